@@ -0,0 +1,220 @@
+#!/bin/python
+import getopt
+import heapq
+import random
+import socket
+import sys
+import threading
+import time
+from coapthon import defines
+from coapthon.client.coap_synchronous import HelperClientSynchronous
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap_protocol import CoAP
+from coapthon.utils import parse_blockwise
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class Bulk(Resource):
+    def __init__(self, name="Bulk", coap_server=None, length=65536):
+        super(Bulk, self).__init__(name, coap_server, visible=True, observable=False, allow_children=False)
+        self.payload = "".join(chr(ord("a") + i % 26) for i in xrange(length))
+
+    def render_GET(self, request):
+        return self
+
+
+class DelayRelay(object):
+    """
+    Forward the datagrams between a client and a server adding a one way delay of rtt / 2 and dropping a fraction
+    of them, to emulate a constrained link.
+    """
+    def __init__(self, address, server_address, rtt, loss):
+        self.server_address = server_address
+        self.delay = rtt / 2.0
+        self.loss = loss
+        self.client_address = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(address)
+        self._socket.settimeout(0.5)
+        self._queue = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._receive), threading.Thread(target=self._forward)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _receive(self):
+        while not self._stopped:
+            try:
+                data, address = self._socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            if address == self.server_address:
+                destination = self.client_address
+            else:
+                self.client_address = address
+                destination = self.server_address
+            if destination is None or random.random() < self.loss:
+                continue
+            with self._condition:
+                heapq.heappush(self._queue, (time.time() + self.delay, data, destination))
+                self._condition.notify()
+
+    def _forward(self):
+        while not self._stopped:
+            with self._condition:
+                while len(self._queue) == 0 and not self._stopped:
+                    self._condition.wait(0.5)
+                if self._stopped:
+                    return
+                due, data, destination = self._queue[0]
+                now = time.time()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._queue)
+            self._socket.sendto(data, destination)
+
+    def close(self):
+        self._stopped = True
+        with self._condition:
+            self._condition.notify()
+
+
+def block2_get(address, path, size):
+    """
+    GET with plain Block2, one request per block, retransmitted after ACK_TIMEOUT.
+
+    :return: the payload
+    """
+    serializer = Serializer()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = ""
+    num = 0
+    # apart from the MIDs of HelperClientSynchronous, the server sees both clients as the relay
+    mid = random.randint(10000, 60000)
+    try:
+        while True:
+            request = Request()
+            request.code = defines.inv_codes["GET"]
+            request.type = defines.inv_types["CON"]
+            request.uri_path = path
+            request.mid = mid
+            request.add_block2(num, 0, size)
+            datagram = serializer.serialize(request)
+            timeout = defines.ACK_TIMEOUT
+            response = None
+            while response is None:
+                sock.sendto(datagram, address)
+                sock.settimeout(timeout)
+                try:
+                    while True:
+                        data, source = sock.recvfrom(4096)
+                        message = serializer.deserialize(data, source[0], source[1])
+                        if isinstance(message, Response) and message.mid == mid:
+                            response = message
+                            break
+                except socket.timeout:
+                    timeout *= 2
+            mid = (mid + 1) % (1 << 16)
+            payload += str(response.payload)
+            block = response.block2
+            if block == 0:
+                return payload
+            num, m, size = parse_blockwise(block)
+            if m == 0:
+                return payload
+            num += 1
+    finally:
+        sock.close()
+
+
+def usage():
+    print "Command:\tbenchmark_blockwise.py [-l] [-s] [-r] [-L] [-n] [-w]"
+    print "Options:"
+    print "\t-l, --length=\t\tSize of the representation in bytes (default 65536)"
+    print "\t-s, --size=\t\tBlock size (default 1024)"
+    print "\t-r, --rtt=\t\tRound trip time of the emulated link in seconds (default 0.3)"
+    print "\t-L, --loss=\t\tFraction of datagrams dropped by the emulated link (default 0)"
+    print "\t-n, --runs=\t\tTransfers per mode (default 1)"
+    print "\t-w, --window=\t\tBlocks requested concurrently by the pipelined Block2 client (default 4)"
+
+
+def main():
+    length = 65536
+    size = 1024
+    rtt = 0.3
+    loss = 0.0
+    runs = 1
+    window = 4
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hl:s:r:L:n:w:", ["help", "length=", "size=", "rtt=", "loss=",
+                                                                  "runs=", "window="])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-l", "--length"):
+            length = int(a)
+        elif o in ("-s", "--size"):
+            size = int(a)
+        elif o in ("-r", "--rtt"):
+            rtt = float(a)
+        elif o in ("-L", "--loss"):
+            loss = float(a)
+        elif o in ("-n", "--runs"):
+            runs = int(a)
+        elif o in ("-w", "--window"):
+            window = int(a)
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        else:
+            usage()
+            sys.exit(2)
+
+    server_address = ("127.0.0.1", 5683)
+    relay_address = ("127.0.0.1", 5684)
+    server = CoAP(server_address)
+    server.add_resource("bulk/", Bulk(length=length))
+    server_thread = threading.Thread(target=server.listen, args=(1,))
+    server_thread.start()
+    relay = DelayRelay(relay_address, server_address, rtt, loss)
+    expected = Bulk(length=length).payload
+    client = HelperClientSynchronous()
+    print "%d bytes, blocks of %d bytes, RTT %.3f s, loss %.2f" % (length, size, rtt, loss)
+    server.endpoints.set_block_size("0.0.0.0/0", size)
+    try:
+        for name in ("Block2", "Block2 x%d" % window, "Q-Block2"):
+            elapsed = []
+            for i in xrange(runs):
+                start = time.time()
+                if name == "Block2":
+                    payload = block2_get(relay_address, "bulk", size)
+                elif name.startswith("Block2"):
+                    try:
+                        payload = "".join(client.get_stream(path="coap://%s:%d/bulk" % relay_address, window=window))
+                    except socket.timeout:
+                        payload = None
+                else:
+                    response = client.get_qblock(path="coap://%s:%d/bulk" % relay_address, size=size)
+                    payload = response.payload if response is not None else None
+                elapsed.append(time.time() - start)
+                if payload != expected:
+                    print "%s: wrong payload" % name
+            print "%-10s %8.3f s (best of %d)" % (name, min(elapsed), runs)
+    finally:
+        relay.close()
+        server.close()
+        server_thread.join(timeout=25)
+
+
+if __name__ == '__main__':
+    main()
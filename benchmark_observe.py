@@ -0,0 +1,134 @@
+#!/bin/python
+import getopt
+import gc
+import os
+import subprocess
+import sys
+import time
+from coapthon import defines
+from coapthon.layer.observe import ObserveRelation, ObserverRegistry
+from coapthon.messages.option import Option
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+def rss():
+    """
+    Get the resident memory of the process.
+
+    :return: the resident memory in bytes
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def registration(i, path):
+    """
+    Build the registration of an observer, as received by the server.
+
+    :param i: the index of the observer
+    :param path: the path of the observed resource
+    :return: (request, response)
+    """
+    request = Request()
+    request.code = defines.inv_codes['GET']
+    request.type = defines.inv_types['CON']
+    request.mid = i % (1 << 16)
+    request.token = "%08x" % i
+    # 250 observers behind each address
+    request.source = ("10.%d.%d.%d" % ((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff), 5683 + i % 250)
+    request.uri_path = path
+    request.observe = 0
+    response = Response()
+    response.destination = request.source
+    response.token = request.token
+    response.type = defines.inv_types['ACK']
+    response.mid = request.mid
+    response.code = defines.responses['CONTENT']
+    option = Option()
+    option.number = defines.inv_options['Observe']
+    option.value = 1
+    response.add_option(option)
+    response.payload = "22.5"
+    return request, response
+
+
+def measure(mode, count, resources):
+    """
+    Register the observers and print the memory used by each relation.
+
+    :param mode: "relation" to store ObserveRelation records, "messages" to keep the registration messages
+    :param count: the number of observers
+    :param resources: the number of observed resources
+    """
+    observed = []
+    for i in xrange(resources):
+        resource = Resource("Sensor%d" % i, visible=True, observable=True, allow_children=False)
+        resource.path = "sensor%d" % i
+        observed.append(resource)
+    registry = ObserverRegistry()
+    legacy = {}
+    gc.collect()
+    before = rss()
+    start = time.time()
+    for i in xrange(count):
+        resource = observed[i % resources]
+        request, response = registration(i, resource.path)
+        if mode == "relation":
+            registry.add(resource, ObserveRelation(request, response, 1))
+        else:
+            host, port = response.destination
+            now = int(round(time.time() * 1000))
+            legacy.setdefault(resource, {})[(host, port, response.token)] = (now, request, response)
+    elapsed = time.time() - start
+    gc.collect()
+    used = rss() - before
+    print "%-10s %9d relations %10.1f MB %8.0f bytes/relation %8.2f s" % (mode, count, used / 1048576.0,
+                                                                          used / float(count), elapsed)
+
+
+def usage():
+    print "Command:\tbenchmark_observe.py [-n] [-r]"
+    print "Options:"
+    print "\t-n, --relations=\t\tNumber of observe relations (default 100000)"
+    print "\t-r, --resources=\t\tNumber of observed resources (default 100)"
+
+
+def main():
+    count = 100000
+    resources = 100
+    mode = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:r:m:", ["help", "relations=", "resources=", "mode="])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-n", "--relations"):
+            count = int(a)
+        elif o in ("-r", "--resources"):
+            resources = int(a)
+        elif o in ("-m", "--mode"):
+            mode = a
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        else:
+            usage()
+            sys.exit(2)
+
+    if mode is not None:
+        measure(mode, count, resources)
+        return
+    # each layout is measured in its own process, the memory freed by the previous one would be reused
+    for mode in ("messages", "relation"):
+        subprocess.call([sys.executable, __file__, "-n", str(count), "-r", str(resources), "-m", mode])
+
+
+if __name__ == '__main__':
+    main()
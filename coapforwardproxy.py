@@ -1,4 +1,3 @@
-from twisted.internet import reactor
 from coapthon.proxy.forward_coap_protocol import ProxyCoAP
 
 __author__ = 'giacomo'
@@ -14,13 +13,10 @@ def main():
 
     server = CoAPForwardProxy("bbbb::2", 5683)
     try:
-        server.serve_forever(poll_interval=0.01)
+        server.listen(10)
     except KeyboardInterrupt:
         print "Server Shutdown"
-        server.server_close()
-        server.stopped.set()
-        server.timer_mid.cancel()
-        server.executor.shutdown(False)
+        server.close()
         print "Exiting..."
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+#!/bin/python
+import getopt
+import sys
+from coapthon.resources.resource_directory import ResourceDirectory
+from coapthon.server.coap_protocol import CoAP
+
+
+class CoAPResourceDirectory(CoAP):
+    def __init__(self, host, port, multicast=False, starting_mid=None):
+        CoAP.__init__(self, (host, port), multicast, starting_mid)
+        self.directory = ResourceDirectory(self)
+        print "CoAP Resource Directory start on " + host + ":" + str(port)
+        print self.root.dump()
+
+    def close(self):
+        self.directory.close()
+        CoAP.close(self)
+
+
+def usage():
+    print "coapresourcedirectory.py -i <ip address> -p <port>"
+
+
+def main(argv):
+    ip = "127.0.0.1"
+    port = 5683
+    try:
+        opts, args = getopt.getopt(argv, "hi:p:", ["ip=", "port="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-i", "--ip"):
+            ip = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+
+    server = CoAPResourceDirectory(ip, port)
+    try:
+        server.listen(10)
+    except KeyboardInterrupt:
+        print "Server Shutdown"
+        server.close()
+        print "Exiting..."
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,7 +2,7 @@
 import getopt
 import sys
 from coapthon.server.coap_protocol import CoAP
-from example_resources import Storage, Separate, BasicResource, Long, Big
+from example_resources import Storage, Separate, BasicResource, Long, Big, Sensor
 
 
 class CoAPServer(CoAP):
@@ -13,6 +13,7 @@ class CoAPServer(CoAP):
         self.add_resource('separate/', Separate())
         self.add_resource('long/', Long())
         self.add_resource('big/', Big())
+        self.add_resource('sensors/{id}/temp', Sensor())
         print "CoAP Server start on " + host + ":" + str(port)
         print self.root.dump()
 
@@ -0,0 +1,280 @@
+import collections
+import threading
+import time
+from coapthon import defines
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+from coapthon.utils import parse_blockwise
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+# options identifying the resource, the responses are invalidated together when the resource is changed
+URI_OPTIONS = frozenset(defines.inv_options[name] for name in ("Uri-Host", "Uri-Port", "Uri-Path", "Uri-Query",
+                                                                "Proxy-Uri", "Proxy-Scheme"))
+
+# options handled by the cache or by the blockwise transfers, not part of the cache key
+NOT_KEY_OPTIONS = frozenset(defines.inv_options[name] for name in ("ETag", "Observe", "Block1", "Block2", "Q-Block1",
+                                                                    "Q-Block2"))
+
+
+class CacheEntry(object):
+    """
+    A response stored in the cache.
+    """
+    __slots__ = ("uri", "datagram", "source", "etag", "expires")
+
+    def __init__(self, uri, datagram, source, etag, expires):
+        """
+        Initialize an entry.
+
+        :param uri: the options identifying the resource
+        :param datagram: the encoded response
+        :param source: the (host, port) of the server
+        :param etag: the ETag of the response, None if the response cannot be revalidated
+        :param expires: the time the response becomes stale
+        """
+        self.uri = uri
+        self.datagram = datagram
+        self.source = source
+        self.etag = etag
+        self.expires = expires
+
+
+class ClientCache(object):
+    """
+    Cache of the responses received by a client (RFC 7252, 5.6). A fresh response is served without contacting the
+    server; a stale response with an ETag is revalidated, the 2.03 Valid response refreshes it without transferring
+    the representation again. The responses are stored encoded, the least recently used are evicted beyond max_size
+    bytes.
+    """
+    def __init__(self, max_size=None):
+        """
+        Initialize the cache.
+
+        :param max_size: the maximum number of bytes of the stored responses, CLIENT_CACHE_SIZE by default
+        """
+        self._max_size = max_size if max_size is not None else defines.CLIENT_CACHE_SIZE
+        self._lock = threading.Lock()
+        # key -> CacheEntry, the least recently used are the first ones
+        self._entries = collections.OrderedDict()
+        # uri -> set of keys of the responses of the resource
+        self._uris = {}
+        self.size = 0
+        # requests served from the cache, revalidated with 2.03 Valid, and sent to get a new representation
+        self.hits = 0
+        self.validations = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        """
+        Get the fraction of the GET requests answered without transferring the representation.
+
+        :return: the hit ratio, 0 if there have been no requests
+        """
+        total = self.hits + self.validations + self.misses
+        if total == 0:
+            return 0.0
+        return (self.hits + self.validations) / float(total)
+
+    def stats(self):
+        """
+        Get the statistics of the cache.
+
+        :return: a dictionary with hits, validations, misses, hit_ratio, entries and size
+        """
+        with self._lock:
+            return {"hits": self.hits, "validations": self.validations, "misses": self.misses,
+                    "hit_ratio": self.hit_ratio, "entries": len(self._entries), "size": self.size}
+
+    def lookup(self, request):
+        """
+        Serve a request from the cache. If the stored response is stale, its ETag is added to the request to
+        revalidate it.
+
+        :param request: the request, with its destination
+        :return: the fresh response, None if the request must be sent to the server
+        """
+        if request.code != defines.inv_codes["GET"] or not self._whole(request):
+            return None
+        uri, key = self._key(request)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            if entry.expires > now:
+                self.hits += 1
+            else:
+                if entry.etag is not None and len(request.etag) == 0:
+                    request.etag = entry.etag
+                return None
+        return self._response(entry, request, now)
+
+    def update(self, request, response):
+        """
+        Update the cache with the response to a request.
+
+        :param request: the request
+        :param response: the response
+        :return: the response to deliver, the stored one if the server answers 2.03 Valid
+        """
+        if not isinstance(response, Response):
+            return response
+        uri, key = self._key(request)
+        now = time.time()
+        if request.code != defines.inv_codes["GET"]:
+            if response.code in (defines.responses["CREATED"], defines.responses["DELETED"],
+                                 defines.responses["CHANGED"]):
+                self.invalidate(uri)
+            return response
+        if not self._whole(request):
+            # a block following the first one, never served from the cache
+            return response
+        if response.code == defines.responses["VALID"]:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and (len(response.etag) == 0 or entry.etag in response.etag):
+                    entry.expires = now + self._max_age(response)
+                    self.validations += 1
+                else:
+                    entry = None
+                    self.misses += 1
+            if entry is not None:
+                return self._response(entry, request, now)
+            return response
+        with self._lock:
+            self.misses += 1
+        if response.code == defines.responses["CONTENT"] and self._whole(response, True):
+            self.store(request, response)
+        return response
+
+    def store(self, request, response):
+        """
+        Store the whole representation of a resource, e.g. reassembled from its blocks.
+
+        :param request: the request
+        :param response: the 2.05 Content response
+        """
+        max_age = self._max_age(response)
+        etag = response.etag[0] if len(response.etag) > 0 else None
+        if max_age == 0 and etag is None:
+            return
+        datagram = Serializer().serialize(response).raw
+        if len(datagram) > self._max_size:
+            return
+        uri, key = self._key(request)
+        entry = CacheEntry(uri, datagram, response.source, etag, time.time() + max_age)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.datagram)
+            self._entries[key] = entry
+            self._uris.setdefault(uri, set()).add(key)
+            self.size += len(datagram)
+            while self.size > self._max_size:
+                key, old = self._entries.popitem(last=False)
+                self._forget(key, old)
+
+    def invalidate(self, uri):
+        """
+        Mark the responses of a resource as stale, they are revalidated at the next request.
+
+        :param uri: the options identifying the resource
+        """
+        with self._lock:
+            for key in self._uris.get(uri, ()):
+                self._entries[key].expires = 0
+
+    def clear(self):
+        """
+        Remove all the responses.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._uris.clear()
+            self.size = 0
+
+    def _forget(self, key, entry):
+        """
+        Update the size and the index after the removal of an entry.
+
+        :param key: the key of the entry
+        :param entry: the entry
+        """
+        self.size -= len(entry.datagram)
+        keys = self._uris.get(entry.uri)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._uris[entry.uri]
+
+    @staticmethod
+    def _key(request):
+        """
+        Compute the cache key of a request: its destination and options, except the NoCacheKey ones.
+
+        :param request: the request
+        :return: (uri, key), the options identifying the resource and the cache key
+        """
+        uri = []
+        others = []
+        for option in sorted(request.options, key=lambda o: o.number):
+            number = option.number
+            value = option.value
+            if isinstance(value, bytearray):
+                value = str(value)
+            if number in URI_OPTIONS:
+                uri.append((number, value))
+            elif number not in NOT_KEY_OPTIONS and number & 0x1E != 0x1C:
+                others.append((number, value))
+        uri = (request.destination,) + tuple(uri)
+        return uri, (uri, tuple(others))
+
+    @staticmethod
+    def _whole(message, last=False):
+        """
+        Check that a message asks for, or carries, the whole representation or its first block.
+
+        :param message: the message
+        :param last: True if the first block must also be the last one
+        :return: True if the message concerns the whole representation
+        """
+        for option in message.options:
+            if option.number == defines.inv_options["Block2"]:
+                num, m, size = parse_blockwise(option.raw_value)
+                return num == 0 and not (last and m == 1)
+        return True
+
+    @staticmethod
+    def _max_age(response):
+        """
+        Get the Max-Age of a response, 60 seconds if not specified.
+
+        :param response: the response
+        :return: the Max-Age in seconds
+        """
+        for option in response.options:
+            if option.number == defines.inv_options["Max-Age"]:
+                return int(option.value)
+        return defines.options[defines.inv_options["Max-Age"]][3]
+
+    @staticmethod
+    def _response(entry, request, now):
+        """
+        Rebuild a stored response for a request, with the remaining freshness as Max-Age.
+
+        :param entry: the entry
+        :param request: the request
+        :param now: the current time
+        :return: the response
+        """
+        host, port = entry.source
+        response = Serializer().deserialize(entry.datagram, host, port)
+        response.token = request.token
+        response.destination = request.source
+        response.del_option_name("Max-Age")
+        response.max_age = max(0, int(entry.expires - now))
+        return response
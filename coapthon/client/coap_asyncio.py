@@ -0,0 +1,547 @@
+import collections
+import functools
+import random
+import socket
+from coapthon import defines
+from coapthon.endpoint import registry as shared_registry
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+from coapthon.client.matching import fresh_notification, reply
+from coapthon.utils import parse_uri
+try:
+    import asyncio
+except ImportError:
+    # Python 2: the backport of asyncio
+    import trollius as asyncio
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        """
+        The end of an observe stream, raised by __anext__.
+        """
+
+ensure_future = getattr(asyncio, "ensure_future", None) or getattr(asyncio, "async")
+
+
+class AsyncExchange(object):
+    """
+    A request waiting for its response, or an observation receiving notifications.
+    """
+    __slots__ = ("request", "future", "stream", "endpoint", "address", "datagram", "timeout", "retransmissions",
+                 "sent", "timer", "acknowledged", "observe", "observed")
+
+    def __init__(self, request, future, stream):
+        """
+        Initialize an exchange.
+
+        :param request: the request
+        :param future: the future of the response
+        :param stream: the ObserveStream receiving the notifications, None if the request does not observe
+        """
+        self.request = request
+        self.future = future
+        self.stream = stream
+        self.endpoint = None
+        self.address = None
+        self.datagram = None
+        # the timeout of the last transmission, chosen from the RTO of the server
+        self.timeout = None
+        self.retransmissions = 0
+        self.sent = None
+        # the retransmission or give up timer, None once the response is received
+        self.timer = None
+        # the server has acknowledged the request, the response is separate
+        self.acknowledged = False
+        # Observe number and time of the last notification, to discard the ones received out of order
+        self.observe = None
+        self.observed = None
+
+
+class ObserveStream(object):
+    """
+    The notifications of an observation, the first response included. With asyncio it is an asynchronous iterator,
+    with trollius the notifications are received with yield From(stream.receive()).
+    """
+    def __init__(self, client, request):
+        """
+        Initialize the stream.
+
+        :param client: the client
+        :param request: the request of the observation
+        """
+        self.request = request
+        self.response = None
+        self._client = client
+        self._notifications = collections.deque()
+        self._waiter = None
+        self.closed = False
+
+    def receive(self):
+        """
+        Receive the next notification.
+
+        :return: the future of the notification, its result is None once the observation has ended
+        """
+        future = asyncio.Future(loop=self._client.loop)
+        if len(self._notifications) > 0:
+            future.set_result(self._notifications.popleft())
+        elif self.closed:
+            future.set_result(None)
+        else:
+            self._waiter = future
+        return future
+
+    def cancel(self):
+        """
+        End the observation, the following notifications are rejected with a RST.
+        """
+        self._client.cancel_observing(self.request)
+        self.put(None, True)
+
+    def put(self, notification, last=False):
+        """
+        Deliver a notification.
+
+        :param notification: the notification, None to only end the stream
+        :param last: True if the observation has ended
+        """
+        if notification is not None:
+            self._notifications.append(notification)
+        self.closed = self.closed or last
+        if self._waiter is not None and not self._waiter.done():
+            if len(self._notifications) > 0:
+                self._waiter.set_result(self._notifications.popleft())
+                self._waiter = None
+            elif self.closed:
+                self._waiter.set_result(None)
+                self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = asyncio.Future(loop=self._client.loop)
+
+        def received(notification):
+            if future.cancelled():
+                return
+            if notification.exception() is not None:
+                future.set_exception(notification.exception())
+            elif notification.result() is None:
+                future.set_exception(StopAsyncIteration())
+            else:
+                future.set_result(notification.result())
+
+        self.receive().add_done_callback(received)
+        return future
+
+
+class HelperClientAsyncio(asyncio.DatagramProtocol):
+    """
+    CoAP client for asyncio (trollius on Python 2). All the requests to all the servers share one datagram transport,
+    the responses are matched with the requests by token and the ACKs and RSTs by MID, the CON requests are
+    retransmitted by timers of the event loop. The requests return futures of their response.
+    """
+    def __init__(self, loop=None, endpoints=None):
+        """
+        Initialize the client and open its transport.
+
+        :param loop: the event loop, the current one by default
+        :param endpoints: the EndpointRegistry updated with the RTT and losses of the servers, the registry shared by
+                          the clients of the process by default
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.endpoints = endpoints if endpoints is not None else shared_registry
+        self.transport = None
+        self._family = None
+        self._current_mid = random.randint(1, 1 << 16)
+        # (host, port, token) -> AsyncExchange
+        self._tokens = {}
+        # (host, port, mid) -> AsyncExchange, while the request may be retransmitted
+        self._mids = {}
+        # (host, port) -> (endpoint, socket address)
+        self._addresses = {}
+        # the requests sent before the transport is open
+        self._waiting = []
+        self._closed = False
+        self._open(socket.AF_INET6)
+
+    def get(self, uri):
+        """
+        GET a resource.
+
+        :param uri: the URI or the request
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["GET"], uri))
+
+    def put(self, uri, payload):
+        """
+        PUT a resource.
+
+        :param uri: the URI or the request
+        :param payload: the payload
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["PUT"], uri, payload))
+
+    def post(self, uri, payload):
+        """
+        POST to a resource.
+
+        :param uri: the URI or the request
+        :param payload: the payload
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["POST"], uri, payload))
+
+    def delete(self, uri):
+        """
+        DELETE a resource.
+
+        :param uri: the URI or the request
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["DELETE"], uri))
+
+    def discover(self, uri):
+        """
+        GET the resources of a server, /.well-known/core if the URI has no path.
+
+        :param uri: the URI of the server
+        :return: the future of the response
+        """
+        request = self._request(defines.inv_codes["GET"], uri)
+        if request.uri_path == "":
+            request.uri_path = defines.DISCOVERY_URL
+        return self.send(request)
+
+    def observe(self, uri):
+        """
+        Observe a resource.
+
+        :param uri: the URI or the request
+        :return: the ObserveStream of the notifications, its response attribute is the future of the first response
+        """
+        request = self._request(defines.inv_codes["GET"], uri)
+        request.observe = 0
+        stream = ObserveStream(self, request)
+        stream.response = self.send(request, stream)
+        return stream
+
+    def send(self, request, stream=None):
+        """
+        Send a request.
+
+        :param request: the request, with its destination
+        :param stream: the ObserveStream of the notifications if the request observes the resource
+        :return: the future of the response, it raises socket.timeout if the server does not answer
+        """
+        exchange = AsyncExchange(request, asyncio.Future(loop=self.loop), stream)
+        if self._closed:
+            exchange.future.set_exception(RuntimeError("Client closed"))
+        elif self._family is None:
+            self._waiting.append(exchange)
+        else:
+            self._resolve(exchange)
+        return exchange.future
+
+    def cancel_observing(self, request):
+        """
+        Forget an observation, the following notifications are rejected with a RST.
+
+        :param request: the request of the observation
+        """
+        if request.destination is None or request.token is None:
+            return
+        host, port = request.destination
+        exchange = self._tokens.get((host, port, request.token))
+        if exchange is not None:
+            self._finish(exchange)
+
+    def close(self):
+        """
+        Close the transport, the pending requests fail.
+        """
+        self._closed = True
+        exchanges = self._waiting + self._tokens.values()
+        self._waiting = []
+        for exchange in exchanges:
+            self._finish(exchange)
+            if not exchange.future.done():
+                exchange.future.set_exception(RuntimeError("Client closed"))
+            if exchange.stream is not None:
+                exchange.stream.put(None, True)
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        host = addr[0]
+        if host.startswith("::ffff:") and "." in host:
+            host = host[7:]
+        try:
+            message = Serializer().deserialize(data, host, addr[1])
+        except (ValueError, AttributeError, TypeError):
+            return
+        if isinstance(message, Response):
+            self._handle_response(message, addr)
+        elif isinstance(message, Message) and not isinstance(message, Request):
+            self._handle_message(message)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the request is retransmitted and gives up in time
+        pass
+
+    @staticmethod
+    def _request(code, uri, payload=None):
+        """
+        Build a request.
+
+        :param code: the method
+        :param uri: the URI or the request
+        :param payload: the payload
+        :return: the request
+        """
+        if isinstance(uri, Request):
+            request = uri
+        else:
+            request = Request()
+            host, port, path = parse_uri(uri)
+            request.destination = (host, port)
+            if path != "":
+                request.uri_path = path
+        request.code = code
+        if payload is not None:
+            request.payload = payload
+        return request
+
+    def _open(self, family):
+        """
+        Open the transport, an IPv6 one reaching IPv4 servers through mapped addresses or an IPv4 one.
+
+        :param family: the address family
+        """
+        local = ("::", 0) if family == socket.AF_INET6 else ("0.0.0.0", 0)
+        future = ensure_future(self.loop.create_datagram_endpoint(lambda: self, local_addr=local, family=family),
+                               loop=self.loop)
+        future.add_done_callback(functools.partial(self._opened, family))
+
+    def _opened(self, family, future):
+        """
+        Send the requests waiting for the transport.
+
+        :param family: the address family of the transport
+        :param future: the future of the transport
+        """
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            if family == socket.AF_INET6:
+                self._open(socket.AF_INET)
+                return
+            for exchange in self._waiting:
+                exchange.future.set_exception(future.exception())
+            self._waiting = []
+            return
+        if self._closed:
+            self.transport.close()
+            return
+        self._family = family
+        waiting = self._waiting
+        self._waiting = []
+        for exchange in waiting:
+            self._resolve(exchange)
+
+    def _resolve(self, exchange):
+        """
+        Resolve the address of the server of a request, then send it.
+
+        :param exchange: the exchange
+        """
+        destination = exchange.request.destination
+        resolved = self._addresses.get(destination)
+        if resolved is not None:
+            self._start(exchange, *resolved)
+            return
+        host, port = destination
+        family = socket.AF_UNSPEC if self._family == socket.AF_INET6 else socket.AF_INET
+        future = ensure_future(self.loop.getaddrinfo(host, port, family=family, type=socket.SOCK_DGRAM),
+                               loop=self.loop)
+        future.add_done_callback(functools.partial(self._resolved, exchange))
+
+    def _resolved(self, exchange, future):
+        """
+        Send a request once the address of its server is resolved.
+
+        :param exchange: the exchange
+        :param future: the future of the address
+        """
+        if future.exception() is not None or len(future.result()) == 0:
+            if not exchange.future.done():
+                exchange.future.set_exception(future.exception() or socket.gaierror("No address"))
+            return
+        family, socktype, proto, canonname, sockaddr = future.result()[0]
+        endpoint = (sockaddr[0], sockaddr[1])
+        if family == socket.AF_INET and self._family == socket.AF_INET6:
+            address = ("::ffff:" + sockaddr[0], sockaddr[1])
+        else:
+            address = sockaddr
+        self._addresses[exchange.request.destination] = (endpoint, address)
+        self._start(exchange, endpoint, address)
+
+    def _start(self, exchange, endpoint, address):
+        """
+        Send a request and start its retransmission timer.
+
+        :param exchange: the exchange
+        :param endpoint: the (host, port) of the server
+        :param address: the socket address of the server
+        """
+        if exchange.future.done() or self._closed:
+            # cancelled meanwhile
+            return
+        request = exchange.request
+        if request.type is None:
+            request.type = defines.inv_types["CON"]
+        if request.token is None:
+            request.token = "%08x" % random.getrandbits(32)
+            while endpoint + (request.token,) in self._tokens:
+                request.token = "%08x" % random.getrandbits(32)
+        if request.mid is None:
+            request.mid = self._current_mid % (1 << 16)
+            self._current_mid += 1
+        request.destination = endpoint
+        exchange.endpoint = endpoint
+        exchange.address = address
+        exchange.datagram = Serializer().serialize(request).raw
+        self._tokens[endpoint + (request.token,)] = exchange
+        self._mids[endpoint + (request.mid,)] = exchange
+        exchange.future.add_done_callback(functools.partial(self._done, exchange))
+        exchange.sent = self.loop.time()
+        exchange.timeout = self.endpoints.timeout(endpoint)
+        self.transport.sendto(exchange.datagram, address)
+        if request.type == defines.inv_types["CON"]:
+            exchange.timer = self.loop.call_later(exchange.timeout, self._retransmit, exchange)
+        else:
+            # no retransmission, the response may still come within MAX_TRANSMIT_SPAN
+            exchange.retransmissions = defines.MAX_RETRANSMIT
+            exchange.timer = self.loop.call_later(defines.MAX_TRANSMIT_SPAN, self._retransmit, exchange)
+
+    def _done(self, exchange, future):
+        """
+        Forget a request whose future has been cancelled, e.g. by asyncio.wait_for.
+
+        :param exchange: the exchange
+        :param future: the future of the response
+        """
+        if future.cancelled():
+            self._finish(exchange)
+
+    def _finish(self, exchange):
+        """
+        Forget an exchange.
+
+        :param exchange: the exchange
+        """
+        if exchange.timer is not None:
+            exchange.timer.cancel()
+            exchange.timer = None
+        if exchange.endpoint is None:
+            return
+        host, port = exchange.endpoint
+        if self._tokens.get((host, port, exchange.request.token)) is exchange:
+            del self._tokens[(host, port, exchange.request.token)]
+        if self._mids.get((host, port, exchange.request.mid)) is exchange:
+            del self._mids[(host, port, exchange.request.mid)]
+
+    def _retransmit(self, exchange):
+        """
+        Retransmit a CON request not acknowledged in time, give up after MAX_RETRANSMIT retransmissions.
+
+        :param exchange: the exchange
+        """
+        exchange.timer = None
+        if exchange.acknowledged or exchange.retransmissions >= defines.MAX_RETRANSMIT:
+            if exchange.retransmissions > 0 and not exchange.acknowledged:
+                self.endpoints.lost(exchange.endpoint)
+            self._finish(exchange)
+            if not exchange.future.done():
+                exchange.future.set_exception(socket.timeout("No response from %s:%d" % exchange.endpoint))
+            if exchange.stream is not None:
+                exchange.stream.put(None, True)
+            return
+        exchange.retransmissions += 1
+        exchange.timeout = self.endpoints.backoff(exchange.endpoint, exchange.timeout)
+        self.endpoints.lost(exchange.endpoint)
+        self.transport.sendto(exchange.datagram, exchange.address)
+        exchange.timer = self.loop.call_later(exchange.timeout, self._retransmit, exchange)
+
+    def _handle_response(self, response, addr):
+        """
+        Match a response with its request by token. The CON responses are acknowledged, the notifications of unknown
+        observations are rejected.
+
+        :param response: the response
+        :param addr: the socket address of the server
+        """
+        host, port = response.source
+        exchange = self._tokens.get((host, port, response.token))
+        message = reply(response, exchange is not None)
+        if message is not None:
+            self.transport.sendto(Serializer().serialize(message).raw, addr)
+        if exchange is None:
+            return
+        first = exchange.timer is not None
+        if first and not exchange.acknowledged:
+            # a retransmitted request gives a weak RTT sample
+            self.endpoints.rtt(exchange.endpoint, self.loop.time() - exchange.sent, exchange.retransmissions)
+        if exchange.timer is not None:
+            exchange.timer.cancel()
+            exchange.timer = None
+        self._mids.pop((host, port, exchange.request.mid), None)
+        if exchange.stream is None or response.observe is None:
+            # the last response of the exchange: the server refused or ended the observation
+            self._finish(exchange)
+        if exchange.stream is not None:
+            if response.observe is None:
+                exchange.stream.put(response, True)
+            elif fresh_notification(exchange, response.observe, self.loop.time()):
+                exchange.stream.put(response)
+        if not exchange.future.done():
+            exchange.future.set_result(response)
+
+    def _handle_message(self, message):
+        """
+        Handle an empty ACK, the response will be separate, or a RST, the request is rejected.
+
+        :param message: the message
+        """
+        host, port = message.source
+        exchange = self._mids.get((host, port, message.mid))
+        if exchange is None:
+            return
+        if message.type == defines.inv_types["ACK"]:
+            if not exchange.acknowledged and exchange.timer is not None:
+                self.endpoints.rtt(exchange.endpoint, self.loop.time() - exchange.sent, exchange.retransmissions)
+                exchange.acknowledged = True
+                # wait for the separate response without retransmitting
+                exchange.timer.cancel()
+                exchange.timer = self.loop.call_later(defines.EXCHANGE_LIFETIME, self._retransmit, exchange)
+            return
+        if message.type != defines.inv_types["RST"]:
+            return
+        self._finish(exchange)
+        if exchange.stream is not None:
+            exchange.stream.put(None, True)
+        if not exchange.future.done():
+            exchange.future.set_result(message)
@@ -1,14 +1,12 @@
-import os
+import collections
+import logging
 import random
-import re
 import time
-import twisted
-from twisted.application.service import Application
+from twisted.internet import defer
 from twisted.internet.error import AlreadyCancelled
-from twisted.python import log
-from twisted.python.log import ILogObserver, FileLogObserver
-from twisted.python.logfile import DailyLogFile
 from coapthon import defines
+from coapthon.client.matching import fresh_notification, reply
+from coapthon.endpoint import registry as shared_registry
 from coapthon.messages.message import Message
 from coapthon.messages.option import Option
 from coapthon.messages.request import Request
@@ -23,29 +21,52 @@ from twisted.internet import reactor
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
-
-home = os.path.expanduser("~")
-if not os.path.exists(home + "/.coapthon/"):
-    os.makedirs(home + "/.coapthon/")
-
-# First, startLogging to capture stdout
-logfile = DailyLogFile("CoAPthon_client.log", home + "/.coapthon/")
-# Now add an observer that logs to a file
-application = Application("CoAPthon_Client")
-application.setComponent(ILogObserver, FileLogObserver(logfile).emit)
+logger = logging.getLogger(__name__)
+
+
+class SharedObservation(object):
+    """
+    An observe relation with a server shared by all the local subscribers of a resource with the same Accept. The
+    notifications are received once and passed to every subscriber.
+    """
+    def __init__(self, key, request):
+        """
+        Initialize an observation.
+
+        :param key: the (host, port, path, accept) of the resource
+        :param request: the registration request
+        """
+        self.key = key
+        self.request = request
+        # [client_callback, Deferred fired with the first response]
+        self.subscribers = []
+        self.response = None
+        # Observe number and reception time of the last notification delivered
+        self.observe = None
+        self.observed = 0
+        # the call re-registering the observation when it goes silent
+        self.refresh = None
 
 
 class CoAP(DatagramProtocol):
-    def __init__(self, server, forward):
-        # print "INIT CLIENT\n"
+    def __init__(self, server, forward, max_in_flight=defines.NSTART, endpoints=None):
         self._forward = forward
+        # RTT statistics of the servers, giving the retransmission timeouts
+        self.endpoints = endpoints if endpoints is not None else shared_registry
         self.received = {}
         self.sent = {}
         self.sent_token = {}
         self.received_token = {}
         self.call_id = {}
+        # token -> SharedObservation, and (host, port, path, accept) -> SharedObservation
         self.relation = {}
+        self.shared = {}
         self._currentMID = 1
+        # requests waiting for a response and requests waiting for a free slot, per endpoint
+        self.max_in_flight = max_in_flight
+        self._in_flight = {}
+        self._pending = {}
+        self._stop_when_done = False
         import socket
         try:
             socket.inet_aton(server[0])
@@ -57,15 +78,10 @@ class CoAP(DatagramProtocol):
 
             self.server = (server[0], server[1])
 
-        # defer = reactor.resolve('coap.me')
-        # defer.addCallback(self.start)
-        # self.server = (None, 5683)
-
         root = Resource('root', visible=False, observable=False, allow_children=True)
         root.path = '/'
         self.root = Tree()
         self.root["/"] = root
-        self.operations = []
         self.l = None
 
     @property
@@ -77,19 +93,22 @@ class CoAP(DatagramProtocol):
         self._currentMID = c
 
     def set_operations(self, operations):
+        """
+        Start all the operations at once, at most max_in_flight of them are sent to the same endpoint before
+        a response comes back.
+
+        :param operations: list of (function, args, kwargs, client_callback)
+        """
+        if not self._forward:
+            self._stop_when_done = True
         for op in operations:
-            function, args, kwargs, client_callback = op
-            self.operations.append((function, args, kwargs, client_callback))
-        host, port = self.server
-
-        if host is not None:
-            self.start(host)
+            function, args, kwargs, client_callback = self.get_operation(op)
+            if function is not None:
+                function(client_callback, *args, **kwargs)
 
     def startProtocol(self):
-        # print "STARTPROTOCOL\n"
-        # self.transport.connect(self.server)
         if self.server is None:
-            log.err("Server address for the client is not initialized")
+            logger.error("Server address for the client is not initialized")
             exit()
         self.l = task.LoopingCall(self.purge_mids)
         self.l.start(defines.EXCHANGE_LIFETIME)
@@ -98,16 +117,17 @@ class CoAP(DatagramProtocol):
         self.l.stop()
 
     def purge_mids(self):
-        log.msg("Purge mids")
+        logger.debug("Purge mids")
         now = time.time()
         sent_key_to_delete = []
         for key in self.sent.keys():
-            message, timestamp, callback, client_callback = self.sent.get(key)
+            message, timestamp, d = self.sent.get(key)
             if timestamp + defines.EXCHANGE_LIFETIME <= now:
                 sent_key_to_delete.append(key)
         for key in sent_key_to_delete:
-            message, timestamp, callback, client_callback = self.sent.get(key)
-            key_token = hash(str(self.server[0]) + str(self.server[1]) + str(message.token))
+            message, timestamp, d = self.sent.get(key)
+            host, port = message.destination
+            key_token = hash(str(host) + str(port) + str(message.token))
             try:
                 del self.sent[key]
             except KeyError:
@@ -125,126 +145,189 @@ class CoAP(DatagramProtocol):
             except KeyError:
                 pass
 
-    def start(self, host):
-        # print "START\n"
-        # self.transport.connect(host, self.server[1])
-        function, args, kwargs, client_callback = self.get_operation()
-        function(client_callback, *args, **kwargs)
-
-    # def start_test(self, transport):
-    #     self.transport = transport
-    #     function, args, kwargs, client_callback = self.get_operation()
-    #     function(client_callback, *args, **kwargs)
-
-    def get_operation(self):
-        try:
-            to_exec = self.operations.pop(0)
-            args = []
-            kwargs = {}
-            if len(to_exec) == 4:
-                function, args, kwargs, client_callback = to_exec
-            elif len(to_exec) == 3:
-                function, args, client_callback = to_exec
-            elif len(to_exec) == 2:
-                function, client_callback = to_exec[0]
-            else:
-                return None, None, None, None
-            return function, args, kwargs, client_callback
-        except IndexError:
+    @staticmethod
+    def get_operation(to_exec):
+        """
+        Unpack an operation.
+
+        :param to_exec: (function, args, kwargs, client_callback), (function, args, client_callback)
+                        or (function, client_callback)
+        :return: (function, args, kwargs, client_callback)
+        """
+        args = []
+        kwargs = {}
+        if len(to_exec) == 4:
+            function, args, kwargs, client_callback = to_exec
+        elif len(to_exec) == 3:
+            function, args, client_callback = to_exec
+        elif len(to_exec) == 2:
+            function, client_callback = to_exec
+        else:
             return None, None, None, None
+        return function, args, kwargs, client_callback
 
     def send(self, message):
-        # print "SEND\n"
         serializer = Serializer()
         if message.destination is None:
             message.destination = self.server
         host, port = message.destination
-        print "Message sent to " + host + ":" + str(port)
-        print "----------------------------------------"
-        print message
-        print "----------------------------------------"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message sent to %s:%d\n%s", host, port, message)
         datagram = serializer.serialize(message)
-        log.msg("Send datagram")
         self.transport.write(datagram, message.destination)
 
-    def send_callback(self, req, callback, client_callback):
+    def send_request(self, req):
+        """
+        Send a request, or queue it while max_in_flight requests to the same endpoint wait for their response.
+
+        :param req: the request
+        :return: a Deferred fired with the response, or with None if the request is rejected or timeouted
+        """
+        if req.destination is None:
+            req.destination = self.server
+        if req.token is None:
+            req.token = "%08x" % random.getrandbits(32)
+        d = defer.Deferred()
+        endpoint = req.destination
+        if self._in_flight.get(endpoint, 0) < self.max_in_flight:
+            self._transmit(req, d)
+        else:
+            self._pending.setdefault(endpoint, collections.deque()).append((req, d))
+        return d
+
+    def _transmit(self, req, d):
+        """
+        Send a request taking one of the slots of its endpoint.
+
+        :param req: the request
+        :param d: the Deferred of the request
+        """
+        endpoint = req.destination
+        self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
         if req.mid is None:
             self._currentMID += 1
-            req.mid = self._currentMID
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(req.mid))
-        key_token = hash(str(self.server[0]) + str(self.server[1]) + str(req.token))
-        self.sent[key] = (req, time.time(), callback, client_callback)
-        self.sent_token[key_token] = (req, time.time(), callback, client_callback)
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        else:
-            err_callback = None
-        self.schedule_retrasmission(req, err_callback)
+            req.mid = self._currentMID % (1 << 16)
+        host, port = endpoint
+        key = hash(str(host) + str(port) + str(req.mid))
+        key_token = hash(str(host) + str(port) + str(req.token))
+        now = time.time()
+        self.sent[key] = (req, now, d)
+        self.sent_token[key_token] = (req, now, d)
+        self.schedule_retrasmission(req)
         self.send(req)
 
+    def _complete(self, req, response):
+        """
+        Fire the Deferred of a request and send the next request queued for the same endpoint.
+
+        :param req: the request
+        :param response: the response, None if the request is rejected or timeouted
+        """
+        host, port = req.destination
+        key = hash(str(host) + str(port) + str(req.mid))
+        entry = self.sent.get(key)
+        if entry is None or entry[2].called:
+            return
+        if response is not None and not req.acknowledged:
+            self._sample(req, entry[1])
+        if key in self.call_id:
+            handler, retransmit_count = self.call_id.pop(key)
+            if handler is not None:
+                try:
+                    handler.cancel()
+                except AlreadyCancelled:
+                    pass
+        if response is not None:
+            self.received[key] = response
+        endpoint = req.destination
+        self._in_flight[endpoint] -= 1
+        queue = self._pending.get(endpoint)
+        if queue:
+            self._transmit(*queue.popleft())
+            if not queue:
+                del self._pending[endpoint]
+        if self._in_flight[endpoint] == 0:
+            del self._in_flight[endpoint]
+        entry[2].callback(response)
+        self._check_done()
+
+    def _sample(self, req, timestamp):
+        """
+        Record the RTT of a request acknowledged or answered, measured from its first transmission.
+
+        :param req: the request
+        :param timestamp: the time of the first transmission
+        """
+        host, port = req.destination
+        key = hash(str(host) + str(port) + str(req.mid))
+        handler, retransmit_count = self.call_id.get(key, (None, 0))
+        self.endpoints.rtt((host, port), time.time() - timestamp, retransmit_count)
+
+    def _check_done(self):
+        """
+        Stop the reactor once all the operations are completed and nothing is observed.
+        """
+        if self._stop_when_done and not self._in_flight and not self._pending and not self.relation:
+            self._stop_when_done = False
+            reactor.stop()
+
+    def send_callback(self, req, callback, client_callback):
+        d = self.send_request(req)
+        d.addCallback(callback, req, client_callback)
+        return d
+
     def datagramReceived(self, datagram, host):
-        # print "RECEIVED\n"
         serializer = Serializer()
         try:
             host, port = host
         except ValueError:
             host, port, tmp1, tmp2 = host
         message = serializer.deserialize(datagram, host, port)
-
-        print "Message received from " + host + ":" + str(port)
-        print "----------------------------------------"
-        print message
-        print "----------------------------------------"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message received from %s:%d\n%s", host, port, message)
         if isinstance(message, Response):
             self.handle_response(message)
         elif isinstance(message, Request):
-            log.err("Received request")
+            logger.warning("Received request from %s:%d", host, port)
         else:
             self.handle_message(message)
 
-        key = hash(str(host) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-           and key in self.sent.keys():
-            # Separate Response
-            print "Separate Response"
-        else:
-            function, args, kwargs, client_callback = self.get_operation()
-            key = hash(str(host) + str(port) + str(message.token))
-            if function is None and len(self.relation) == 0:
-                if not self._forward:
-                    reactor.stop()
-            elif key in self.relation:
-                response, timestamp, client_callback = self.relation.get(key)
-                self.handle_notification(message, client_callback)
-            else:
-                function(client_callback, *args, **kwargs)
-
     def handle_message(self, message):
         host, port = message.source
         key = hash(str(host) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-           and key in self.sent.keys():
-            return None
-        if key in self.sent.keys():
-            self.received[key] = message
-            if message.type == defines.inv_types["RST"]:
-                print message
-            else:
-                req, timestamp, callback, client_callback = self.sent[key]
-                callback(message.mid, client_callback)
+        entry = self.sent.get(key)
+        if entry is None:
+            return
+        req = entry[0]
+        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"]:
+            # Separate Response, the request keeps its slot until the response arrives
+            logger.debug("Separate Response")
+            if not req.acknowledged:
+                self._sample(req, entry[1])
+            req.acknowledged = True
+            handler, retransmit_count = self.call_id.pop(key, (None, 0))
+            if handler is not None:
+                try:
+                    handler.cancel()
+                except AlreadyCancelled:
+                    pass
+        elif message.type == defines.inv_types["RST"]:
+            req.rejected = True
+            self._complete(req, None)
 
     def handle_response(self, response):
-        if response.type == defines.inv_types["CON"]:
-            ack = Message.new_ack(response)
-            self.send(ack)
-        key_token = hash(str(self.server[0]) + str(self.server[1]) + str(response.token))
-
-        if key_token in self.sent_token.keys():
+        host, port = response.source
+        key_token = hash(str(host) + str(port) + str(response.token))
+        entry = self.sent_token.get(key_token)
+        message = reply(response, entry is not None or key_token in self.relation)
+        if message is not None:
+            self.send(message)
+        if entry is not None and not entry[2].called:
+            # a response, or the first notification after a (re-)registration
             self.received_token[key_token] = response
-            req, timestamp, callback, client_callback = self.sent_token[key_token]
-            key = hash(str(self.server[0]) + str(self.server[1]) + str(req.mid))
-            self.received[key] = response
-            callback(req.mid, client_callback)
+            self._complete(entry[0], response)
+        elif key_token in self.relation:
+            self.handle_notification(response)
 
     def discover(self, client_callback, *args, **kwargs):
         req = Request()
@@ -258,29 +341,7 @@ class CoAP(DatagramProtocol):
         req.code = defines.inv_codes['GET']
         req.uri_path = ".well-known/core"
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.discover_results, client_callback)
-
-    def discover_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-        err_callback = None
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        elif isinstance(client_callback, tuple):
-            client_callback = client_callback[0]
-        if response is not None:
-            # self.parse_core_link_format(response.payload)
-            client_callback(response)
-        elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
+        return self.send_callback(req, self.results, client_callback)
 
     def get(self, client_callback, *args, **kwargs):
         # print "GET\n"
@@ -310,32 +371,67 @@ class CoAP(DatagramProtocol):
 
         req.code = defines.inv_codes['GET']
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.get_results, client_callback)
-
-    def get_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-
-        err_callback = None
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        elif isinstance(client_callback, tuple):
-            client_callback = client_callback[0]
-        if response is not None:
-            # self.parse_core_link_format(response.payload)
-            client_callback(response)
-        elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
+        return self.send_callback(req, self.results, client_callback)
 
     def observe(self, client_callback, *args, **kwargs):
+        """
+        Subscribe to a resource. The subscribers of the same resource with the same Accept share one observation with
+        the server: the notifications are passed to every client callback, a late subscriber gets the last one at once.
+
+        :param client_callback: the callback or a (callback, err_callback) tuple
+        :param args: the path or the request
+        :param kwargs: the Token, MID and Server of the request and its options
+        :return: a Deferred fired with the first response
+        """
+        req = self._observe_request(args, kwargs)
+        host, port = req.destination
+        key = (host, port, req.uri_path, req.accept)
+        d = defer.Deferred()
+        shared = self.shared.get(key)
+        if shared is None:
+            shared = SharedObservation(key, req)
+            shared.subscribers.append([client_callback, d])
+            self.shared[key] = shared
+            self._register(shared, req)
+        else:
+            shared.subscribers.append([client_callback, d])
+            if shared.response is not None:
+                self.results(shared.response, shared.request, client_callback)
+                d.callback(shared.response)
+        return d
+
+    def unobserve(self, client_callback, *args, **kwargs):
+        """
+        Unsubscribe from a resource, the observation with the server is cancelled when its last subscriber leaves.
+
+        :param client_callback: the callback given to observe
+        :param args: the path or the request given to observe
+        :param kwargs: the Server and the options given to observe
+        """
+        req = self._observe_request(args, kwargs)
+        host, port = req.destination
+        shared = self.shared.get((host, port, req.uri_path, req.accept))
+        if shared is None:
+            return
+        # equal, not identical: a bound method or a (callback, err_callback) tuple is a new object each time
+        shared.subscribers = [s for s in shared.subscribers if s[0] != client_callback]
+        if len(shared.subscribers) > 0:
+            return
+        self._forget(shared)
+        # deregistration (RFC 7641, 3.6)
+        deregister = self._copy(shared.request)
+        deregister.observe = 1
+        self.send_request(deregister)
+
+    def _observe_request(self, args, kwargs):
+        """
+        Build the registration request of an observation.
+
+        :param args: the path or the request
+        :param kwargs: the Token, MID and Server of the request and its options
+        :return: the request
+        """
+        kwargs = dict(kwargs)
         if isinstance(args[0], str):
             path = str(args[0])
             req = Request()
@@ -352,7 +448,6 @@ class CoAP(DatagramProtocol):
         else:
             req = args[0]
             assert(isinstance(req, Request))
-            path = req.uri_path
         for key in kwargs:
             try:
                 o = Option()
@@ -363,56 +458,178 @@ class CoAP(DatagramProtocol):
                 pass
 
         req.code = defines.inv_codes['GET']
-        req.uri_path = path
         req.observe = 0
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.observe_results, client_callback)
-
-    def observe_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-
+        if req.destination is None:
+            req.destination = self.server
+        if req.token is None:
+            req.token = "%08x" % random.getrandbits(32)
+        return req
+
+    @staticmethod
+    def _copy(request):
+        """
+        Copy a request with the same token and a new MID.
+
+        :param request: the request
+        :return: the copy
+        """
+        req = Request()
+        req.code = request.code
+        req.type = request.type
+        req.token = request.token
+        req.destination = request.destination
+        for option in request.options:
+            req.add_option(option)
+        return req
+
+    def _register(self, shared, req):
+        """
+        Send the registration of an observation.
+
+        :param shared: the observation
+        :param req: the registration request
+        """
+        d = self.send_request(req)
+        d.addCallback(self.observe_results, shared)
+
+    def _refresh(self, shared):
+        """
+        Register again an observation whose last notification is older than its Max-Age.
+
+        :param shared: the observation
+        """
+        shared.refresh = None
+        if self.shared.get(shared.key) is shared:
+            logger.debug("Observation of %s lapsed, registering again", shared.request.uri_path)
+            self._register(shared, self._copy(shared.request))
+
+    def _forget(self, shared):
+        """
+        Drop an observation, its following notifications are rejected.
+
+        :param shared: the observation
+        """
+        if self.shared.get(shared.key) is shared:
+            del self.shared[shared.key]
+        host, port = shared.request.destination
+        self.relation.pop(hash(str(host) + str(port) + str(shared.request.token)), None)
+        if shared.refresh is not None and shared.refresh.active():
+            shared.refresh.cancel()
+        shared.refresh = None
+
+    def results(self, response, req, client_callback):
+        """
+        Deliver the response of a request to the client callback.
+
+        :param response: the response, None if the request is rejected or timeouted
+        :param req: the request
+        :param client_callback: the callback or a (callback, err_callback) tuple
+        :return: the response
+        """
         err_callback = None
         if isinstance(client_callback, tuple) and len(client_callback) > 1:
             client_callback, err_callback = client_callback
         elif isinstance(client_callback, tuple):
             client_callback = client_callback[0]
         if response is not None:
-            if response.observe != 0:
-                # TODO add observing results
-                host, port = response.source
-                key = hash(str(host) + str(port) + str(response.token))
-                self.relation[key] = (response, time.time(), client_callback)
             client_callback(response)
         elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
-
-    def handle_notification(self, response, client_callback):
+            host, port = req.destination
+            err_callback(req.mid, host, port)
+        return response
+
+    def observe_results(self, response, shared):
+        """
+        Handle the response to the registration of an observation.
+
+        :param response: the response, None if the request is rejected or timeouted
+        :param shared: the observation
+        :return: the response
+        """
+        if self.shared.get(shared.key) is not shared:
+            # all the subscribers left in the meantime
+            return response
+        if response is None and shared.response is not None:
+            # the server did not answer the re-registration, it is tried again later
+            shared.refresh = reactor.callLater(self._max_age(shared.response), self._refresh, shared)
+            return response
+        if response is not None and response.observe is not None and \
+                response.code < defines.responses["BAD_REQUEST"]:
+            host, port = response.source
+            self.relation[hash(str(host) + str(port) + str(response.token))] = shared
+            shared.observe = None
+        self._deliver(shared, response)
+        return response
+
+    def handle_notification(self, response):
+        """
+        Pass a notification to the subscribers of its observation, unless an older one.
+
+        :param response: the notification
+        """
         host, port = response.source
-        key = hash(str(host) + str(port) + str(response.token))
-        self.relation[key] = (response, time.time(), client_callback)
-        if response.type == defines.inv_types["CON"]:
-            ack = Message.new_ack(response)
-            self.send(ack)
+        shared = self.relation[hash(str(host) + str(port) + str(response.token))]
+        if response.observe is not None and not fresh_notification(shared, response.observe, time.time()):
+            return
+        self._deliver(shared, response)
+
+    def _deliver(self, shared, response):
+        """
+        Pass a response to all the subscribers of an observation. A response without Observe, or an error, ends the
+        observation, otherwise it is registered again if no notification follows within the Max-Age.
+
+        :param shared: the observation
+        :param response: the response, None if the request is rejected or timeouted
+        """
+        if response is None or response.observe is None or response.code >= defines.responses["BAD_REQUEST"]:
+            self._forget(shared)
+        else:
+            if shared.observe is None:
+                shared.observe = response.observe
+                shared.observed = time.time()
+            shared.response = response
+            if shared.refresh is not None and shared.refresh.active():
+                shared.refresh.cancel()
+            shared.refresh = reactor.callLater(self._max_age(response) + defines.OBSERVE_REFRESH_MARGIN,
+                                               self._refresh, shared)
+        for client_callback, d in list(shared.subscribers):
+            self.results(response, shared.request, client_callback)
+            if not d.called:
+                d.callback(response)
+        self._check_done()
+
+    @staticmethod
+    def _max_age(response):
+        """
+        Get the Max-Age of a response, 60 seconds if not specified.
+
+        :param response: the response
+        :return: the Max-Age in seconds
+        """
+        for option in response.options:
+            if option.number == defines.inv_options["Max-Age"]:
+                return int(option.value)
+        return defines.options[defines.inv_options["Max-Age"]][3]
 
     def cancel_observing(self, response, send_rst):
+        """
+        Drop the observation a notification belongs to, for all its subscribers.
+
+        :param response: the notification
+        :param send_rst: True to reject the notification with a RST
+        """
         host, port = response.source
-        key = hash(str(host) + str(port) + str(response.token))
-        del self.relation[key]
+        shared = self.relation.get(hash(str(host) + str(port) + str(response.token)))
+        if shared is not None:
+            self._forget(shared)
         if send_rst:
             rst = Message.new_rst(response)
             self.send(rst)
+        self._check_done()
 
     def post(self, client_callback, *args, **kwargs):
-        if isinstance(args, tuple):
+        if isinstance(args[0], str):
             path, payload = args
             req = Request()
             req.uri_path = path
@@ -438,35 +655,14 @@ class CoAP(DatagramProtocol):
                 pass
         req.code = defines.inv_codes['POST']
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.post_results, client_callback)
-
-    def post_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-        err_callback = None
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        elif isinstance(client_callback, tuple):
-            client_callback = client_callback[0]
-        if response is not None:
-            # self.parse_core_link_format(response.payload)
-            client_callback(response)
-        elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
+        return self.send_callback(req, self.results, client_callback)
 
     def put(self, client_callback, *args, **kwargs):
-        if isinstance(args[0], tuple):
+        if isinstance(args[0], str):
             path, payload = args
             req = Request()
             req.uri_path = path
+            req._payload = payload
             if "Token" in kwargs.keys():
                 req.token = kwargs.get("Token")
                 del kwargs["Token"]
@@ -488,29 +684,7 @@ class CoAP(DatagramProtocol):
                 pass
         req.code = defines.inv_codes['PUT']
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.put_results, client_callback)
-
-    def put_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-        err_callback = None
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        elif isinstance(client_callback, tuple):
-            client_callback = client_callback[0]
-        if response is not None:
-            # self.parse_core_link_format(response.payload)
-            client_callback(response)
-        elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
+        return self.send_callback(req, self.results, client_callback)
 
     def delete(self, client_callback, *args, **kwargs):
         if isinstance(args[0], str):
@@ -538,69 +712,43 @@ class CoAP(DatagramProtocol):
                 pass
         req.code = defines.inv_codes['DELETE']
         req.type = defines.inv_types["CON"]
-        self.send_callback(req, self.delete_results, client_callback)
-
-    def delete_results(self, mid, client_callback):
-        key = hash(str(self.server[0]) + str(self.server[1]) + str(mid))
-        response = self.received.get(key)
-        if key in self.call_id.keys():
-            handler, retransmit_count = self.call_id.get(key)
-            if handler is not None:
-                try:
-                    log.msg("Cancel retrasmission")
-                    handler.cancel()
-                except AlreadyCancelled:
-                    pass
-        err_callback = None
-        if isinstance(client_callback, tuple) and len(client_callback) > 1:
-            client_callback, err_callback = client_callback
-        elif isinstance(client_callback, tuple):
-            client_callback = client_callback[0]
-        if response is not None:
-            # self.parse_core_link_format(response.payload)
-            client_callback(response)
-        elif err_callback is not None:
-            err_callback(mid, self.server[0], self.server[1])
+        return self.send_callback(req, self.results, client_callback)
 
-    def schedule_retrasmission(self, request, err_callback):
-        host, port = self.server
+    def schedule_retrasmission(self, request):
+        host, port = request.destination
         if request.type == defines.inv_types['CON']:
-            future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
+            future_time = self.endpoints.timeout((host, port))
             key = hash(str(host) + str(port) + str(request.mid))
             self.call_id[key] = (reactor.callLater(future_time, self.retransmit,
-                                                   (request, host, port, future_time, err_callback)), 0)
+                                                   (request, host, port, future_time)), 0)
 
     def retransmit(self, t):
-        log.msg("Retransmit")
-        request, host, port, future_time, err_callback = t
+        request, host, port, future_time = t
         key = hash(str(host) + str(port) + str(request.mid))
         call_id, retransmit_count = self.call_id[key]
         if retransmit_count < defines.MAX_RETRANSMIT and (not request.acknowledged and not request.rejected):
+            logger.debug("Retransmit %d to %s:%d", request.mid, host, port)
             retransmit_count += 1
-            req, timestamp, callback, client_callback = self.sent[key]
-            self.sent[key] = (request, time.time(), callback, client_callback)
+            self.endpoints.lost((host, port))
             self.send(request)
-            future_time *= 2
+            future_time = self.endpoints.backoff((host, port), future_time)
             self.call_id[key] = (reactor.callLater(future_time, self.retransmit,
-                                                   (request, host, port, future_time, err_callback)), retransmit_count)
+                                                   (request, host, port, future_time)), retransmit_count)
 
         elif request.acknowledged or request.rejected:
             request.timeouted = False
             del self.call_id[key]
         else:
             request.timeouted = True
-            log.err("Request timeouted")
+            logger.warning("Request %d to %s:%d timeouted", request.mid, host, port)
             del self.call_id[key]
-            if err_callback is not None:
-                err_callback(request.mid, host, port)
+            self._complete(request, None)
 
 
 class HelperClient(object):
-    def __init__(self, server=("bbbb::2", 5683), forward=False):
-        # print "INIT HELPER\n"
-        self.protocol = CoAP(server, forward)
+    def __init__(self, server=("bbbb::2", 5683), forward=False, max_in_flight=defines.NSTART, endpoints=None):
+        self.protocol = CoAP(server, forward, max_in_flight, endpoints)
         reactor.listenUDP(0, self.protocol)
-        #reactor.run()
 
     @property
     def starting_mid(self):
@@ -611,5 +759,4 @@ class HelperClient(object):
         self.protocol.current_mid = mid
 
     def start(self, operations):
-        # print "START HELPER\n"
         self.protocol.set_operations(operations)
\ No newline at end of file
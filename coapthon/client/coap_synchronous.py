@@ -1,231 +1,156 @@
+import Queue
+import logging
 import random
-import re
 import socket
-import threading
 import time
-from coapthon.messages.message import Message
+import concurrent.futures
 from coapthon.messages.response import Response
 from coapthon import defines
+from coapthon.client.multiplex import MultiplexClient
+from coapthon.endpoint import registry as shared_registry
 from coapthon.serializer import Serializer
 from coapthon.messages.request import Request
-# import logging as log
+from coapthon.utils import decode_missing_blocks, parse_blockwise, parse_uri
 
 __author__ = 'giacomo'
 
+logger = logging.getLogger(__name__)
+
+
+class BlockReader(object):
+    """
+    Reads the blocks of an upload from a file-like object or an iterator of strings, holding at most a block and the
+    beginning of the following one.
+    """
+    def __init__(self, source):
+        """
+        Initialize the reader.
+
+        :param source: the file-like object or iterator
+        """
+        self._read = getattr(source, "read", None)
+        self._iterator = iter(source) if self._read is None else None
+        self._buffer = ""
+        self._eof = False
+
+    def _fill(self, n):
+        """
+        Read until n bytes are buffered or the source ends.
+
+        :param n: the number of bytes
+        """
+        while len(self._buffer) < n and not self._eof:
+            if self._read is not None:
+                data = self._read(n - len(self._buffer))
+                if not data:
+                    self._eof = True
+            else:
+                data = next(self._iterator, None)
+                if data is None:
+                    self._eof = True
+            if data:
+                self._buffer += str(data)
+
+    def skip(self, n):
+        """
+        Skip the beginning of the body, e.g. the blocks already sent before an upload is resumed.
+
+        :param n: the number of bytes
+        """
+        while n > 0:
+            self._fill(min(n, defines.MAX_PAYLOAD))
+            if len(self._buffer) == 0:
+                return
+            skipped = min(n, len(self._buffer))
+            self._buffer = self._buffer[skipped:]
+            n -= skipped
+
+    def block(self, size):
+        """
+        Read the next block.
+
+        :param size: the block size
+        :return: the payload and True if other blocks follow
+        """
+        self._fill(size + 1)
+        payload = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return payload, len(self._buffer) > 0
+
 
 class HelperClientSynchronous(object):
-    def __init__(self, parent=None):
+    """
+    Blocking client. The requests are sent through a MultiplexClient, which can also be used directly to send
+    concurrent requests.
+    """
+    def __init__(self, parent=None, endpoints=None, cache=None):
         self._currentMID = 100
-        self.relation = {}
-        self.received = {}
-        self.sent = {}
-        self.sent_token = {}
-        self.received_token = {}
-        self.call_id = {}
-        self._response = None
-        self.condition = threading.Condition()
-        self._endpoint = None
-        self._socket = None
-        self._receiver_thread = None
-        self.stop = False
+        # RTT and loss statistics of the servers, shared by the clients of the process by default
+        self.endpoints = endpoints if endpoints is not None else shared_registry
+        # the ClientCache of the GET responses, None to send every request
+        self.cache = cache
+        self._client = None
+        # the notifications of the observation, received by the MultiplexClient
+        self._notifications = Queue.Queue()
         self.parent = parent
 
+    @property
+    def client(self):
+        """
+        Get the MultiplexClient sending the requests, created at the first request.
+
+        :return: the client
+        """
+        if self._client is None:
+            self._client = MultiplexClient(endpoints=self.endpoints, cache=self.cache)
+        return self._client
+
+    def close(self):
+        """
+        Close the socket of the client.
+        """
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
     @staticmethod
     def start(operations):
         # self.transport.connect(host, self.server[1])
         function, args, kwargs = operations[0]
         function(*args, **kwargs)
 
-    def send(self, request, endpoint, resend=False):
-
-        self._endpoint = endpoint
-        self._socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-        self._receiver_thread = threading.Thread(target=self.datagram_received)
-        self._receiver_thread.start()
-        if not resend:
-            if request.mid is None:
-                request.mid = self._currentMID
-                self._currentMID += 1
-            key = hash(str(self._endpoint[0]) + str(self._endpoint[1]) + str(request.mid))
-            key_token = hash(str(self._endpoint[0]) + str(self._endpoint[1]) + str(request.token))
-            self.sent[key] = (request, time.time())
-            self.sent[key_token] = request
-        if request.type is None:
-            request.type = defines.inv_types["CON"]
-        serializer = Serializer()
-        request.destination = self._endpoint
-        # host, port = request.destination
-        # print "Message sent to " + host + ":" + str(port)
-        # print "----------------------------------------"
-        # print request
-        # print "----------------------------------------"
-        datagram = serializer.serialize(request)
-        # log.info("Send datagram")
-        self._socket.sendto(datagram, self._endpoint)
-
-    def schedule_retrasmission(self, request):
-        host, port = self._endpoint
-        if request.type == defines.inv_types['CON']:
-            future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
-            key = hash(str(host) + str(port) + str(request.mid))
-            self.call_id[key] = (threading.Timer(future_time, self.retransmit, (request, host, port, future_time)), 0)
-
-    def retransmit(self, t):
-        # log.info("Retransmit")
-        request, host, port, future_time = t
-        key = hash(str(host) + str(port) + str(request.mid))
-        call_id, retransmit_count = self.call_id[key]
-        if retransmit_count < defines.MAX_RETRANSMIT and (not request.acknowledged and not request.rejected):
-            retransmit_count += 1
-            self.sent[key] = (request, time.time())
-            self.send(request, request.destination)
-            future_time *= 2
-            self.call_id[key] = (threading.Timer(future_time, self.retransmit,
-                                                 (request, host, port, future_time)), retransmit_count)
-
-        elif request.acknowledged or request.rejected:
-            request.timeouted = False
-            del self.call_id[key]
-        else:
-            request.timeouted = True
-            # log.error("Request timeouted")
-            del self.call_id[key]
-            # notify timeout
-            self.condition.acquire()
-            self.condition.notify()
-            self.condition.release()
-
-    def datagram_received(self):
-        # TODO mutex
-        self.stop = False
-        while not self.stop:
-            self._socket.settimeout(2 * defines.ACK_TIMEOUT)
-            try:
-                datagram, addr = self._socket.recvfrom(1152)
-            except socket.timeout, e:
-                err = e.args[0]
-                # this next if/else is a bit redundant, but illustrates how the
-                # timeout exception is setup
-                if err == 'timed out':
-                    print 'recv timed out, retry later'
-                    continue
-                else:
-                    print e
-                    return
-            except socket.error, e:
-                # Something else happened, handle error, exit, etc.
-                print e
-                return
-            else:
-                if len(datagram) == 0:
-                    print 'orderly shutdown on server end'
-                    return
+    @staticmethod
+    def _wait(future):
+        """
+        Wait for a response.
 
-            serializer = Serializer()
-            try:
-                host, port = addr
-            except ValueError:
-                host, port, tmp1, tmp2 = addr
-            message = serializer.deserialize(datagram, host, port)
-            # print "Message received from " + host + ":" + str(port)
-            # print "----------------------------------------"
-            # print message
-            # print "----------------------------------------"
-            if isinstance(message, Response):
-                self.handle_response(message)
-            elif isinstance(message, Request):
-                # log.error("Received request")
-                pass
-            else:
-                self.handle_message(message)
-            key = hash(str(host) + str(port) + str(message.mid))
-            if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-               and key in self.sent.keys():
-                # Separate Response
-                # handle separate
-                print "Separate Response"
-                self._response = message
-                self.condition.acquire()
-                self.condition.notify()
-                self.condition.release()
-            else:
-                # TODO handle notification
-                self._response = message
-                self.condition.acquire()
-                self.condition.notify()
-                self.condition.release()
-                if message.observe == 0:
-                    self._receiver_thread = None
-                    self.stop = True
-
-    def handle_response(self, response):
-        if response.type == defines.inv_types["CON"]:
-            ack = Message.new_ack(response)
-            self.send(ack, self._endpoint)
-        key_token = hash(str(self._endpoint[0]) + str(self._endpoint[1]) + str(response.token))
-        if key_token in self.sent_token.keys():
-            self.received_token[key_token] = response
-            req = self.sent_token[key_token]
-            key = hash(str(self._endpoint[0]) + str(self._endpoint[1]) + str(req.mid))
-            timer, counter = self.call_id[key]
-            timer.cancel()
-            self.received[key] = response
-            self.condition.acquire()
-            self._response = response
-            self.condition.notify()
-            self.condition.release()
-
-    def handle_message(self, message):
-        key = hash(str(self._endpoint[0]) + str(self._endpoint[1]) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-           and key in self.sent.keys():
+        :param future: the future of the response
+        :return: the response, None if the server does not answer
+        """
+        try:
+            return future.result()
+        except socket.timeout as e:
+            logger.warning("Give up on message: %s", e)
             return None
-        if key in self.sent.keys():
-            self.received[key] = message
-            if message.type == defines.inv_types["RST"]:
-                self._response = message
-            else:
-                # log.error("Received unattended message")
-                # handle error
-                self._response = "Received unattended message"
-            self.condition.acquire()
-            self.condition.notify()
-            self.condition.release()
-
-    def parse_path(self, path):
-        m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*):([0-9]*)/(\S*)", path)
-        if m is None:
-            m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*)/(\S*)", path)
-            if m is None:
-                m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*)", path)
-                if m is None:
-                    ip, port, path = self.parse_path_ipv6(path)
-                else:
-                    ip = m.group(2)
-                    port = 5683
-                    path = ""
-            else:
-                ip = m.group(2)
-                port = 5683
-                path = m.group(3)
-        else:
-            ip = m.group(2)
-            port = int(m.group(3))
-            path = m.group(4)
 
-        return ip, port, path
+    @staticmethod
+    def parse_path(path):
+        return parse_uri(path)
+
 
     def get(self, *args, **kwargs):
         """
+        GET a resource. A representation split in blocks is fetched transparently, unless the request asks for a
+        specific block.
 
         :param args: request object
-        :param kwargs: dictionary with parameters
+        :param kwargs: dictionary with parameters, window is the maximum number of blocks requested concurrently
+        :return: the response with the whole representation
         """
         if len(args) > 0:
             request = args[0]
             assert(isinstance(request, Request))
             endpoint = request.destination
-            ip, port = endpoint
         else:
             request = Request()
             path = kwargs['path']
@@ -235,83 +160,293 @@ class HelperClientSynchronous(object):
             request.uri_path = path
             endpoint = (ip, port)
         request.code = defines.inv_codes["GET"]
+        size = self.endpoints.block_size(endpoint)
+        follow = self._block2(request) is None
+        if follow:
+            # the size of the representation, to request the following blocks without overshooting the last one
+            request.size2 = 0
+        if size < defines.MAX_PAYLOAD and follow:
+            # ask for smaller blocks from the first one on a lossy link
+            request.add_block2(0, 0, size)
 
-        self.send(request, endpoint)
-        future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
-        retransmit_count = 0
-        self.condition.acquire()
-        while True:
-            self.condition.wait(timeout=future_time)
-            if self._response is not None:
-                break
-            if request.type == defines.inv_types['CON']:
-                if retransmit_count < defines.MAX_RETRANSMIT and (not request.acknowledged and not request.rejected):
-                    print("retransmit")
-                    retransmit_count += 1
-                    future_time *= 2
-                    self.send(request, endpoint)
-                else:
-                    print("Give up on message: " + str(request.mid))
-                    self.stop = True
-                    break
-        message = self._response
-        self._response = None
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
-            self._response = None
+        message = self._wait(self.client.send(request))
+        if follow and isinstance(message, Response) and message.code == defines.responses["CONTENT"]:
+            block2 = self._block2(message)
+            if block2 is not None and block2[1] == 1:
+                message = self._get_blocks(request, endpoint, kwargs.get("window", defines.NSTART), message)
+                if self.cache is not None and isinstance(message, Response):
+                    self.cache.store(request, message)
         return message
 
+    def get_stream(self, *args, **kwargs):
+        """
+        GET a resource split in blocks, yielding the payload of each block in order as soon as it is received.
+        Up to window blocks are requested concurrently, so at most window blocks are held in memory.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters, window is the maximum number of blocks requested concurrently,
+                       start the block to resume from, size the block size of start, progress a function called
+                       with the bytes received so far (start included) and the total size or None if unknown
+        :return: a generator of the payloads
+        :raise ValueError: if the server answers with an error or the representation changes during the transfer
+        :raise socket.timeout: if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["GET"], args, kwargs)
+        request.type = defines.inv_types["CON"]
+        request.size2 = 0
+        progress = kwargs.get("progress")
+        total = None
+        for response in self._blocks(request, endpoint, kwargs.get("window", defines.NSTART),
+                                     start=kwargs.get("start", 0), size=kwargs.get("size")):
+            if response.code != defines.responses["CONTENT"]:
+                raise ValueError("Block transfer failed: " + defines.inv_responses.get(response.code, str(response.code)))
+            payload = str(response.payload) if response.payload is not None else ""
+            if progress is not None:
+                if total is None:
+                    total = response.size2
+                block2 = self._block2(response)
+                progress((block2[0] * block2[2] if block2 is not None else 0) + len(payload), total)
+            yield payload
+
+    def download(self, sink, *args, **kwargs):
+        """
+        GET a resource split in blocks into a writable sink, e.g. a file, without holding the representation in
+        memory.
+
+        :param sink: the object whose write method receives the payloads in order
+        :param args: request object
+        :param kwargs: dictionary with parameters, as for get_stream
+        :return: the number of bytes written
+        :raise ValueError: if the server answers with an error or the representation changes during the transfer
+        :raise socket.timeout: if the server does not answer
+        """
+        written = 0
+        for payload in self.get_stream(*args, **kwargs):
+            sink.write(payload)
+            written += len(payload)
+        return written
+
+    def put_stream(self, source, *args, **kwargs):
+        """
+        PUT a body read from a file-like object or an iterator of strings, with Block1.
+
+        :param source: the file-like object or iterator
+        :param args: request object
+        :param kwargs: dictionary with parameters, as for _upload
+        :return: the response to the last block, or None if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["PUT"], args, kwargs)
+        return self._upload(request, endpoint, source, kwargs)
+
+    def post_stream(self, source, *args, **kwargs):
+        """
+        POST a body read from a file-like object or an iterator of strings, with Block1.
+
+        :param source: the file-like object or iterator
+        :param args: request object
+        :param kwargs: dictionary with parameters, as for _upload
+        :return: the response to the last block, or None if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["POST"], args, kwargs)
+        return self._upload(request, endpoint, source, kwargs)
+
+    def _upload(self, request, endpoint, source, kwargs):
+        """
+        Send a body block by block, each one after the 2.31 Continue of the previous one. Only the block being sent
+        and the beginning of the following one are held in memory.
+
+        :param request: the request
+        :param endpoint: the server
+        :param source: the file-like object or iterator of strings, positioned at the beginning of the body
+        :param kwargs: dictionary with parameters, size is the block size, start the block to resume from (with the
+                       token of the interrupted upload), length the size of the body sent as Size1, progress a
+                       function called with the bytes sent so far (start included) and the length
+        :return: the response to the last block, or None if the server does not answer
+        """
+        request.type = defines.inv_types["CON"]
+        if "token" in kwargs:
+            request.token = kwargs["token"]
+        size = kwargs.get("size", self.endpoints.block_size(endpoint))
+        num = kwargs.get("start", 0)
+        length = kwargs.get("length")
+        progress = kwargs.get("progress")
+        reader = BlockReader(source)
+        reader.skip(num * size)
+        sent = num * size
+        first = True
+        while True:
+            payload, more = reader.block(size)
+            block = Request()
+            block.code = request.code
+            block.type = request.type
+            block.token = request.token
+            block.destination = request.destination
+            for option in request.options:
+                if option.number not in (defines.inv_options["Block1"], defines.inv_options["Size1"]):
+                    block.add_option(option)
+            block.block1 = (num, 1 if more else 0, size)
+            if first and length is not None:
+                block.size1 = length
+            first = False
+            block.payload = payload
+            response = self._wait(self.client.send(block))
+            if not isinstance(response, Response):
+                return None
+            sent += len(payload)
+            if progress is not None:
+                progress(sent, length)
+            if response.code != defines.responses["CONTINUE"] or not more:
+                return response
+            block1 = response.block1
+            if block1 != 0 and block1[2] < size:
+                # the server asks for smaller blocks, the following ones are numbered accordingly
+                size = block1[2]
+                num = sent // size
+            else:
+                num += 1
+
+    def _get_blocks(self, request, endpoint, window, first):
+        """
+        Fetch the blocks following the first one and reassemble the representation. The transfer starts again if
+        the representation changes in the meantime.
+
+        :param request: the request
+        :param endpoint: the server
+        :param window: the maximum number of blocks requested concurrently
+        :param first: the response with the first block
+        :return: the response with the whole representation, or None if the server does not answer
+        """
+        for i in xrange(defines.MAX_RETRANSMIT + 1):
+            payload = []
+            response = None
+            try:
+                for message in self._blocks(request, endpoint, window, first):
+                    if message.code != defines.responses["CONTENT"]:
+                        return message
+                    if response is None:
+                        response = message
+                    payload.append(str(message.payload) if message.payload is not None else "")
+            except socket.error:
+                return None
+            except ValueError:
+                first = None
+                continue
+            response.del_option_name("Block2")
+            response.payload = "".join(payload)
+            return response
+        return None
+
+    def _blocks(self, request, endpoint, window, first=None, start=0, size=None):
+        """
+        Request the blocks of a Block2 transfer through the MultiplexClient, keeping up to window requests
+        outstanding once the first block has been received. The responses are reordered by block number and must
+        carry the ETag of the first block.
+
+        :param request: the request
+        :param endpoint: the server
+        :param window: the maximum number of outstanding requests
+        :param first: the response with the first block, None to request it
+        :param start: the block to start from
+        :param size: the block size of start, chosen from the statistics of the server by default
+        :return: a generator of the responses in block order, it stops after an error response
+        :raise ValueError: if the representation changes during the transfer
+        :raise socket.timeout: if a block is not received after MAX_RETRANSMIT retransmissions
+        :raise socket.error: if the server rejects a request with a RST
+        """
+        window = max(1, window)
+        skip = (defines.inv_options["Block2"], defines.inv_options["Q-Block1"], defines.inv_options["Q-Block2"])
+        start_size = size if size is not None else self.endpoints.block_size(endpoint)
+        size = None
+        etag = None
+        last = None
+        # block number -> future of the response
+        pending = {}
+        received = {}
+        # the next block to request and the next one to return
+        num = start
+        emit = start
+        message = first
+        while last is None or emit <= last:
+            if message is None:
+                while len(pending) < (window if size is not None else 1) and (last is None or num <= last):
+                    # the blocks share the token of the transfer, so the server serves them from the same snapshot
+                    block = Request()
+                    block.token = request.token
+                    block.code = request.code
+                    block.type = defines.inv_types["CON"]
+                    block.destination = request.destination
+                    for option in request.options:
+                        if option.number in skip or (num > start and option.number == defines.inv_options["Size2"]):
+                            continue
+                        block.add_option(option)
+                    block.add_block2(num, 0, size if size is not None else start_size)
+                    pending[num] = self.client.send(block)
+                    num += 1
+                done = concurrent.futures.wait(pending.values(), return_when=concurrent.futures.FIRST_COMPLETED)[0]
+                n = min(n for n, future in pending.iteritems() if future in done)
+                message = pending.pop(n).result()
+                if not isinstance(message, Response):
+                    raise socket.error("Block %d rejected by %s:%d" % ((n,) + endpoint))
+            if message.code == defines.responses["REQUEST_ENTITY_INCOMPLETE"]:
+                raise ValueError("Representation changed during the transfer")
+            block2 = self._block2(message)
+            if message.code != defines.responses["CONTENT"] or block2 is None:
+                # an error, or a representation not split in blocks
+                yield message
+                return
+            n, m, block_size = block2
+            tag = message.etag[0] if len(message.etag) > 0 else None
+            if size is None:
+                size = block_size
+                etag = tag
+                if message.size2 is not None:
+                    last = max(0, (message.size2 + size - 1) // size - 1)
+                # the server may answer with smaller blocks than requested
+                emit = n
+                num = max(num, n + 1)
+            elif tag != etag or block_size != size:
+                raise ValueError("Representation changed during the transfer")
+            if m == 0:
+                last = n if last is None else min(last, n)
+                for i in [i for i in pending if i > last]:
+                    del pending[i]
+            if n >= emit and n not in received:
+                received[n] = message
+            message = None
+            while emit in received:
+                yield received.pop(emit)
+                emit += 1
+
+    @staticmethod
+    def _block2(message):
+        """
+        Get the Block2 option of a message.
+
+        :return: the (num, m, size) tuple or None if the message has no Block2 option
+        """
+        for option in message.options:
+            if option.number == defines.inv_options["Block2"]:
+                return parse_blockwise(option.raw_value)
+        return None
+
     def observe(self, *args, **kwargs):
         """
+        Observe a resource, the response and the notifications are returned by notification().
 
         :param args: request object
         :param kwargs: dictionary with parameters
+        :return: the future of the first response
         """
-        if len(args) > 0:
-            request = args[0]
-            assert(isinstance(request, Request))
-            endpoint = request.destination
-        else:
-            request = Request()
-            path = kwargs['path']
-            assert(isinstance(path, str))
-            ip, port, path = self.parse_path(path)
-            request.destination = (ip, port)
-            request.uri_path = path
-            endpoint = (ip, port)
-        request.code = defines.inv_codes["GET"]
-        request.observe = 0
-        self.send(request, endpoint)
+        kwargs["callback"] = self._notifications.put
+        return self.client.observe(*args, **kwargs)
 
-    def notification(self,  *args, **kwargs):
-        if len(args) > 0:
-            request = args[0]
-            assert(isinstance(request, Request))
-            endpoint = request.destination
-            ip, port = endpoint
-        else:
-            request = Request()
-            path = kwargs['path']
-            assert(isinstance(path, str))
-            ip, port, path = self.parse_path(path)
-            endpoint = (ip, port)
-        self.condition.acquire()
-        self.condition.wait()
-        message = self._response
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.send(request, endpoint)
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
-        return message
+    def notification(self, *args, **kwargs):
+        """
+        Wait for the next notification of the observation.
+
+        :return: the notification
+        """
+        return self._notifications.get()
 
     def delete(self, *args, **kwargs):
         """
@@ -319,33 +454,7 @@ class HelperClientSynchronous(object):
         :param args: request object
         :param kwargs: dictionary with parameters
         """
-        if len(args) > 0:
-            request = args[0]
-            assert(isinstance(request, Request))
-            endpoint = request.destination
-            ip, port = endpoint
-        else:
-            request = Request()
-            path = kwargs['path']
-            assert(isinstance(path, str))
-            ip, port, path = self.parse_path(path)
-            request.destination = (ip, port)
-            request.uri_path = path
-            endpoint = (ip, port)
-        request.code = defines.inv_codes["DELETE"]
-        self.send(request, endpoint)
-        self.condition.acquire()
-        self.condition.wait()
-        message = self._response
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.send(request, endpoint)
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
-        return message
+        return self._wait(self.client.delete(*args, **kwargs))
 
     def post(self, *args, **kwargs):
         """
@@ -353,36 +462,7 @@ class HelperClientSynchronous(object):
         :param args: request object
         :param kwargs: dictionary with parameters
         """
-        if len(args) > 0:
-            request = args[0]
-            assert(isinstance(request, Request))
-            endpoint = request.destination
-            payload = request.payload
-            ip, port = endpoint
-        else:
-            request = Request()
-            path = kwargs['path']
-            payload = kwargs['payload']
-            assert(isinstance(path, str))
-            ip, port, path = self.parse_path(path)
-            request.destination = (ip, port)
-            request.uri_path = path
-            endpoint = (ip, port)
-        request.code = defines.inv_codes["POST"]
-        request.payload = payload
-        self.send(request, endpoint)
-        self.condition.acquire()
-        self.condition.wait()
-        message = self._response
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.send(request, endpoint)
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
-        return message
+        return self._wait(self.client.post(*args, **kwargs))
 
     def put(self, *args, **kwargs):
         """
@@ -390,36 +470,7 @@ class HelperClientSynchronous(object):
         :param args: request object
         :param kwargs: dictionary with parameters
         """
-        if len(args) > 0:
-            request = args[0]
-            assert(isinstance(request, Request))
-            endpoint = request.destination
-            ip, port = endpoint
-            payload = request.payload
-        else:
-            request = Request()
-            path = kwargs['path']
-            payload = kwargs['payload']
-            assert(isinstance(path, str))
-            ip, port, path = self.parse_path(path)
-            request.destination = (ip, port)
-            request.uri_path = path
-            endpoint = (ip, port)
-        request.code = defines.inv_codes["PUT"]
-        request.payload = payload
-        self.send(request, endpoint)
-        self.condition.acquire()
-        self.condition.wait()
-        message = self._response
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.send(request, endpoint)
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
-        return message
+        return self._wait(self.client.put(*args, **kwargs))
 
     def discover(self, *args, **kwargs):
         """
@@ -427,53 +478,259 @@ class HelperClientSynchronous(object):
         :param args: request object
         :param kwargs: dictionary with parameters
         """
+        return self._wait(self.client.discover(*args, **kwargs))
+
+    def get_qblock(self, *args, **kwargs):
+        """
+        GET a resource with Q-Block2 (RFC 9177). The server sends the blocks in bursts of MAX_PAYLOADS without
+        waiting for a request per block; the next burst is asked for as soon as one is complete and the missing
+        blocks are asked for after NON_RECEIVE_TIMEOUT.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters, size is the block size
+        :return: the response with the whole representation, or None if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["GET"], args, kwargs)
+        size = kwargs.get("size", self.endpoints.block_size(endpoint))
+        sock = self._qblock_socket(endpoint)
+        serializer = Serializer()
+        blocks = {}
+        last = None
+        first = None
+        etag = None
+        retries = 0
+        # the first block of the last burst asked for
+        asked = 0
+        self._qblock_send(sock, serializer, request, endpoint, [(0, 1, size)])
+        sent = time.time()
+        try:
+            while True:
+                try:
+                    message = self._qblock_receive(sock, serializer, request.token, defines.NON_RECEIVE_TIMEOUT)
+                except socket.timeout:
+                    retries += 1
+                    self.endpoints.lost(endpoint)
+                    if retries > defines.NON_MAX_RETRANSMIT:
+                        return None
+                    highest = max(blocks) if len(blocks) > 0 else -1
+                    missing = [(num, 0, size) for num in xrange(highest) if num not in blocks]
+                    missing = missing[:defines.MAX_PAYLOADS]
+                    if last is None:
+                        # and the blocks following the last one received
+                        missing.append((highest + 1, 1, size))
+                    self._qblock_send(sock, serializer, request, endpoint, missing)
+                    continue
+                if first is None:
+                    self.endpoints.rtt(endpoint, time.time() - sent if retries == 0 else None)
+                retries = 0
+                if len(message.q_block2) == 0:
+                    # not split in blocks, or an error
+                    return message
+                num, m, block_size = message.q_block2[0]
+                tag = message.etag[0] if len(message.etag) > 0 else None
+                if etag != tag:
+                    if etag is not None:
+                        # the representation changed, start again with the blocks of the new one
+                        blocks = {}
+                        last = None
+                        first = None
+                        asked = 0
+                    etag = tag
+                size = block_size
+                if num not in blocks:
+                    blocks[num] = str(message.payload) if message.payload is not None else ""
+                if first is None or num == 0:
+                    first = message
+                if m == 0:
+                    last = num
+                if last is not None and len(blocks) == last + 1:
+                    first.del_option_name("Q-Block2")
+                    first.payload = "".join(blocks[i] for i in xrange(last + 1))
+                    return first
+                # the blocks may be received in any order, e.g. the first one after the burst
+                end = (num // defines.MAX_PAYLOADS + 1) * defines.MAX_PAYLOADS
+                following = last is None or end <= last
+                if following and end > asked and all(i in blocks for i in xrange(end)):
+                    # a complete burst, ask for the next one without waiting for NON_TIMEOUT
+                    asked = end
+                    self._qblock_send(sock, serializer, request, endpoint, [(end, 1, size)])
+                elif m == 0 or num + 1 == end:
+                    # the end of a burst, ask for its missing blocks together with the next burst
+                    missing = [(i, 0, size) for i in xrange(min(end, num + 1)) if i not in blocks]
+                    missing = missing[:defines.MAX_PAYLOADS]
+                    if following and end > asked:
+                        asked = end
+                        missing.append((end, 1, size))
+                    if len(missing) > 0:
+                        self._qblock_send(sock, serializer, request, endpoint, missing)
+        finally:
+            sock.close()
+
+    def put_qblock(self, *args, **kwargs):
+        """
+        PUT a payload with Q-Block1 (RFC 9177).
+
+        :param args: request object
+        :param kwargs: dictionary with parameters, size is the block size
+        :return: the response, or None if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["PUT"], args, kwargs)
+        return self._qblock_upload(request, endpoint, kwargs)
+
+    def post_qblock(self, *args, **kwargs):
+        """
+        POST a payload with Q-Block1 (RFC 9177).
+
+        :param args: request object
+        :param kwargs: dictionary with parameters, size is the block size
+        :return: the response, or None if the server does not answer
+        """
+        request, endpoint = self._qblock_request(defines.inv_codes["POST"], args, kwargs)
+        return self._qblock_upload(request, endpoint, kwargs)
+
+    def _qblock_upload(self, request, endpoint, kwargs):
+        """
+        Send the blocks of a Q-Block1 request in bursts of MAX_PAYLOADS. The next burst is sent when the server
+        confirms the previous one with 2.31 or after NON_TIMEOUT, the missing blocks listed by a 4.08 response are
+        sent again.
+
+        :param request: the request, with the payload
+        :param endpoint: the server
+        :param kwargs: dictionary with parameters, size is the block size
+        :return: the response, or None if the server does not answer
+        """
+        size = kwargs.get("size", self.endpoints.block_size(endpoint))
+        body = str(request.payload) if request.payload is not None else ""
+        total = max(1, (len(body) + size - 1) // size)
+        sock = self._qblock_socket(endpoint)
+        serializer = Serializer()
+        num = 0
+        retries = 0
+
+        def send_block(i):
+            block = self._qblock_copy(request)
+            block.q_block1 = (i, 1 if i < total - 1 else 0, size)
+            if i == 0:
+                block.size1 = len(body)
+            block.payload = body[i * size:(i + 1) * size]
+            self._qblock_send_message(sock, serializer, block, endpoint)
+
+        try:
+            while True:
+                if num < total:
+                    end = min(total, num + defines.MAX_PAYLOADS)
+                    for i in xrange(num, end):
+                        send_block(i)
+                    num = end
+                timeout = defines.NON_TIMEOUT if num < total else defines.NON_RECEIVE_TIMEOUT + defines.NON_TIMEOUT
+                try:
+                    message = self._qblock_receive(sock, serializer, request.token, timeout)
+                except socket.timeout:
+                    if num < total:
+                        # go on with the next burst
+                        continue
+                    retries += 1
+                    self.endpoints.lost(endpoint)
+                    if retries > defines.NON_MAX_RETRANSMIT:
+                        return None
+                    # the server answers the last block or lists the missing ones
+                    send_block(total - 1)
+                    continue
+                retries = 0
+                if message.code == defines.responses["CONTINUE"]:
+                    continue
+                if message.code == defines.responses["REQUEST_ENTITY_INCOMPLETE"] and \
+                        message.content_type == defines.inv_content_types["application/missing-blocks+cbor-seq"]:
+                    for i in decode_missing_blocks(message.payload):
+                        if i < total:
+                            send_block(i)
+                    continue
+                return message
+        finally:
+            sock.close()
+
+    def _qblock_request(self, code, args, kwargs):
+        """
+        Build the request of a Q-Block transfer.
+
+        :param code: the method
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the request and the server
+        """
         if len(args) > 0:
             request = args[0]
             assert(isinstance(request, Request))
             endpoint = request.destination
-            ip, port = endpoint
         else:
             request = Request()
             path = kwargs['path']
             assert(isinstance(path, str))
             ip, port, path = self.parse_path(path)
             request.destination = (ip, port)
-            if path == "":
-                path = defines.DISCOVERY_URL
             request.uri_path = path
             endpoint = (ip, port)
-        request.code = defines.inv_codes["GET"]
-        self.send(request, endpoint)
-        self.condition.acquire()
-        self.condition.wait()
-        message = self._response
-        key = hash(str(ip) + str(port) + str(message.mid))
-        if message.type == defines.inv_types["ACK"] and message.code == defines.inv_codes["EMPTY"] \
-                and key in self.sent.keys():
-            # Separate Response
-            self.send(request, endpoint)
-            self.condition.acquire()
-            self.condition.wait()
-            message = self._response
+            if 'payload' in kwargs:
+                request.payload = kwargs['payload']
+        request.code = code
+        request.type = defines.inv_types["NON"]
+        if request.token is None:
+            request.token = "%08x" % random.getrandbits(32)
+        return request, endpoint
+
+    @staticmethod
+    def _qblock_socket(endpoint):
+        family = socket.getaddrinfo(endpoint[0], endpoint[1])[0][0]
+        return socket.socket(family, socket.SOCK_DGRAM)
+
+    def _qblock_copy(self, request):
+        """
+        Copy a request with a new MID and without the Q-Block options.
+
+        :param request: the request
+        :return: the copy
+        """
+        message = Request()
+        message.code = request.code
+        message.type = request.type
+        message.token = request.token
+        message.destination = request.destination
+        for option in request.options:
+            if option.number not in (defines.inv_options["Q-Block1"], defines.inv_options["Q-Block2"]):
+                message.add_option(option)
+        message.mid = self._currentMID % (1 << 16)
+        self._currentMID += 1
         return message
 
+    def _qblock_send(self, sock, serializer, request, endpoint, blocks):
+        """
+        Ask for blocks of a Q-Block2 response.
+
+        :param blocks: the list of (num, m, size)
+        """
+        message = self._qblock_copy(request)
+        for num, m, size in blocks:
+            message.add_q_block2(num, m, size)
+        self._qblock_send_message(sock, serializer, message, endpoint)
+
     @staticmethod
-    def parse_path_ipv6(path):
-        m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]:([0-9]*)/(\S*)", path)
-        if m is None:
-            m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]/(\S*)", path)
-            if m is None:
-                m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]", path)
-                ip = m.group(2)
-                port = 5683
-                path = ""
-            else:
-                ip = m.group(2)
-                port = 5683
-                path = m.group(3)
-        else:
-            ip = m.group(2)
-            port = int(m.group(3))
-            path = m.group(4)
+    def _qblock_send_message(sock, serializer, message, endpoint):
+        sock.sendto(serializer.serialize(message), endpoint)
+
+    @staticmethod
+    def _qblock_receive(sock, serializer, token, timeout):
+        """
+        Receive the next response of a Q-Block transfer.
 
-        return ip, port, path
+        :param token: the token of the transfer
+        :param timeout: seconds to wait
+        :return: the response
+        :raise socket.timeout: if no response is received
+        """
+        deadline = time.time() + timeout
+        while True:
+            sock.settimeout(max(deadline - time.time(), 0.001))
+            datagram, addr = sock.recvfrom(4096)
+            message = serializer.deserialize(datagram, addr[0], addr[1])
+            if isinstance(message, Response) and message.token == token:
+                return message
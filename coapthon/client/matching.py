@@ -0,0 +1,41 @@
+from coapthon import defines
+from coapthon.messages.message import Message
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+def reply(response, matched):
+    """
+    Choose the empty message answering a response received by a client: a notification matching no request or
+    observation is rejected with a RST (RFC 7641, 3.6), a CON response is acknowledged, duplicates included since
+    the ACK may have been lost.
+
+    :param response: the response
+    :param matched: True if the response matches a request or an observation
+    :return: the RST or the ACK, None if no answer is due
+    """
+    if not matched and response.observe is not None:
+        return Message.new_rst(response)
+    if response.type == defines.inv_types["CON"]:
+        return Message.new_ack(response)
+    return None
+
+
+def fresh_notification(observation, observe, now):
+    """
+    Check that a notification is newer than the last one received for an observation (RFC 7641, 3.4), and record
+    it as the last one if so.
+
+    :param observation: the observation, with the observe and observed attributes of the last notification
+    :param observe: the Observe number of the notification
+    :param now: the time of reception in seconds
+    :return: True if the notification must be delivered
+    """
+    last = observation.observe
+    if last is None or (last < observe < last + (1 << 23)) or (observe < last and last - observe > (1 << 23)) \
+            or now > observation.observed + 128:
+        observation.observe = observe
+        observation.observed = now
+        return True
+    return False
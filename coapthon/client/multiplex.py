@@ -0,0 +1,443 @@
+import heapq
+import logging
+import random
+import socket
+import threading
+import time
+import concurrent.futures
+from coapthon import defines
+from coapthon.endpoint import registry as shared_registry
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+from coapthon.client.matching import fresh_notification, reply
+from coapthon.utils import parse_uri
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+logger = logging.getLogger(__name__)
+
+
+class Exchange(object):
+    """
+    A request waiting for its response, or an observation receiving notifications.
+    """
+    __slots__ = ("request", "endpoint", "address", "datagram", "future", "callback", "timeout", "retransmissions",
+                 "sent", "deadline", "acknowledged", "observe", "observed")
+
+    def __init__(self, request, endpoint, address, datagram, callback):
+        """
+        Initialize an exchange.
+
+        :param request: the request
+        :param endpoint: the (host, port) of the server
+        :param address: the socket address of the server
+        :param datagram: the encoded request
+        :param callback: the function called with each notification, None if the request does not observe
+        """
+        self.request = request
+        self.endpoint = endpoint
+        self.address = address
+        self.datagram = datagram
+        self.future = concurrent.futures.Future()
+        self.callback = callback
+        # the timeout of the last transmission, chosen from the RTO of the server
+        self.timeout = None
+        self.retransmissions = 0
+        self.sent = time.time()
+        # time of the next retransmission or of the give up, None once the response is received
+        self.deadline = None
+        # the server has acknowledged the request, the response is separate
+        self.acknowledged = False
+        # Observe number and time of the last notification, to discard the ones received out of order
+        self.observe = None
+        self.observed = None
+
+
+class MultiplexClient(object):
+    """
+    A CoAP client sending any number of concurrent requests to any number of servers through a single socket. One
+    thread receives the responses, matches them with the requests by token and the ACKs and RSTs by MID, and
+    retransmits the CON requests. Each request returns a future of its response.
+
+    The callbacks of the futures and of the observations are run by the receiving thread and must not block.
+    """
+    def __init__(self, endpoints=None, bind=None, cache=None):
+        """
+        Initialize the client and start the receiving thread.
+
+        :param endpoints: the EndpointRegistry updated with the RTT and losses of the servers, the registry shared by
+                          the clients of the process by default
+        :param bind: the local (host, port), any address and port by default
+        :param cache: the ClientCache serving the GET requests, None to send every request
+        """
+        self.endpoints = endpoints if endpoints is not None else shared_registry
+        self.cache = cache
+        self._socket = None
+        try:
+            # IPv6 socket reaching the IPv4 servers as well through mapped addresses
+            self._socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self._socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            self._socket.bind(bind if bind is not None else ("::", 0))
+            self._family = socket.AF_INET6
+        except (socket.error, AttributeError):
+            if self._socket is not None:
+                self._socket.close()
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.bind(bind if bind is not None else ("0.0.0.0", 0))
+            self._family = socket.AF_INET
+        self._lock = threading.Lock()
+        self._current_mid = random.randint(1, 1 << 16)
+        # (host, port, token) -> Exchange, the last one sent if requests share a token, e.g. the blocks of a transfer
+        self._tokens = {}
+        # (host, port, mid) -> Exchange, while the request may be retransmitted
+        self._mids = {}
+        # (deadline, counter, exchange), an entry is stale if the deadline of the exchange has changed
+        self._timers = []
+        self._counter = 0
+        # (host, port) -> (endpoint, socket address)
+        self._addresses = {}
+        self._stopped = False
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, request, callback=None):
+        """
+        Send a request. Requests outstanding at once may share a token if their responses are piggy-backed, e.g. the
+        blocks of a Block2 transfer.
+
+        :param request: the request, with its destination
+        :param callback: the function called with each notification if the request observes the resource
+        :return: the future of the response, it raises socket.timeout if the server does not answer
+        """
+        endpoint, address = self._resolve(request.destination)
+        if self.cache is not None and callback is None:
+            request.destination = endpoint
+            response = self.cache.lookup(request)
+            if response is not None:
+                future = concurrent.futures.Future()
+                future.set_result(response)
+                return future
+        if request.type is None:
+            request.type = defines.inv_types["CON"]
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Client closed")
+            if request.token is None:
+                request.token = "%08x" % random.getrandbits(32)
+                while endpoint + (request.token,) in self._tokens:
+                    request.token = "%08x" % random.getrandbits(32)
+            if request.mid is None:
+                request.mid = self._current_mid % (1 << 16)
+                self._current_mid += 1
+            request.destination = endpoint
+            exchange = Exchange(request, endpoint, address, Serializer().serialize(request).raw, callback)
+            exchange.timeout = self.endpoints.timeout(endpoint)
+            self._tokens[endpoint + (request.token,)] = exchange
+            self._mids[endpoint + (request.mid,)] = exchange
+            if request.type == defines.inv_types["CON"]:
+                self._schedule(exchange, exchange.sent + exchange.timeout)
+            else:
+                # no retransmission, the response may still come within MAX_TRANSMIT_SPAN
+                exchange.retransmissions = defines.MAX_RETRANSMIT
+                self._schedule(exchange, exchange.sent + defines.MAX_TRANSMIT_SPAN)
+        self._socket.sendto(exchange.datagram, address)
+        return exchange.future
+
+    def get(self, *args, **kwargs):
+        """
+        GET a resource.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["GET"], args, kwargs))
+
+    def put(self, *args, **kwargs):
+        """
+        PUT a resource.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["PUT"], args, kwargs))
+
+    def post(self, *args, **kwargs):
+        """
+        POST to a resource.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["POST"], args, kwargs))
+
+    def delete(self, *args, **kwargs):
+        """
+        DELETE a resource.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the future of the response
+        """
+        return self.send(self._request(defines.inv_codes["DELETE"], args, kwargs))
+
+    def discover(self, *args, **kwargs):
+        """
+        GET the resources of a server, /.well-known/core if the path is empty.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters
+        :return: the future of the response
+        """
+        request = self._request(defines.inv_codes["GET"], args, kwargs)
+        if request.uri_path == "":
+            request.uri_path = defines.DISCOVERY_URL
+        return self.send(request)
+
+    def observe(self, *args, **kwargs):
+        """
+        Observe a resource. The notifications, the first response included, are passed to the callback given in the
+        parameters until cancel_observing is called or the server ends the observation.
+
+        :param args: request object
+        :param kwargs: dictionary with parameters, callback is the function called with each notification
+        :return: the future of the first response
+        """
+        request = self._request(defines.inv_codes["GET"], args, kwargs)
+        request.observe = 0
+        return self.send(request, kwargs["callback"])
+
+    def cancel_observing(self, request):
+        """
+        Forget an observation, the following notifications are rejected with a RST.
+
+        :param request: the request of the observation
+        """
+        host, port = request.destination
+        with self._lock:
+            exchange = self._tokens.pop((host, port, request.token), None)
+            if exchange is not None:
+                self._mids.pop((host, port, request.mid), None)
+                exchange.deadline = None
+
+    def close(self):
+        """
+        Stop the client, the pending requests fail.
+        """
+        with self._lock:
+            self._stopped = True
+            # the requests sharing a token with a later one are only found by MID
+            exchanges = set(self._tokens.values()) | set(self._mids.values())
+            self._tokens.clear()
+            self._mids.clear()
+            self._timers = []
+        for exchange in exchanges:
+            if not exchange.future.done():
+                exchange.future.set_exception(RuntimeError("Client closed"))
+        self._thread.join(timeout=2)
+        self._socket.close()
+
+    @staticmethod
+    def _request(code, args, kwargs):
+        """
+        Build a request from a request object or a path.
+
+        :param code: the method
+        :param args: request object
+        :param kwargs: dictionary with parameters, path and payload
+        :return: the request
+        """
+        if len(args) > 0:
+            request = args[0]
+            assert(isinstance(request, Request))
+        else:
+            request = Request()
+            path = kwargs['path']
+            assert(isinstance(path, str))
+            ip, port, path = parse_uri(path)
+            request.destination = (ip, port)
+            if path != "":
+                request.uri_path = path
+            if 'payload' in kwargs:
+                request.payload = kwargs['payload']
+        request.code = code
+        return request
+
+    def _resolve(self, destination):
+        """
+        Resolve the address of a server.
+
+        :param destination: the (host, port) of the server
+        :return: the (host, port) with the numeric host and the socket address
+        """
+        resolved = self._addresses.get(destination)
+        if resolved is None:
+            host, port = destination
+            family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+            endpoint = (sockaddr[0], sockaddr[1])
+            if family == socket.AF_INET and self._family == socket.AF_INET6:
+                address = ("::ffff:" + sockaddr[0], sockaddr[1])
+            else:
+                address = sockaddr
+            resolved = (endpoint, address)
+            self._addresses[destination] = resolved
+        return resolved
+
+    def _schedule(self, exchange, deadline):
+        """
+        Set the time of the next retransmission or of the give up of an exchange.
+
+        :param exchange: the exchange
+        :param deadline: the time
+        """
+        exchange.deadline = deadline
+        self._counter += 1
+        heapq.heappush(self._timers, (deadline, self._counter, exchange))
+
+    def _receive(self):
+        """
+        Receive the datagrams and handle the expired exchanges, until the client is closed.
+        """
+        serializer = Serializer()
+        while not self._stopped:
+            with self._lock:
+                due = self._timers[0][0] if len(self._timers) > 0 else None
+            timeout = 1.0 if due is None else min(max(due - time.time(), 0.001), 1.0)
+            try:
+                self._socket.settimeout(timeout)
+                datagram, addr = self._socket.recvfrom(65535)
+            except socket.timeout:
+                datagram = None
+            except socket.error:
+                if self._stopped:
+                    return
+                continue
+            if datagram is not None:
+                host = addr[0]
+                if host.startswith("::ffff:") and "." in host:
+                    host = host[7:]
+                try:
+                    message = serializer.deserialize(datagram, host, addr[1])
+                except (ValueError, AttributeError, TypeError):
+                    message = None
+                if isinstance(message, Response):
+                    self._handle_response(message, addr)
+                elif isinstance(message, Message) and not isinstance(message, Request):
+                    self._handle_message(message)
+            self._expire()
+
+    def _handle_response(self, response, addr):
+        """
+        Match a response with its request: a piggy-backed response by MID and token, so the requests outstanding at
+        once may share a token, a separate response or a notification by token. The CON responses are acknowledged,
+        the notifications of unknown observations are rejected.
+
+        :param response: the response
+        :param addr: the socket address of the server
+        """
+        host, port = response.source
+        now = time.time()
+        with self._lock:
+            key = (host, port, response.token)
+            if response.type == defines.inv_types["ACK"]:
+                exchange = self._mids.get((host, port, response.mid))
+                if exchange is not None and exchange.request.token != response.token:
+                    exchange = None
+            else:
+                exchange = self._tokens.get(key)
+            if exchange is not None and (exchange.callback is None or response.observe is None):
+                # the last response of the exchange
+                if self._tokens.get(key) is exchange:
+                    del self._tokens[key]
+            if exchange is not None:
+                self._mids.pop((host, port, exchange.request.mid), None)
+                first = exchange.deadline is not None
+                exchange.deadline = None
+            # a duplicate of a piggy-backed response may belong to an observation still going on
+            matched = exchange is not None or key in self._tokens
+        message = reply(response, matched)
+        if message is not None:
+            self._socket.sendto(Serializer().serialize(message).raw, addr)
+        if exchange is None:
+            return
+        if first and not exchange.acknowledged:
+            # a retransmitted request gives a weak RTT sample
+            self.endpoints.rtt(exchange.endpoint, now - exchange.sent, exchange.retransmissions)
+        if exchange.callback is not None and \
+                (response.observe is None or fresh_notification(exchange, response.observe, now)):
+            # without Observe, the last one: the server refused or ended the observation
+            try:
+                exchange.callback(response)
+            except Exception:
+                # the receiving thread serves every exchange of the socket, it must not die with a callback
+                logger.exception("Notification callback failed")
+        if not exchange.future.done():
+            if self.cache is not None and exchange.callback is None:
+                response = self.cache.update(exchange.request, response)
+            exchange.future.set_result(response)
+
+    def _handle_message(self, message):
+        """
+        Handle an empty ACK, the response will be separate, or a RST, the request is rejected.
+
+        :param message: the message
+        """
+        host, port = message.source
+        with self._lock:
+            exchange = self._mids.get((host, port, message.mid))
+            if exchange is None:
+                return
+            if message.type == defines.inv_types["ACK"]:
+                if not exchange.acknowledged and exchange.deadline is not None:
+                    self.endpoints.rtt(exchange.endpoint, time.time() - exchange.sent, exchange.retransmissions)
+                exchange.acknowledged = True
+                # wait for the separate response without retransmitting
+                self._schedule(exchange, time.time() + defines.EXCHANGE_LIFETIME)
+                return
+            if message.type != defines.inv_types["RST"]:
+                return
+            del self._mids[(host, port, message.mid)]
+            if self._tokens.get((host, port, exchange.request.token)) is exchange:
+                del self._tokens[(host, port, exchange.request.token)]
+            exchange.deadline = None
+        if not exchange.future.done():
+            exchange.future.set_result(message)
+
+    def _expire(self):
+        """
+        Retransmit the CON requests not acknowledged in time, give up after MAX_RETRANSMIT retransmissions.
+        """
+        now = time.time()
+        retransmit = []
+        expired = []
+        with self._lock:
+            while len(self._timers) > 0 and self._timers[0][0] <= now:
+                deadline, counter, exchange = heapq.heappop(self._timers)
+                if exchange.deadline != deadline:
+                    continue
+                host, port = exchange.endpoint
+                if exchange.acknowledged or exchange.retransmissions >= defines.MAX_RETRANSMIT:
+                    exchange.deadline = None
+                    if self._tokens.get((host, port, exchange.request.token)) is exchange:
+                        del self._tokens[(host, port, exchange.request.token)]
+                    self._mids.pop((host, port, exchange.request.mid), None)
+                    expired.append(exchange)
+                    continue
+                exchange.retransmissions += 1
+                exchange.timeout = self.endpoints.backoff(exchange.endpoint, exchange.timeout)
+                self._schedule(exchange, now + exchange.timeout)
+                retransmit.append(exchange)
+        for exchange in retransmit:
+            self.endpoints.lost(exchange.endpoint)
+            self._socket.sendto(exchange.datagram, exchange.address)
+        for exchange in expired:
+            if exchange.retransmissions > 0 and not exchange.acknowledged:
+                self.endpoints.lost(exchange.endpoint)
+            if not exchange.future.done():
+                exchange.future.set_exception(socket.timeout("No response from %s:%d" % exchange.endpoint))
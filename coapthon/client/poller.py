@@ -0,0 +1,259 @@
+import collections
+import functools
+import heapq
+import random
+import socket
+import threading
+import time
+from coapthon import defines
+from coapthon.client.multiplex import MultiplexClient
+from coapthon.messages.request import Request
+from coapthon.utils import parse_uri
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class PolledDevice(object):
+    """
+    A device polled by a Poller: its outstanding requests and its backoff while it does not answer.
+    """
+    __slots__ = ("endpoint", "in_flight", "waiting", "failures", "backoff_until")
+
+    def __init__(self, endpoint):
+        """
+        Initialize a device.
+
+        :param endpoint: the (host, port) of the device
+        """
+        self.endpoint = endpoint
+        self.in_flight = 0
+        # targets due while NSTART requests to the device were outstanding
+        self.waiting = collections.deque()
+        # consecutive polls without answer, and the time before which the device is not polled
+        self.failures = 0
+        self.backoff_until = 0
+
+
+class PollTarget(object):
+    """
+    A resource polled periodically.
+    """
+    __slots__ = ("uri", "device", "path", "interval", "due", "removed")
+
+    def __init__(self, uri, device, path, interval, due):
+        """
+        Initialize a target.
+
+        :param uri: the URI of the resource
+        :param device: the PolledDevice
+        :param path: the path of the resource
+        :param interval: the seconds between two polls
+        :param due: the time of the next poll
+        """
+        self.uri = uri
+        self.device = device
+        self.path = path
+        self.interval = interval
+        self.due = due
+        self.removed = False
+
+
+class Poller(object):
+    """
+    Polls the resources of many devices through a single MultiplexClient. The first poll of each resource is placed
+    at a random point of its interval, so that the requests are spread evenly over time. At most nstart requests are
+    outstanding to each device and at most rate requests per second are sent overall. A device that does not answer
+    is left alone for an exponentially growing time, up to POLL_MAX_BACKOFF.
+
+    The results are passed to the callback, or put in the queue, as (target, response) tuples, the response being
+    None if the device does not answer. The callback is run by the receiving thread of the client and must not block.
+    """
+    def __init__(self, client=None, rate=None, nstart=None, callback=None, queue=None):
+        """
+        Initialize the poller and start its scheduling thread.
+
+        :param client: the MultiplexClient sending the requests, a new one by default
+        :param rate: the maximum number of requests per second, POLL_MAX_RATE by default
+        :param nstart: the maximum number of outstanding requests to a device, NSTART by default
+        :param callback: the function called with each (target, response)
+        :param queue: the queue receiving each (target, response)
+        """
+        self._own_client = client is None
+        self.client = client if client is not None else MultiplexClient()
+        self.rate = rate if rate is not None else defines.POLL_MAX_RATE
+        self.nstart = nstart if nstart is not None else defines.NSTART
+        self.callback = callback
+        self.queue = queue
+        self._condition = threading.Condition()
+        # (due, counter, target)
+        self._timers = []
+        self._counter = 0
+        # (host, port) -> PolledDevice
+        self._devices = {}
+        # earliest time of the next request allowed by the rate
+        self._next_send = 0
+        self._stopped = False
+        self._started = time.time()
+        self.sent = 0
+        self.received = 0
+        self.failed = 0
+        # seconds between the scheduled time of a poll and its request: smoothed and maximum
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._thread = threading.Thread(target=self._schedule)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, uri, interval):
+        """
+        Poll a resource periodically.
+
+        :param uri: the coap:// URI of the resource
+        :param interval: the seconds between two polls
+        :return: the PollTarget
+        """
+        host, port, path = parse_uri(uri)
+        with self._condition:
+            device = self._devices.get((host, port))
+            if device is None:
+                device = PolledDevice((host, port))
+                self._devices[(host, port)] = device
+            target = PollTarget(uri, device, path, interval, time.time() + random.uniform(0, interval))
+            self._push(target)
+            self._condition.notify()
+        return target
+
+    def remove(self, target):
+        """
+        Stop polling a resource.
+
+        :param target: the PollTarget
+        """
+        with self._condition:
+            target.removed = True
+
+    def stats(self):
+        """
+        Get the metrics of the poller.
+
+        :return: a dictionary with sent, received, failed, in_flight, waiting, backing_off, throughput (responses
+                 per second), lag and max_lag (seconds)
+        """
+        with self._condition:
+            now = time.time()
+            devices = self._devices.values()
+            return {"sent": self.sent, "received": self.received, "failed": self.failed,
+                    "in_flight": sum(device.in_flight for device in devices),
+                    "waiting": sum(len(device.waiting) for device in devices),
+                    "backing_off": sum(1 for device in devices if device.backoff_until > now),
+                    "throughput": self.received / max(now - self._started, 0.001),
+                    "lag": self.lag, "max_lag": self.max_lag}
+
+    def close(self):
+        """
+        Stop polling, the client is closed if it has been created by the poller.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout=2)
+        if self._own_client:
+            self.client.close()
+
+    def _push(self, target):
+        """
+        Schedule the next poll of a target.
+
+        :param target: the target
+        """
+        self._counter += 1
+        heapq.heappush(self._timers, (target.due, self._counter, target))
+
+    def _schedule(self):
+        """
+        Send the polls when they are due, within the rate and the NSTART of each device, until the poller is closed.
+        """
+        while True:
+            with self._condition:
+                target = None
+                while not self._stopped:
+                    now = time.time()
+                    if len(self._timers) > 0:
+                        ready = max(self._timers[0][0], self._next_send)
+                        if ready <= now:
+                            due, counter, target = heapq.heappop(self._timers)
+                            break
+                        self._condition.wait(min(ready - now, 1.0))
+                    else:
+                        self._condition.wait(1.0)
+                if self._stopped:
+                    return
+                if target.removed or target.due != due:
+                    continue
+                device = target.device
+                if device.backoff_until > now:
+                    target.due = device.backoff_until
+                    self._push(target)
+                    continue
+                if device.in_flight >= self.nstart:
+                    device.waiting.append(target)
+                    continue
+                device.in_flight += 1
+                lag = now - due
+                self.lag = (1 - defines.ENDPOINT_ALPHA) * self.lag + defines.ENDPOINT_ALPHA * lag
+                self.max_lag = max(self.max_lag, lag)
+                self.sent += 1
+                self._next_send = max(self._next_send, now - 1.0 / self.rate) + 1.0 / self.rate
+                # the next poll keeps the cadence, the missed ones are skipped
+                target.due = due + target.interval
+                if target.due <= now:
+                    target.due += ((now - target.due) // target.interval + 1) * target.interval
+                self._push(target)
+            request = Request()
+            request.code = defines.inv_codes["GET"]
+            request.destination = device.endpoint
+            if target.path != "":
+                request.uri_path = target.path
+            try:
+                future = self.client.send(request)
+            except (socket.error, RuntimeError):
+                self._done(target, None)
+                continue
+            future.add_done_callback(functools.partial(self._done, target))
+
+    def _done(self, target, future):
+        """
+        Handle the end of a poll: free the slot of the device, update its backoff and deliver the result.
+
+        :param target: the target
+        :param future: the future of the response, None if the request could not be sent
+        """
+        try:
+            response = future.result() if future is not None else None
+        except (socket.timeout, RuntimeError):
+            response = None
+        with self._condition:
+            device = target.device
+            device.in_flight -= 1
+            now = time.time()
+            if response is None:
+                self.failed += 1
+                device.failures += 1
+                backoff = min(target.interval * (1 << min(device.failures - 1, 16)), defines.POLL_MAX_BACKOFF)
+                device.backoff_until = now + backoff
+            else:
+                self.received += 1
+                device.failures = 0
+                device.backoff_until = 0
+            if len(device.waiting) > 0:
+                waiting = device.waiting.popleft()
+                waiting.due = min(waiting.due, now)
+                self._push(waiting)
+                self._condition.notify()
+        if target.removed:
+            return
+        if self.callback is not None:
+            self.callback(target, response)
+        if self.queue is not None:
+            self.queue.put((target, response))
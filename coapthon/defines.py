@@ -27,6 +27,84 @@ ALL_COAP_NODES = "224.0.1.187"
 
 MAX_PAYLOAD = 1024
 
+# maximum number of outstanding requests to a server (RFC 7252), e.g. the blocks of a Block2 transfer
+NSTART = 1
+
+# maximum number of blockwise transfers kept by the server, the least recently used are dropped
+MAX_BLOCKWISE_SESSIONS = 1000
+
+# seconds after which an idle blockwise transfer is dropped
+BLOCKWISE_SESSION_LIFETIME = EXCHANGE_LIFETIME
+
+# maximum size of a body uploaded with Block1
+MAX_UPLOAD_SIZE = 1048576
+
+# bodies larger than this are reassembled in a temporary file
+UPLOAD_SPILL_THRESHOLD = 65536
+
+# maximum memory used by the bodies reassembled in memory
+UPLOAD_MEMORY_LIMIT = 4194304
+
+# maximum number of concrete paths of a template resource whose ETags and Observe counter are kept
+MAX_TEMPLATE_STATES = 10000
+
+# maximum number of endpoints whose RTT and loss statistics are kept
+MAX_ENDPOINTS = 1000
+
+# smoothing factors of the RTT and loss estimates of an endpoint (RFC 6298)
+ENDPOINT_ALPHA = 0.125
+ENDPOINT_BETA = 0.25
+
+# CoCoA: bounds of the retransmission timeout of an endpoint, ACK_TIMEOUT until the first RTT sample
+RTO_MIN = 0.1
+RTO_MAX = 60
+
+# CoCoA: weight of a new strong (not retransmitted) and weak (retransmitted once or twice) estimate in the RTO
+RTO_STRONG_WEIGHT = 0.5
+RTO_WEAK_WEIGHT = 0.25
+
+# transmissions observed before the block size of an endpoint is adapted
+BLOCK_SIZE_MIN_SAMPLES = 8
+
+# (loss rate, block size): the block size of the first entry whose loss rate is above the loss of the endpoint
+BLOCK_SIZE_BY_LOSS = ((0.05, 1024), (0.15, 512), (1.0, 256))
+
+# RTT in seconds (SRTT + 4 * RTTVAR) below which an endpoint is on a LAN, where a lost block is quickly retransmitted
+BLOCK_SIZE_LAN_RTT = 0.05
+
+# BLOCK_SIZE_BY_LOSS of the endpoints on a LAN
+BLOCK_SIZE_BY_LOSS_LAN = ((0.3, 1024), (0.5, 512), (1.0, 256))
+
+# Q-Block (RFC 9177): blocks sent in a burst before waiting for the client
+MAX_PAYLOADS = 10
+
+# Q-Block: seconds waited after a burst before sending the next one
+NON_TIMEOUT = 2
+
+# Q-Block: seconds without blocks after which the missing ones are requested
+NON_RECEIVE_TIMEOUT = 4
+
+# Q-Block: requests of missing blocks before giving up
+NON_MAX_RETRANSMIT = 4
+
+# notifications are NON, one every NOTIFICATION_CON_COUNT is CON to check that the observer is still there
+NOTIFICATION_CON_COUNT = 100
+
+# seconds after which the next notification is CON anyway (RFC 7641 asks for one at least every 24 hours)
+NOTIFICATION_CON_PERIOD = 86400
+
+# bytes of responses kept by the cache of a client, the least recently used are evicted
+CLIENT_CACHE_SIZE = 1048576
+
+# Poller: maximum number of requests per second sent to all the devices
+POLL_MAX_RATE = 1000
+
+# Poller: maximum seconds a device which does not answer is left alone, the backoff doubles at each failure
+POLL_MAX_BACKOFF = 3600
+
+# seconds after the Max-Age of the last notification before a client re-registers an observation gone silent
+OBSERVE_REFRESH_MARGIN = 2
+
 '''  Message Format '''
 
 # number of bits used for the encoding of the CoAP version field.
@@ -94,9 +172,12 @@ options = {
     14: ('Max-Age', INTEGER, False, 60),
     15: ('Uri-Query', STRING, True, None),
     17: ('Accept', INTEGER, False, 0),
+    19: ('Q-Block1', INTEGER, True, None),
     20: ('Location-Query', STRING, True, None),
     23: ('Block2', INTEGER, False, None),
     27: ('Block1', INTEGER, False, None),
+    28: ('Size2', INTEGER, False, 0),
+    31: ('Q-Block2', INTEGER, True, None),
     35: ('Proxy-Uri', STRING, False, None),
     39: ('Proxy-Scheme', STRING, False, None),
     60: ('Size1', INTEGER, False, None)
@@ -158,7 +239,8 @@ content_types = {
     41: "application/xml",
     42: "application/octet-stream",
     47: "application/exi",
-    50: "application/json"
+    50: "application/json",
+    272: "application/missing-blocks+cbor-seq"
 }
 
 inv_content_types = {v: k for k, v in content_types.iteritems()}
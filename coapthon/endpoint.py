@@ -0,0 +1,301 @@
+import collections
+import random
+import socket
+import threading
+import time
+from coapthon import defines
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class Endpoint(object):
+    """
+    Transmission statistics of a remote endpoint: smoothed RTT, retransmission timeout and loss rate.
+
+    The RTO is estimated as in CoAP Simple Congestion Control/Advanced (CoCoA): a strong estimator is fed by the
+    messages acknowledged without retransmission, a weak one by the messages acknowledged after one or two
+    retransmissions, the RTT being measured from the first transmission. Each new estimate is averaged into the RTO.
+    """
+    __slots__ = ("srtt", "rttvar", "srtt_weak", "rttvar_weak", "rto", "rto_timestamp", "loss", "samples",
+                 "timestamp")
+
+    def __init__(self):
+        """
+        Initialize the statistics of an endpoint.
+        """
+        # smoothed RTT and RTT variation in seconds of the strong and weak estimators, None until the first sample
+        self.srtt = None
+        self.rttvar = None
+        self.srtt_weak = None
+        self.rttvar_weak = None
+        # the retransmission timeout and the time of its last update
+        self.rto = float(defines.ACK_TIMEOUT)
+        self.rto_timestamp = time.time()
+        # exponentially weighted fraction of the transmissions which have been lost
+        self.loss = 0.0
+        # number of transmissions observed
+        self.samples = 0
+        self.timestamp = time.time()
+
+    def rtt_sample(self, rtt, weak=False):
+        """
+        Update the smoothed RTT with a sample, as in RFC 6298, and average the new estimate into the RTO.
+
+        :param rtt: the RTT in seconds
+        :param weak: True if the message has been retransmitted, the sample feeds the weak estimator
+        """
+        srtt, rttvar = (self.srtt_weak, self.rttvar_weak) if weak else (self.srtt, self.rttvar)
+        if srtt is None:
+            srtt = rtt
+            rttvar = rtt / 2.0
+        else:
+            rttvar = (1 - defines.ENDPOINT_BETA) * rttvar + defines.ENDPOINT_BETA * abs(srtt - rtt)
+            srtt = (1 - defines.ENDPOINT_ALPHA) * srtt + defines.ENDPOINT_ALPHA * rtt
+        if weak:
+            self.srtt_weak, self.rttvar_weak = srtt, rttvar
+            estimate = srtt + rttvar
+            weight = defines.RTO_WEAK_WEIGHT
+        else:
+            self.srtt, self.rttvar = srtt, rttvar
+            estimate = srtt + 4 * rttvar
+            weight = defines.RTO_STRONG_WEIGHT
+        rto = weight * estimate + (1 - weight) * self.rto
+        self.rto = min(max(rto, defines.RTO_MIN), defines.RTO_MAX)
+        self.rto_timestamp = time.time()
+
+    def current_rto(self, now):
+        """
+        Get the RTO, aged if it has not been updated for a while: a small RTO is doubled after 16 times its value,
+        a large one moves halfway back to ACK_TIMEOUT after 4 times its value.
+
+        :param now: the current time
+        :return: the RTO in seconds
+        """
+        if self.rto < 1 and now - self.rto_timestamp > 16 * self.rto:
+            self.rto = min(2 * self.rto, float(defines.ACK_TIMEOUT))
+            self.rto_timestamp = now
+        elif self.rto > 3 and now - self.rto_timestamp > 4 * self.rto:
+            self.rto = (defines.ACK_TIMEOUT + self.rto) / 2.0
+            self.rto_timestamp = now
+        return self.rto
+
+    def transmission(self, lost):
+        """
+        Update the loss rate with the outcome of a transmission.
+
+        :param lost: True if the transmission has been lost
+        """
+        self.loss = (1 - defines.ENDPOINT_ALPHA) * self.loss + defines.ENDPOINT_ALPHA * (1.0 if lost else 0.0)
+        self.samples += 1
+
+
+class EndpointRegistry(object):
+    """
+    Statistics of the endpoints a server or a client talks to, used to choose the block size of each new blockwise
+    transfer. The least recently seen endpoints are dropped beyond MAX_ENDPOINTS.
+    """
+    def __init__(self, max_endpoints=None):
+        """
+        Initialize the registry.
+
+        :param max_endpoints: the maximum number of endpoints, MAX_ENDPOINTS by default
+        """
+        self._max_endpoints = max_endpoints if max_endpoints is not None else defines.MAX_ENDPOINTS
+        self._lock = threading.Lock()
+        # (host, port) -> Endpoint, the least recently seen ones are the first ones
+        self._endpoints = collections.OrderedDict()
+        # (family, network bytes, prefix length, block size), the longest prefixes are the first ones
+        self._subnets = []
+
+    def get(self, address):
+        """
+        Get the statistics of an endpoint, creating them if needed.
+
+        :param address: the (host, port) of the endpoint
+        :return: the Endpoint
+        """
+        key = self._normalize(address)
+        with self._lock:
+            endpoint = self._endpoints.pop(key, None)
+            if endpoint is None:
+                endpoint = Endpoint()
+            endpoint.timestamp = time.time()
+            self._endpoints[key] = endpoint
+            while len(self._endpoints) > self._max_endpoints:
+                self._endpoints.popitem(last=False)
+            return endpoint
+
+    def rtt(self, address, rtt, retransmissions=0):
+        """
+        Record an acknowledged transmission and its RTT.
+
+        :param address: the (host, port) of the endpoint
+        :param rtt: the time in seconds from the first transmission of the message, None if unknown
+        :param retransmissions: the retransmissions of the message, the RTT is not sampled beyond two
+        """
+        endpoint = self.get(address)
+        with self._lock:
+            if rtt is not None and retransmissions <= 2:
+                endpoint.rtt_sample(rtt, retransmissions > 0)
+            endpoint.transmission(False)
+
+    def rto(self, address):
+        """
+        Get the retransmission timeout of an endpoint.
+
+        :param address: the (host, port) of the endpoint
+        :return: the RTO in seconds
+        """
+        endpoint = self.get(address)
+        with self._lock:
+            return endpoint.current_rto(time.time())
+
+    def timeout(self, address):
+        """
+        Choose the timeout of the first transmission of a CON message, between RTO and RTO * ACK_RANDOM_FACTOR.
+
+        :param address: the (host, port) of the endpoint
+        :return: the timeout in seconds
+        """
+        rto = self.rto(address)
+        return random.uniform(rto, rto * defines.ACK_RANDOM_FACTOR)
+
+    def backoff(self, address, timeout):
+        """
+        Compute the timeout of the next retransmission with the variable backoff factor of CoCoA: 3 for an RTO
+        below 1 second, 1.5 above 3 seconds, 2 otherwise.
+
+        :param address: the (host, port) of the endpoint
+        :param timeout: the timeout of the last transmission
+        :return: the timeout in seconds
+        """
+        rto = self.rto(address)
+        if rto < 1:
+            factor = 3
+        elif rto > 3:
+            factor = 1.5
+        else:
+            factor = 2
+        return min(timeout * factor, defines.RTO_MAX)
+
+    def stats(self):
+        """
+        Get the statistics of the endpoints.
+
+        :return: a dictionary (host, port) -> rto, srtt, rttvar, srtt_weak, rttvar_weak, loss and samples
+        """
+        now = time.time()
+        with self._lock:
+            return dict((address, {"rto": endpoint.current_rto(now), "srtt": endpoint.srtt, "rttvar": endpoint.rttvar,
+                                "srtt_weak": endpoint.srtt_weak, "rttvar_weak": endpoint.rttvar_weak,
+                                "loss": endpoint.loss, "samples": endpoint.samples})
+                        for address, endpoint in self._endpoints.iteritems())
+
+    def delivered(self, address):
+        """
+        Record a transmission which has not been lost.
+
+        :param address: the (host, port) of the endpoint
+        """
+        self.rtt(address, None)
+
+    def lost(self, address):
+        """
+        Record a lost transmission, e.g. a retransmission or a duplicated request.
+
+        :param address: the (host, port) of the endpoint
+        """
+        endpoint = self.get(address)
+        with self._lock:
+            endpoint.transmission(True)
+
+    def set_block_size(self, subnet, size):
+        """
+        Force the block size of the endpoints in a subnet.
+
+        :param subnet: the subnet, e.g. "10.0.0.0/8" or "fd00::/8"
+        :param size: the block size, None to remove the override
+        """
+        address, length = subnet.split("/")
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        network = socket.inet_pton(family, address)
+        length = int(length)
+        with self._lock:
+            self._subnets = [s for s in self._subnets if s[:3] != (family, network, length)]
+            if size is not None:
+                self._subnets.append((family, network, length, size))
+                self._subnets.sort(key=lambda s: -s[2])
+
+    def block_size(self, address, resource=None):
+        """
+        Choose the block size of a new transfer with an endpoint. The block size of the resource prevails over the
+        one of the subnet, which prevails over the statistics. Endpoints with less than BLOCK_SIZE_MIN_SAMPLES
+        transmissions get MAX_PAYLOAD, the other ones the block size of their loss rate, with the more tolerant
+        thresholds of BLOCK_SIZE_BY_LOSS_LAN if their RTT is below BLOCK_SIZE_LAN_RTT.
+
+        :param address: the (host, port) of the endpoint
+        :param resource: the resource transferred, if any
+        :return: the block size
+        """
+        if resource is not None and resource.block_size is not None:
+            return resource.block_size
+        key = self._normalize(address)
+        size = self._subnet_block_size(key[0])
+        if size is not None:
+            return size
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None or endpoint.samples < defines.BLOCK_SIZE_MIN_SAMPLES:
+                return defines.MAX_PAYLOAD
+            loss = endpoint.loss
+            lan = endpoint.srtt is not None and endpoint.srtt + 4 * endpoint.rttvar < defines.BLOCK_SIZE_LAN_RTT
+        sizes = defines.BLOCK_SIZE_BY_LOSS_LAN if lan else defines.BLOCK_SIZE_BY_LOSS
+        for threshold, size in sizes:
+            if loss < threshold:
+                return size
+        return sizes[-1][1]
+
+    def _subnet_block_size(self, host):
+        """
+        Find the block size of the most specific subnet of a host.
+
+        :param host: the normalized host
+        :return: the block size or None if the host is not in any subnet
+        """
+        if len(self._subnets) == 0:
+            return None
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        try:
+            address = socket.inet_pton(family, host)
+        except socket.error:
+            return None
+        for f, network, length, size in self._subnets:
+            if f != family:
+                continue
+            full, bits = divmod(length, 8)
+            if address[:full] != network[:full]:
+                continue
+            if bits > 0:
+                mask = (0xFF << (8 - bits)) & 0xFF
+                if ord(address[full]) & mask != ord(network[full]) & mask:
+                    continue
+            return size
+        return None
+
+    @staticmethod
+    def _normalize(address):
+        """
+        Map IPv4-mapped IPv6 addresses, as received by a dual stack socket, to IPv4.
+
+        :param address: the (host, port) of the endpoint
+        :return: the normalized (host, port)
+        """
+        host = str(address[0])
+        if host.startswith("::ffff:") and "." in host:
+            host = host[7:]
+        return host, int(address[1])
+
+
+# statistics shared by the clients of this process
+registry = EndpointRegistry()
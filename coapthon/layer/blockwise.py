@@ -1,11 +1,56 @@
-import struct
+import collections
+import tempfile
+import threading
+import time
 from coapthon import defines
-from coapthon.utils import byte_len, bit_len, parse_blockwise
+from coapthon.messages.response import Response
+from coapthon.utils import parse_blockwise
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
 
+class BlockwiseSession(object):
+    """
+    State of a blockwise transfer. A Block2 transfer keeps a snapshot of the representation sent with the first
+    block, so the following blocks are served from it without rendering the resource again. A Block1 transfer
+    reassembles the body of the request in a buffer or in a temporary file.
+    """
+    __slots__ = ("block", "byte", "num", "m", "size", "timestamp", "path", "node", "version", "resource", "source",
+                 "etag", "content_type", "snapshot", "body", "length", "reserved")
+
+    def __init__(self, block, num, m, size):
+        """
+        Initialize a transfer.
+
+        :param block: 1 for Block1, 2 for Block2
+        :param num: the block number
+        :param m: the M bit
+        :param size: the block size
+        """
+        self.block = block
+        self.num = num
+        self.m = m
+        self.size = size
+        self.byte = num * size
+        self.timestamp = time.time()
+        self.path = None
+        # the resource in the tree and its Observe counter when the snapshot was taken
+        self.node = None
+        self.version = None
+        # the rendered resource, its payload dict and ETag when the snapshot was taken
+        self.resource = None
+        self.source = None
+        self.etag = None
+        self.content_type = None
+        # memoryview of the encoded representation
+        self.snapshot = None
+        # Block1: the bytearray or the temporary file with the body, the bytes received and the memory reserved
+        self.body = None
+        self.length = 0
+        self.reserved = 0
+
+
 class BlockwiseLayer(object):
     """
     Handles the Blockwise feature.
@@ -19,13 +64,19 @@ class BlockwiseLayer(object):
         :param parent: the CoAP server
         """
         self._parent = parent
+        self._lock = threading.RLock()
+        # the least recently used transfers are the first ones
+        self._parent.blockwise = collections.OrderedDict()
+        # bytes reserved by the uploads reassembled in memory
+        self._memory = 0
 
     def handle_request(self, request):
         """
-        Store Blockwise parameter required by clients
+        Store Blockwise parameter required by clients. The blocks of a Block1 request are reassembled and the request
+        is processed only once, with the whole body as payload.
 
         :param request: the request message
-        :return: M bit, request
+        :return: M bit, the request to be processed or the response to a block
         """
         ret = True
         for option in request.options:
@@ -33,67 +84,406 @@ class BlockwiseLayer(object):
                 host, port = request.source
                 key = hash(str(host) + str(port) + str(request.token))
                 num, m, size = parse_blockwise(option.raw_value)
-                # remember choices
-                if key in self._parent.blockwise:
-                    block, byte, num2, m2, size2 = self._parent.blockwise[key]
-                    if block == 2:
-                        self._parent.blockwise[key] = (2, byte, num, m, size)
+                # the block is taken from the Block2 option of each request, pipelined requests share the session
+                with self._lock:
+                    session = self.get(key)
+                    if session is not None and session.block == 2:
+                        self.store(key, session)
                     else:
-                        self._parent.blockwise[key] = (2, 0, num, m, size)
-                else:
-                    self._parent.blockwise[key] = (2, 0, num, m, size)
+                        self.store(key, BlockwiseSession(2, num, m, size))
             elif option.number == defines.inv_options["Block1"]:
-                host, port = request.source
-                key = hash(str(host) + str(port) + str(request.token))
                 num, m, size = parse_blockwise(option.raw_value)
-                # remember choices
-                self._parent.blockwise[key] = (1, 0, num, m, size)
-                if m == 0:
-                    del self._parent.blockwise[key]
-                    ret = False
+                ret = m == 1
+                response = self.handle_block1(request, num, m, size)
+                if response is not None:
+                    return ret, response
         return ret, request
 
-    def start_block2(self, request):
+    def handle_block1(self, request, num, m, size):
         """
-        Initialize a blockwise response. Used if payload > 1024
+        Add a block to the body of an upload.
 
         :param request: the request message
+        :param num: the block number
+        :param m: the M bit
+        :param size: the block size
+        :return: the response to the block, or None if the body is complete and the request must be processed
         """
         host, port = request.source
         key = hash(str(host) + str(port) + str(request.token))
-        self._parent.blockwise[key] = (2, 0, 0, 1, 1024)
+        with self._lock:
+            session = self.get(key)
+            if session is None or session.block != 1:
+                if num != 0:
+                    # the beginning of the body is missing (RFC 7959, 2.5)
+                    return self._error(request, 'REQUEST_ENTITY_INCOMPLETE')
+                session = BlockwiseSession(1, num, m, size)
+                session.body = None
+                self.store(key, session)
+        payload = request.payload if request.payload is not None else ""
+        offset = num * size
+        if offset != session.byte + session.length:
+            self.discard(key)
+            return self._error(request, 'REQUEST_ENTITY_INCOMPLETE')
+        length = session.length + len(payload)
+        total = max(length, request.size1) if request.size1 is not None else length
+        if total > defines.MAX_UPLOAD_SIZE:
+            self.discard(key)
+            return self._error(request, 'REQUEST_ENTITY_TOO_LARGE')
+        if not self.write(session, session.length, payload, total):
+            self.discard(key)
+            return self._error(request, 'REQUEST_ENTITY_TOO_LARGE')
+        session.num = num
+        session.m = m
+        session.size = size
 
-    def handle_response(self, key, response, resource):
+        if m == 1:
+            if num == 0:
+                # propose a smaller size for the following blocks, if suitable for the client
+                size = min(size, self._block1_size(request))
+                session.size = size
+            self.store(key, session)
+            response = Response()
+            response.destination = request.source
+            response.code = defines.responses["CONTINUE"]
+            response.token = request.token
+            response.block1 = (num, m, size)
+            response = self._parent.message_layer.reliability_response(request, response)
+            response = self._parent.message_layer.matcher_response(response)
+            return response
+
+        # last block, the request is processed with the whole body
+        with self._lock:
+            self._parent.blockwise.pop(key, None)
+        request.payload = self.body(session)
+        return None
+
+    @staticmethod
+    def _block2(request):
         """
-        Handle Blockwise in responses.
+        Get the Block2 option of a request.
 
-        :param key: key parameter to search inside the dictionary
-        :param response: the response message
-        :param resource: the request message
-        :return: the new response
+        :param request: the request message
+        :return: the (num, m, size) tuple or None if the request has no Block2 option
+        """
+        for option in request.options:
+            if option.number == defines.inv_options["Block2"]:
+                return parse_blockwise(option.raw_value)
+        return None
+
+    def _block1_size(self, request):
+        """
+        Choose the block size of an upload.
+
+        :param request: the request message
+        :return: the block size
+        """
+        try:
+            resource = self._parent.root["/" + request.uri_path]
+        except KeyError:
+            resource = None
+        return self._parent.endpoints.block_size(request.source, resource)
+
+    def write(self, session, offset, payload, total):
+        """
+        Write a block of an upload, in memory up to UPLOAD_SPILL_THRESHOLD and in a temporary file beyond. The memory
+        is charged to UPLOAD_MEMORY_LIMIT, shared by the Block1 and Q-Block1 uploads.
+
+        :param session: the transfer, with body, length and reserved attributes
+        :param offset: the offset of the block in the body
+        :param payload: the block
+        :param total: the expected size of the body
+        :return: False if the memory limit is reached
+        """
+        if session.body is None or isinstance(session.body, bytearray):
+            if total > defines.UPLOAD_SPILL_THRESHOLD:
+                body = tempfile.TemporaryFile(prefix="coapthon")
+                if session.body is not None:
+                    # the blocks of a Q-Block1 upload may have been received in any order
+                    body.write(session.body)
+                with self._lock:
+                    self._release(session)
+                session.body = body
+            elif total > session.reserved:
+                with self._lock:
+                    if self._memory + total - session.reserved > defines.UPLOAD_MEMORY_LIMIT:
+                        return False
+                    self._memory += total - session.reserved
+                    session.reserved = total
+                if session.body is None:
+                    # pre-allocated with Size1, if known
+                    session.body = bytearray(total)
+                elif len(session.body) < total:
+                    session.body.extend(bytearray(total - len(session.body)))
+        if isinstance(session.body, bytearray):
+            session.body[offset:offset + len(payload)] = payload
+        else:
+            session.body.seek(offset)
+            session.body.write(payload)
+        session.length += len(payload)
+        return True
+
+    def body(self, session):
+        """
+        Take the body of a complete upload and release its memory.
+
+        :param session: the transfer
+        :return: the body, a rewound temporary file if it has been spilled to disk
+        """
+        with self._lock:
+            self._release(session)
+        body = session.body
+        session.body = None
+        if body is None:
+            return ""
+        elif isinstance(body, bytearray):
+            if len(body) > session.length:
+                del body[session.length:]
+            return body
+        # the resources read the body from the file, which is deleted when closed
+        body.truncate(session.length)
+        body.seek(0)
+        return body
+
+    def _release(self, session):
+        """
+        Release the memory reserved by an upload.
+
+        :param session: the transfer
+        """
+        self._memory -= session.reserved
+        session.reserved = 0
+
+    def _drop(self, session):
+        """
+        Release the resources of a dropped transfer.
+
+        :param session: the transfer
+        """
+        if session.block == 1:
+            self.drop_body(session)
+
+    def drop_body(self, session):
+        """
+        Release the memory or the temporary file of an upload.
+
+        :param session: the transfer
+        """
+        with self._lock:
+            self._release(session)
+        if session.body is not None and not isinstance(session.body, bytearray):
+            session.body.close()
+        session.body = None
+
+    def _error(self, request, error):
+        response = Response()
+        response.destination = request.source
+        response = self._parent.send_error(request, response, error)
+        if error == 'REQUEST_ENTITY_TOO_LARGE':
+            response.size1 = defines.MAX_UPLOAD_SIZE
+        return response
+
+    def get(self, key):
+        """
+        Get a transfer which is not expired.
+
+        :param key: the key of the transfer
+        :return: the transfer or None
         """
-        block, byte, num, m, size = self._parent.blockwise[key]
-        payload = resource.payload
-        if block == 2:
-            ret = payload[byte:byte + size]
-
-            if len(ret) == size:
-                m = 1
-            else:
-                m = 0
-            response.block2 = (num, m, size)
-            response.payload = ret
-            byte += size
-            num += 1
-            if m == 0:
+        with self._lock:
+            session = self._parent.blockwise.get(key)
+            if session is not None and session.timestamp + defines.BLOCKWISE_SESSION_LIFETIME < time.time():
                 del self._parent.blockwise[key]
-            else:
-                self._parent.blockwise[key] = (2, byte, num, m, size)
+                self._drop(session)
+                return None
+            return session
 
-        elif block == 1:
-            if m == 1:
-                response.code = defines.responses["CONTINUE"]
-            response.block1 = (num, m, size)
+    def store(self, key, session):
+        """
+        Store a transfer as the most recently used one and drop the least recently used transfers beyond
+        MAX_BLOCKWISE_SESSIONS.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        """
+        with self._lock:
+            session.timestamp = time.time()
+            old = self._parent.blockwise.pop(key, None)
+            if old is not None and old is not session:
+                self._drop(old)
+            self._parent.blockwise[key] = session
+            while len(self._parent.blockwise) > defines.MAX_BLOCKWISE_SESSIONS:
+                self._drop(self._parent.blockwise.popitem(last=False)[1])
+
+    def discard(self, key):
+        """
+        Remove a transfer.
+
+        :param key: the key of the transfer
+        """
+        with self._lock:
+            session = self._parent.blockwise.pop(key, None)
+            if session is not None:
+                self._drop(session)
+
+    def purge(self, now=None):
+        """
+        Remove the idle transfers.
+
+        :param now: the current time
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            while len(self._parent.blockwise) > 0:
+                key, session = next(self._parent.blockwise.iteritems())
+                if session.timestamp + defines.BLOCKWISE_SESSION_LIFETIME >= now:
+                    break
+                del self._parent.blockwise[key]
+                self._drop(session)
+
+    def start_block2(self, request, resource=None):
+        """
+        Initialize a blockwise response. Used if the payload is larger than the block size chosen for the client.
+
+        :param request: the request message
+        :param resource: the resource rendered
+        """
+        host, port = request.source
+        key = hash(str(host) + str(port) + str(request.token))
+        self.store(key, BlockwiseSession(2, 0, 1, self._parent.endpoints.block_size(request.source, resource)))
+
+    def serve_block2(self, request, response):
+        """
+        Serve a block of a transfer in progress from its snapshot. A request without Block2 or for the block 0
+        starts a new transfer, a change of the resource since the snapshot answers 4.08.
+
+        :param request: the request message
+        :param response: the response message
+        :return: the response, or None if the resource must be rendered
+        """
+        host, port = request.source
+        key = hash(str(host) + str(port) + str(request.token))
+        path = str("/" + request.uri_path)
+        with self._lock:
+            session = self.get(key)
+            if session is None or session.block != 2:
+                return None
+            if session.snapshot is None or session.resource is None:
+                # e.g. a discovery, rendered at every block
+                return None
+            block2 = self._block2(request)
+            if block2 is None:
+                self.discard(key)
+                return None
+            if block2[0] == 0 or session.path != path:
+                session.snapshot = None
+                return None
+            try:
+                node = self._parent.root[path]
+            except KeyError:
+                node = None
+            if node is None or node is not session.node or node.observe_count != session.version or \
+                    session.resource.raw_payload is not session.source or session.resource.etag != session.etag:
+                # the representation changed during the transfer
+                self.discard(key)
+                return self._parent.send_error(request, response, 'REQUEST_ENTITY_INCOMPLETE')
+
+            response.code = defines.responses['CONTENT']
+            response.token = request.token
+            if session.content_type is not None:
+                response.content_type = session.content_type
+            # the blocks of a pipelined download may be requested concurrently with the same token
+            response = self.handle_response(key, response, session.resource, block2=block2)
+            if session.etag is not None:
+                response.etag = session.etag
+            if session.resource.max_age is not None:
+                response.max_age = session.resource.max_age
+        response = self._parent.message_layer.reliability_response(request, response)
+        response = self._parent.message_layer.matcher_response(response)
         return response
 
+    def snapshot(self, session, request, response, resource):
+        """
+        Take the snapshot of the representation sent with the first block of a Block2 transfer.
+
+        :param session: the transfer
+        :param request: the request message
+        :param response: the response message, with the representation as payload
+        :param resource: the rendered resource, None if the payload is not produced by a resource
+        """
+        payload = response.payload
+        if payload is None and resource is not None:
+            payload = resource.payload
+            if isinstance(payload, tuple):
+                # (Content-Type, payload)
+                payload = payload[1]
+        if payload is None:
+            payload = ""
+        elif not isinstance(payload, str):
+            payload = str(payload)
+        session.snapshot = memoryview(payload)
+        session.path = str("/" + request.uri_path)
+        session.content_type = None
+        for option in response.options:
+            if option.number == defines.inv_options["Content-Type"]:
+                session.content_type = option.value
+        session.node = None
+        session.resource = None
+        if resource is not None:
+            try:
+                session.node = self._parent.root[session.path]
+            except KeyError:
+                session.node = None
+            session.version = session.node.observe_count if session.node is not None else None
+            session.resource = resource
+            session.source = resource.raw_payload
+            session.etag = resource.etag
+
+    def handle_response(self, key, response, resource, request=None, block2=None):
+        """
+        Handle Blockwise in responses. The block is chosen by the Block2 option of the request, never by the state of
+        the transfer, which is shared by the concurrent requests of a pipelined download.
 
+        :param key: key parameter to search inside the dictionary
+        :param response: the response message
+        :param resource: the resource, None if the payload is already in the response
+        :param request: the request message if the resource has been rendered, None to use the snapshot
+        :param block2: the (num, m, size) asked for when the snapshot is used
+        :return: the new response
+        """
+        with self._lock:
+            session = self.get(key)
+            if session is None:
+                return response
+            if session.block == 2:
+                if request is not None and request.code != defines.inv_codes["GET"]:
+                    # only the representations returned by GET are split in blocks
+                    return response
+                if request is not None:
+                    # rendered again, e.g. the first block
+                    self.snapshot(session, request, response, resource)
+                    block2 = self._block2(request)
+                    if block2 is None:
+                        num, size = 0, session.size
+                    else:
+                        num, size = block2[0], block2[2]
+                    if num == 0:
+                        # the server may answer the first block with a smaller size than asked by the client
+                        size = min(size, self._parent.endpoints.block_size(request.source, resource))
+                        session.size = size
+                else:
+                    num, size = block2[0], block2[2]
+                byte = num * size
+                ret = session.snapshot[byte:byte + size]
+                m = 1 if byte + size < len(session.snapshot) else 0
+                response.block2 = (num, m, size)
+                if request is not None and num == 0 and request.size2 is not None:
+                    # the client asked for the size of the representation
+                    response.size2 = len(session.snapshot)
+                response.payload = ret
+                if m == 0:
+                    self.discard(key)
+                else:
+                    self.store(key, session)
+        return response
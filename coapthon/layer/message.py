@@ -60,7 +60,7 @@ class MessageLayer(object):
         if port is None or port == 0:
             raise AttributeError("Response has no destination port set")
         key = hash(str(host) + str(port) + str(response.mid))
-        self._parent.sent[key] = (response, time.time())
+        self._parent.sent[key] = (response, time.time(), 0)
         return response
 
     def handle_message(self, message):
@@ -80,19 +80,24 @@ class MessageLayer(object):
         if t is None:
             # log.err(defines.types[message.type] + " received without the corresponding message")
             return
-        response, timestamp = t
+        response, timestamp, retransmissions = t
         # Reliability
         if message.type == defines.inv_types['ACK']:
-            response.acknowledged = True
+            if not response.acknowledged:
+                # a retransmitted message gives a weak RTT sample
+                self._parent.endpoints.rtt((host, port), time.time() - timestamp, retransmissions)
+                response.acknowledged = True
+                # the next CON message to the client, then a newer notification waiting for this one
+                self._parent.outbound_layer.release(response)
+                self._parent.observe_layer.notification_acknowledged(response)
         elif message.type == defines.inv_types['RST']:
-            response.rejected = True
+            if not response.rejected and not response.acknowledged:
+                response.rejected = True
+                self._parent.outbound_layer.release(response)
 
         # Observing
         if message.type == defines.inv_types['RST']:
-            for resource in self._parent.relation.keys():
-                host, port = message.source
-                key = hash(str(host) + str(port) + str(response.token))
-                self._parent.observe_layer.remove_observer(resource, key)
+            self._parent.observe_layer.remove_observer((host, port, response.token))
 
         # cancel retransmission
         # log.msg("Cancel retrasmission to:" + host + ":" + str(port))
@@ -102,7 +107,7 @@ class MessageLayer(object):
                 call_id.cancel()
         except:
             pass
-        self._parent.sent[key] = (response, time.time())
+        self._parent.sent[key] = (response, time.time(), retransmissions)
 
     def start_separate_timer(self, request):
         """
@@ -1,13 +1,302 @@
+import heapq
+import struct
+import threading
 import time
 from coapthon import defines
 from coapthon.messages.option import Option
+from coapthon.messages.request import Request
 from coapthon.messages.response import Response
 from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
 
+class ObserveCondition(object):
+    """
+    Conditional attributes of an observation, given as Uri-Query of the registration: pmin and pmax are the minimum
+    and maximum seconds between two notifications, st the change of the value, gt and lt the thresholds whose
+    crossing is notified. st, gt and lt apply to resources whose representation is a number.
+    """
+    __slots__ = ("pmin", "pmax", "st", "gt", "lt", "resource", "last", "value", "pending", "due")
+
+    attributes = ("pmin", "pmax", "st", "gt", "lt")
+
+    def __init__(self, resource, attributes):
+        """
+        Initialize the conditions of an observation.
+
+        :param resource: the observed resource
+        :param attributes: dictionary of the conditional attributes
+        """
+        for name in self.attributes:
+            setattr(self, name, attributes.get(name))
+        self.resource = resource
+        # time and value of the last notification
+        self.last = time.time()
+        self.value = None
+        # an update to be notified once pmin has elapsed
+        self.pending = False
+        self.due = None
+
+    @classmethod
+    def parse(cls, query):
+        """
+        Parse the conditional attributes of a registration.
+
+        :param query: the Uri-Query of the registration
+        :return: dictionary of the attributes, None if the attributes are not valid
+        """
+        attributes = {}
+        for q in query:
+            name, sep, value = str(q).partition("=")
+            if name not in cls.attributes:
+                continue
+            try:
+                attributes[name] = float(value)
+            except ValueError:
+                return None
+            if attributes[name] < 0 and name in ("pmin", "pmax", "st"):
+                return None
+        if attributes.get("pmax") is not None and attributes.get("pmax") <= attributes.get("pmin", 0):
+            return None
+        return attributes
+
+    def changed(self, value):
+        """
+        Check if an update fulfills st, gt or lt. Any update does if they are not given.
+
+        :param value: the value of the resource, None if not a number
+        :return: True if the update must be notified
+        """
+        if self.st is None and self.gt is None and self.lt is None:
+            return True
+        if value is None or self.value is None:
+            return True
+        if self.st is not None and abs(value - self.value) >= self.st:
+            return True
+        for threshold in (self.gt, self.lt):
+            if threshold is not None and min(value, self.value) <= threshold < max(value, self.value):
+                return True
+        return False
+
+    def next_due(self):
+        """
+        Compute when the observation must be checked by the timer.
+
+        :return: the time, None if nothing is waiting
+        """
+        due = None
+        if self.pending:
+            due = self.last + (self.pmin or 0)
+        if self.pmax is not None:
+            due = self.last + self.pmax if due is None else min(due, self.last + self.pmax)
+        return due
+
+
+class ObserveRelation(object):
+    """
+    An observe relation. Only what is needed to notify the observer is kept, the registration request and response
+    are released once the relation is created.
+    """
+    __slots__ = ("key", "accept", "query", "confirmable", "timestamp", "sequence", "con_counter", "con_timestamp")
+
+    def __init__(self, request, response, sequence):
+        """
+        Create the relation of a registration.
+
+        :param request: the registration request
+        :param response: the response to the registration
+        :param sequence: the Observe number of the response
+        """
+        host, port = response.destination
+        # the same host string is shared by the relations of an endpoint
+        self.key = (intern(str(host)), port, response.token)
+        self.accept = request.accept
+        self.query = tuple(str(q) for q in request.query)
+        self.confirmable = request.type == defines.inv_types['CON']
+        # time in ms of the last notification
+        self.timestamp = int(round(time.time() * 1000))
+        # Observe number of the last notification
+        self.sequence = sequence
+        # notifications sent as NON since the last CON one
+        self.con_counter = 0
+        # time in ms of the last CON notification, the registration shows the observer is there
+        self.con_timestamp = self.timestamp
+
+    @property
+    def destination(self):
+        """
+        Get the address of the observer.
+
+        :return: (host, port)
+        """
+        return self.key[:2]
+
+    @property
+    def token(self):
+        """
+        Get the token of the observation.
+
+        :return: the token
+        """
+        return self.key[2]
+
+    def request(self, resource):
+        """
+        Rebuild the request of the registration, used to render the resource for the observer.
+
+        :param resource: the observed resource
+        :return: the request
+        """
+        request = Request()
+        request.code = defines.inv_codes['GET']
+        request.type = defines.inv_types['CON'] if self.confirmable else defines.inv_types['NON']
+        request.token = self.token
+        request.source = self.destination
+        request.uri_path = resource.path
+        for q in self.query:
+            request.add_query(q)
+        if self.accept is not None:
+            option = Option()
+            option.number = defines.inv_options['Accept']
+            option.value = self.accept
+            request.add_option(option)
+        request.observe = 0
+        request.acknowledged = True
+        return request
+
+
+class ObserverRegistry(object):
+    """
+    The observe relations of the server. A forward map from each resource to its observers is used to notify them, a
+    reverse map from the (host, port, token) of each observer to the observed resource and an index of the observers
+    of each endpoint make the removal of an observer independent from the number of observed resources.
+    """
+
+    def __init__(self):
+        # resource -> {(host, port, token): ObserveRelation}
+        self._resources = {}
+        # (host, port, token) -> resource
+        self._observers = {}
+        # (host, port) -> set of (host, port, token)
+        self._endpoints = {}
+        self._lock = threading.RLock()
+
+    def get(self, resource):
+        """
+        Get the observers of a resource.
+
+        :param resource: the resource
+        :return: the dictionary of the observers, None if the resource is not observed
+        """
+        return self._resources.get(resource)
+
+    def resource(self, key):
+        """
+        Get the resource observed by an observer.
+
+        :param key: the (host, port, token) of the observer
+        :return: the resource, None if the observer is not registered
+        """
+        return self._observers.get(key)
+
+    def keys(self):
+        """
+        Get the observed resources.
+
+        :return: the list of the resources
+        """
+        return self._resources.keys()
+
+    def __contains__(self, resource):
+        return resource in self._resources
+
+    def __len__(self):
+        return len(self._resources)
+
+    def add(self, resource, relation):
+        """
+        Register an observer of a resource. An observer using the same token for another resource is moved.
+
+        :param resource: the resource
+        :type relation: ObserveRelation
+        :param relation: the relation
+        """
+        key = relation.key
+        with self._lock:
+            old = self._observers.get(key)
+            if old is not None and old is not resource:
+                self.remove(key)
+            self._resources.setdefault(resource, {})[key] = relation
+            self._observers[key] = resource
+            self._endpoints.setdefault(key[:2], set()).add(key)
+
+    def remove(self, key):
+        """
+        Remove an observer.
+
+        :param key: the (host, port, token) of the observer
+        :return: the resource it observed, None if the observer is not registered
+        """
+        with self._lock:
+            resource = self._observers.pop(key, None)
+            if resource is None:
+                return None
+            observers = self._resources.get(resource)
+            if observers is not None:
+                observers.pop(key, None)
+                if len(observers) == 0:
+                    del self._resources[resource]
+            keys = self._endpoints.get(key[:2])
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._endpoints[key[:2]]
+            return resource
+
+    def remove_resource(self, resource):
+        """
+        Remove all the observers of a resource.
+
+        :param resource: the resource
+        :return: the dictionary of the observers removed, None if the resource was not observed
+        """
+        with self._lock:
+            observers = self._resources.get(resource)
+            if observers is None:
+                return None
+            for key in observers.keys():
+                self.remove(key)
+            return observers
+
+    def replace(self, old, resource):
+        """
+        Move the observers of a resource to the resource that replaces it.
+
+        :param old: the replaced resource
+        :param resource: the new resource
+        """
+        with self._lock:
+            observers = self._resources.pop(old, None)
+            if observers is None:
+                return
+            self._resources[resource] = observers
+            for key in observers:
+                self._observers[key] = resource
+
+    def endpoint(self, host, port):
+        """
+        Get the observers of an endpoint.
+
+        :param host: the host of the endpoint
+        :param port: the port of the endpoint
+        :return: the list of (host, port, token)
+        """
+        return list(self._endpoints.get((host, port), ()))
+
+
 class ObserveLayer(object):
     """
     Handles the Observing feature.
@@ -20,6 +309,15 @@ class ObserveLayer(object):
         :param parent: the CoAP server
         """
         self._parent = parent
+        # observer key -> ObserveCondition, for the observations registered with conditional attributes
+        self._conditions = {}
+        # (due, key) of the conditions, checked by a single timer
+        self._schedule = []
+        self._timer = None
+        self._timer_due = None
+        # observer key -> [CON notification in transmission, newer notification waiting for it or None]
+        self._inflight = {}
+        self._lock = threading.RLock()
 
     def notify_deletion(self, resource):
         """
@@ -36,13 +334,11 @@ class ObserveLayer(object):
             return
         now = int(round(time.time() * 1000))
         commands = []
-        for item in observers.keys():
-            old, request, response = observers[item]
+        for relation in observers.values():
             # send notification
-            commands.append((self._parent.prepare_notification_deletion, [(resource, request, response)], {}))
-            observers[item] = (now, request, response)
+            commands.append((self._parent.prepare_notification_deletion, [(resource, relation)], {}))
+            relation.timestamp = now
         resource.observe_count += 1
-        self._parent.relation[resource] = observers
         return commands
 
     def notify(self, resource):
@@ -59,29 +355,254 @@ class ObserveLayer(object):
             resource.observe_count += 1
             return
         now = int(round(time.time() * 1000))
-        commands = []
-        for item in observers.keys():
-            old, request, response = observers[item]
-            # send notification
-            commands.append((self._parent.prepare_notification, (resource, request, response)))
-            observers[item] = (now, request, response)
+        batch = []
+        value = None
+        with self._lock:
+            for item, relation in observers.items():
+                condition = self._conditions.get(item)
+                if condition is not None:
+                    if value is None:
+                        value = self.value(resource)
+                    if not self.update(item, condition, value):
+                        # coalesced, notified by the timer with the latest state
+                        continue
+                batch.append(relation)
+                relation.timestamp = now
         resource.observe_count += 1
-        self._parent.relation[resource] = observers
-        return commands
+        if len(batch) == 0:
+            return []
+        # the notifications are rendered and sent by a single job
+        return [(self._parent.prepare_notifications, (resource, batch))]
+
+    def update(self, key, condition, value):
+        """
+        Handle an update of a resource observed with conditional attributes.
+
+        :param key: the key of the observer
+        :param condition: the conditions of the observation
+        :param value: the value of the resource, None if not a number
+        :return: True if the update must be notified now
+        """
+        notify = False
+        if condition.changed(value):
+            now = time.time()
+            if condition.pmin is None or now >= condition.last + condition.pmin:
+                condition.last = now
+                condition.value = value
+                condition.pending = False
+                notify = True
+            else:
+                condition.pending = True
+        self.schedule(key, condition)
+        return notify
+
+    def schedule(self, key, condition):
+        """
+        Schedule the next check of an observation with conditional attributes.
+
+        :param key: the key of the observer
+        :param condition: the conditions of the observation
+        """
+        with self._lock:
+            due = condition.next_due()
+            if due == condition.due:
+                return
+            condition.due = due
+            if due is None:
+                return
+            heapq.heappush(self._schedule, (due, key))
+            if self._timer_due is None or due < self._timer_due:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer_due = due
+                self._timer = threading.Timer(max(0, due - time.time()), self.expire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def expire(self):
+        """
+        Send the coalesced notifications whose pmin has elapsed and the ones whose pmax has elapsed.
+        """
+        batches = {}
+        with self._lock:
+            self._timer = None
+            self._timer_due = None
+            now = time.time()
+            expired = []
+            while len(self._schedule) > 0 and self._schedule[0][0] <= now:
+                due, key = heapq.heappop(self._schedule)
+                condition = self._conditions.get(key)
+                if condition is not None and condition.due == due:
+                    expired.append((key, condition))
+            for key, condition in expired:
+                condition.due = None
+                observers = self._parent.relation.get(condition.resource)
+                if observers is None or key not in observers:
+                    del self._conditions[key]
+                    continue
+                relation = observers[key]
+                relation.timestamp = int(round(now * 1000))
+                batches.setdefault(condition.resource, []).append(relation)
+                condition.last = now
+                condition.value = self.value(condition.resource)
+                condition.pending = False
+                self.schedule(key, condition)
+            if self._timer is None and len(self._schedule) > 0:
+                due, key = self._schedule[0]
+                self._timer_due = due
+                self._timer = threading.Timer(max(0, due - time.time()), self.expire)
+                self._timer.daemon = True
+                self._timer.start()
+        for resource, batch in batches.iteritems():
+            try:
+                self._parent.executor.submit(self._parent.prepare_notifications, (resource, batch))
+            except (RuntimeError, AttributeError):
+                # the server is closing
+                return
+
+    def close(self):
+        """
+        Stop the timer of the conditional observations.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._timer_due = None
+
+    @staticmethod
+    def value(resource):
+        """
+        Get the value of a resource, used by the st, gt and lt attributes.
+
+        :param resource: the resource
+        :return: the representation as a number, None if it is not a number
+        """
+        try:
+            content_type, payload = resource.representation()
+            return float(payload)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def prepare_notifications(self, t):
+        """
+        Create the notifications of an update for all the observers of a resource. The representation is rendered and
+        encoded once for each Accept and Uri-Query of the observers, the datagram of each observer is the encoded
+        representation preceded by its own header and token.
+
+        :type t: (resource, [ObserveRelation])
+        :param t: the resource and its observers
+        :return: the list of (resource, relation, notification, datagram), datagram is None if the notification must
+                 be serialized on its own, e.g. the first block of a blockwise transfer
+        """
+        resource, observers = t
+        assert(isinstance(resource, Resource))
+        serializer = Serializer()
+        encoded = {}
+        notifications = []
+        for relation in observers:
+            host, port = relation.destination
+            key = (relation.accept, relation.query)
+            if key not in encoded:
+                encoded[key] = self.encode_notification(resource, relation.request(resource), serializer)
+            if encoded[key] is None:
+                notifications.append(self.prepare_notification((resource, relation)) + (None,))
+                continue
+            template, rendered, options = encoded[key]
+            if template.payload is not None \
+                    and len(template.payload) > self._parent.endpoints.block_size((host, port), rendered):
+                notifications.append(self.prepare_notification((resource, relation)) + (None,))
+                continue
+            response = Response()
+            response.destination = relation.destination
+            response.token = relation.token
+            response.code = template.code
+            for option in template.options:
+                response.add_option(option)
+            response.payload = template.payload
+            self._parent.blockwise_layer.discard(hash(str(host) + str(port) + str(relation.token)))
+            # Reliability
+            response = self.reliability_response(relation, response, resource)
+            # Matcher
+            response = self._parent.message_layer.matcher_response(response)
+            token = str(response.token) if response.token is not None else ""
+            header = struct.pack("!BBH", (defines.VERSION << 6) | (response.type << 4) | len(token), response.code,
+                                 response.mid)
+            notifications.append((rendered, relation, response, header + token + options))
+        return notifications
+
+    def reliability_response(self, relation, response, resource):
+        """
+        Set the type of a notification according to the notification policy of the resource and record it in the
+        relation. The notifications are NON, a CON one is sent every count notifications or period seconds: if it is
+        not acknowledged the observer is removed.
+
+        :type relation: ObserveRelation
+        :param relation: the relation
+        :param response: the notification
+        :param resource: the observed resource
+        :return: the notification
+        """
+        count, period = resource.notification_policy or self._parent.notification_policy
+        now = int(round(time.time() * 1000))
+        if (count is not None and relation.con_counter + 1 >= count) or \
+                (period is not None and now - relation.con_timestamp >= period * 1000):
+            response.type = defines.inv_types['CON']
+            relation.con_counter = 0
+            relation.con_timestamp = now
+        else:
+            response.type = defines.inv_types['NON']
+            relation.con_counter += 1
+        relation.sequence = resource.observe_count
+        return response
+
+    def encode_notification(self, resource, request, serializer):
+        """
+        Render and encode the notification shared by the observers with the same Accept and Uri-Query.
+
+        :param resource: the resource updated
+        :param request: the request of one of the observers
+        :param serializer: the serializer
+        :return: (notification without token, rendered resource, encoded options and payload), None if the
+                 notification must be created for each observer
+        """
+        method = getattr(resource, 'render_GET', None)
+        if not hasattr(method, '__call__'):
+            return None
+        rendered = method(request)
+        if not isinstance(rendered, Resource):
+            return None
+        response = Response()
+        response.code = defines.responses['CONTENT']
+        option = Option()
+        option.number = defines.inv_options['Observe']
+        option.value = resource.observe_count
+        response.add_option(option)
+        try:
+            self._parent.resource_layer.set_representation(request, response, rendered)
+        except KeyError:
+            return None
+        response.type = defines.inv_types['NON']
+        response.mid = 0
+        datagram = serializer.serialize(response).raw
+        # skip the header, the message has no token
+        return response, rendered, datagram[4:]
 
     def prepare_notification(self, t):
         """
         Create the notification message.
 
-        :type t: (resource, request, old_response)
+        :type t: (resource, ObserveRelation)
         :param t: the arguments of the notification message
         :return: the notification message
         """
-        resource, request, old_response = t
+        resource, relation = t
         assert(isinstance(resource, Resource))
+        observed = resource
+        request = relation.request(resource)
         response = Response()
-        response.destination = old_response.destination
-        response.token = old_response.token
+        response.destination = relation.destination
+        response.token = relation.token
 
         option = Option()
         option.number = defines.inv_options['Observe']
@@ -92,72 +613,116 @@ class ObserveLayer(object):
             # Render_GET
             response.code = defines.responses['CONTENT']
             resource = method(request)
-            response.payload = resource.payload
-            # Blockwise
-            response, resource = self._parent.blockwise_response(request, response, resource)
-            host, port = request.source
-            key = hash(str(host) + str(port) + str(request.token))
-            if key in self._parent.blockwise:
-                del self._parent.blockwise[key]
-            # Reliability
-            request.acknowledged = True
-            response = self._parent.message_layer.reliability_response(request, response)
-            # Matcher
-            response = self._parent.message_layer.matcher_response(response)
-            return resource, request, response
+            try:
+                self._parent.resource_layer.set_representation(request, response, resource)
+            except KeyError:
+                response.code = defines.responses['NOT_ACCEPTABLE']
         else:
             response.code = defines.responses['METHOD_NOT_ALLOWED']
-            # Blockwise
-            response, resource = self._parent.blockwise_response(request, response, resource)
-            host, port = request.source
-            key = hash(str(host) + str(port) + str(request.token))
-            if key in self._parent.blockwise:
-                del self._parent.blockwise[key]
-            # Reliability
-            request.acknowledged = True
-            response = self._parent.message_layer.reliability_response(request, response)
-            # Matcher
-            response = self._parent.message_layer.matcher_response(response)
-            return resource, request, response
+        # Blockwise
+        response, resource = self._parent.blockwise_response(request, response, resource)
+        host, port = relation.destination
+        key = hash(str(host) + str(port) + str(relation.token))
+        self._parent.blockwise_layer.discard(key)
+        # Reliability
+        response = self.reliability_response(relation, response, observed)
+        # Matcher
+        response = self._parent.message_layer.matcher_response(response)
+        return resource, relation, response
 
     def prepare_notification_deletion(self, t):
         """
         Create the notification message for deleted resource.
 
-        :type t: (resource, request, old_response)
+        :type t: (resource, ObserveRelation)
         :param t: the arguments of the notification message
         :return: the notification message
         """
-        resource, request, old_response = t
+        resource, relation = t
+        observed = resource
+        request = relation.request(resource)
         response = Response()
-        response.destination = old_response.destination
-        response.token = old_response.token
+        response.destination = relation.destination
+        response.token = relation.token
         response.code = defines.responses['NOT_FOUND']
         response.payload = None
         # Blockwise
         response, resource = self._parent.blockwise_response(request, response, resource)
-        host, port = request.source
-        key = hash(str(host) + str(port) + str(request.token))
-        if key in self._parent.blockwise:
-            del self._parent.blockwise[key]
+        host, port = relation.destination
+        key = hash(str(host) + str(port) + str(relation.token))
+        self._parent.blockwise_layer.discard(key)
         # Reliability
-        request.acknowledged = True
-        response = self._parent.message_layer.reliability_response(request, response)
+        response = self.reliability_response(relation, response, observed)
         # Matcher
         response = self._parent.message_layer.matcher_response(response)
-        return resource, request, response
+        return resource, relation, response
 
-    def send_notification(self, t):
+    def send_notification(self, t, datagram=None):
         """
-        Sends a notification message.
+        Sends a notification message. If a CON notification to the same observer is still in transmission the new one
+        replaces it at its next retransmission (RFC 7641, 4.5.2), or right away if it is still queued behind other CON
+        messages to the observer, so at most one notification per observer is in flight.
 
-        :param t: (the resource, request, the notification message)
+        :param t: (the resource, the relation, the notification message)
+        :param datagram: the encoded notification, None to serialize it
         """
         assert isinstance(t, tuple)
-        resource, request, notification_message = t
-        host, port = notification_message.destination
-        self._parent.schedule_retrasmission(notification_message)
-        self._parent.send(notification_message, host, port)
+        resource, relation, notification_message = t
+        with self._lock:
+            pending = self._inflight.get(relation.key)
+            if pending is not None and not (pending[0].acknowledged or pending[0].rejected or pending[0].timeouted):
+                # carried by the ongoing transmission, which is confirmable
+                notification_message.type = defines.inv_types['CON']
+                relation.con_counter = 0
+                relation.con_timestamp = int(round(time.time() * 1000))
+                if self._parent.outbound_layer.replace(pending[0], notification_message):
+                    # not sent yet, the newer one takes its place in the queue
+                    pending[0] = notification_message
+                else:
+                    pending[1] = notification_message
+                return
+            if notification_message.type == defines.inv_types['CON']:
+                self._inflight[relation.key] = [notification_message, None]
+            else:
+                self._inflight.pop(relation.key, None)
+        self._parent.outbound_layer.send(notification_message, datagram)
+
+    def replace_notification(self, message):
+        """
+        Get the message to retransmit in place of a notification not acknowledged yet: the newest notification to the
+        same observer if the resource changed meanwhile, the retransmission counter and timeout go on.
+
+        :param message: the message to be retransmitted
+        :return: the message to retransmit
+        """
+        host, port = message.destination
+        key = (host, port, message.token)
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None or pending[0] is not message or pending[1] is None:
+                return message
+            replacement = pending[1]
+            self._inflight[key] = [replacement, None]
+            return replacement
+
+    def notification_acknowledged(self, message):
+        """
+        Handle the ACK of a notification: the newer notification waiting for it, if any, is sent.
+
+        :param message: the acknowledged message
+        """
+        host, port = message.destination
+        key = (host, port, message.token)
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None or pending[0] is not message:
+                return
+            replacement = pending[1]
+            if replacement is None:
+                del self._inflight[key]
+                return
+            self._inflight[key] = [replacement, None]
+        self._parent.outbound_layer.send(replacement)
 
     def add_observing(self, resource, request, response):
         """
@@ -168,25 +733,23 @@ class ObserveLayer(object):
         :param response: the response
         :return: response
         """
-        host, port = response.destination
-        key = hash(str(host) + str(port) + str(response.token))
-        observers = self._parent.relation.get(resource)
-        now = int(round(time.time() * 1000))
+        attributes = ObserveCondition.parse(request.query)
+        if attributes is None:
+            # conditional attributes not valid, answered without registering the observer
+            return response
         observe_count = resource.observe_count
-        if observers is None:
-            # log.msg("Initiate an observe relation between " + str(host) + ":" +
-            #        str(port) + " and resource " + str(resource.path))
-            observers = {key: (now, request, response)}
-        elif key not in observers:
-            # log.msg("Initiate an observe relation between " + str(host) + ":" +
-            #         str(port) + " and resource " + str(resource.path))
-            observers[key] = (now, request, response)
-        else:
-            # log.msg("Update observe relation between " + str(host) + ":" +
-            #         str(port) + " and resource " + str(resource.path))
-            old, request, response = observers[key]
-            observers[key] = (now, request, response)
-        self._parent.relation[resource] = observers
+        relation = ObserveRelation(request, response, observe_count)
+        key = relation.key
+        # a registration with the token of an existing one replaces it
+        self._parent.relation.add(resource, relation)
+        with self._lock:
+            if len(attributes) > 0:
+                condition = ObserveCondition(resource, attributes)
+                condition.value = self.value(resource)
+                self._conditions[key] = condition
+                self.schedule(key, condition)
+            else:
+                self._conditions.pop(key, None)
         option = Option()
         option.number = defines.inv_options['Observe']
         option.value = observe_count
@@ -202,17 +765,17 @@ class ObserveLayer(object):
         """
         commands = []
         # log.msg("Remove observers")
-        t = self._parent.root.from_prefix(path)
-        for n in t:
-            resource = self._parent.root[n]
-            observers = self._parent.relation.get(resource)
+        # only the observed resources are checked, not the whole tree
+        for resource in self._parent.relation.keys():
+            if resource.path is None or not resource.path.startswith(path):
+                continue
+            observers = self._parent.relation.remove_resource(resource)
             if observers is not None:
-                for item in observers.keys():
-                    old, request, response = observers[item]
+                for item, relation in observers.items():
                     # send notification
-                    commands.append((self._parent.prepare_notification_deletion, [(resource, request, response)], {}))
-                    del observers[item]
-                del self._parent.relation[resource]
+                    commands.append((self._parent.prepare_notification_deletion, [(resource, relation)], {}))
+                    with self._lock:
+                        self._conditions.pop(item, None)
         return commands
 
     def update_relations(self, path, resource):
@@ -226,22 +789,31 @@ class ObserveLayer(object):
         old_resource = self._parent.root[path]
         observers = self._parent.relation.get(old_resource)
         if observers is not None:
-            del self._parent.relation[old_resource]
-            self._parent.relation[resource] = observers
+            self._parent.relation.replace(old_resource, resource)
+            with self._lock:
+                for key in observers:
+                    condition = self._conditions.get(key)
+                    if condition is not None:
+                        condition.resource = resource
 
-    def remove_observer(self, resource, key):
+    def remove_observer(self, key):
         """
-        Remove an observer for a certain resource.
+        Remove an observer, e.g. after a RST, a deregistration or a notification not acknowledged.
 
-        :param response: the response message which has not been acknowledge
-        :param request: the request
-        :param resource: the resource
+        :param key: the (host, port, token) of the observer
+        :return: the resource it observed, None if the observer is not registered
         """
-        print "Remove observer for the resource"
-        observers = self._parent.relation.get(resource)
-        if observers is not None and key in observers.keys():
-            del observers[key]
-            self._parent.relation[resource] = observers
-        observers = self._parent.relation.get(resource)
-        if len(observers) == 0:
-            del self._parent.relation[resource]
+        with self._lock:
+            self._conditions.pop(key, None)
+            self._inflight.pop(key, None)
+        return self._parent.relation.remove(key)
+
+    def remove_endpoint(self, host, port):
+        """
+        Remove all the observers of an endpoint which does not answer anymore.
+
+        :param host: the host of the endpoint
+        :param port: the port of the endpoint
+        """
+        for key in self._parent.relation.endpoint(host, port):
+            self.remove_observer(key)
@@ -0,0 +1,133 @@
+import collections
+import threading
+import time
+from coapthon import defines
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class OutboundLayer(object):
+    """
+    Limits the CON messages outstanding to each client to NSTART (RFC 7252, 4.7). The following ones wait in a queue
+    per endpoint and are sent one at a time as the outstanding ones are acknowledged, rejected or given up. A queued
+    notification is replaced in place by a newer one to the same observer.
+    """
+    def __init__(self, parent):
+        """
+        Initialize an Outbound Layer.
+
+        :type parent: coapserver.CoAP
+        :param parent: the CoAP server
+        """
+        self._parent = parent
+        self._lock = threading.Lock()
+        # (host, port) -> MIDs of the CON messages waiting for their ACK, each one holds a slot
+        self._outstanding = {}
+        # (host, port) -> deque of [message, datagram] waiting to be sent
+        self._queues = {}
+
+    def send(self, message, datagram=None):
+        """
+        Send a message. A CON message is queued if NSTART CON messages to its endpoint are outstanding.
+
+        :param message: the message
+        :param datagram: the encoded message, None to serialize it
+        :return: True if the message has been sent, False if it has been queued
+        """
+        if message.type == defines.inv_types["CON"]:
+            endpoint = message.destination
+            with self._lock:
+                outstanding = self._outstanding.setdefault(endpoint, set())
+                if len(outstanding) >= self._parent.nstart:
+                    self._queues.setdefault(endpoint, collections.deque()).append([message, datagram])
+                    return False
+                outstanding.add(message.mid)
+        self._transmit(message, datagram)
+        return True
+
+    def replace(self, message, newer, datagram=None):
+        """
+        Replace a message still waiting in the queue, e.g. a notification superseded by a newer one.
+
+        :param message: the queued message
+        :param newer: the message to send in its place
+        :param datagram: the encoded newer message, None to serialize it
+        :return: True if the message has been replaced, False if it is not queued
+        """
+        with self._lock:
+            for entry in self._queues.get(message.destination, ()):
+                if entry[0] is message:
+                    entry[0] = newer
+                    entry[1] = datagram
+                    return True
+        return False
+
+    def transfer(self, message, newer):
+        """
+        Pass the slot of an outstanding CON message to the message retransmitted in its place, e.g. a notification
+        superseded by a newer one. A late ACK of the former message no longer frees the slot.
+
+        :param message: the outstanding message
+        :param newer: the message retransmitted in its place
+        """
+        with self._lock:
+            outstanding = self._outstanding.get(message.destination)
+            if outstanding is not None and message.mid in outstanding:
+                outstanding.discard(message.mid)
+                outstanding.add(newer.mid)
+
+    def release(self, message):
+        """
+        Free the slot of a CON message acknowledged, rejected or given up, the next queued message is sent. Nothing
+        happens if the message does not hold a slot, e.g. it has been released already.
+
+        :param message: the message
+        """
+        if message.type != defines.inv_types["CON"]:
+            return
+        endpoint = message.destination
+        entry = None
+        with self._lock:
+            outstanding = self._outstanding.get(endpoint)
+            if outstanding is None or message.mid not in outstanding:
+                return
+            outstanding.discard(message.mid)
+            queue = self._queues.get(endpoint)
+            if queue:
+                entry = queue.popleft()
+                outstanding.add(entry[0].mid)
+                if len(queue) == 0:
+                    del self._queues[endpoint]
+            if len(outstanding) == 0:
+                del self._outstanding[endpoint]
+        if entry is not None:
+            self._transmit(*entry)
+
+    def queued(self, endpoint):
+        """
+        Get the number of messages waiting to be sent to an endpoint.
+
+        :param endpoint: the (host, port) of the endpoint
+        :return: the number of queued messages
+        """
+        with self._lock:
+            return len(self._queues.get(endpoint, ()))
+
+    def _transmit(self, message, datagram):
+        """
+        Send a message and schedule its retransmission if it is CON.
+
+        :param message: the message
+        :param datagram: the encoded message, None to serialize it
+        """
+        host, port = message.destination
+        if message.type == defines.inv_types["CON"]:
+            # the RTT is measured from the transmission, not from the time spent in the queue
+            key = hash(str(host) + str(port) + str(message.mid))
+            self._parent.sent[key] = (message, time.time(), 0)
+            self._parent.schedule_retrasmission(message)
+        if datagram is None:
+            self._parent.send(message, host, port)
+        else:
+            self._parent.send_datagram(datagram, host, port)
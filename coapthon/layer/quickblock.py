@@ -0,0 +1,457 @@
+import collections
+import socket
+import threading
+import time
+import zlib
+from coapthon import defines
+from coapthon.messages.message import Message
+from coapthon.messages.response import Response
+from coapthon.utils import encode_missing_blocks
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class QuickBlockSession(object):
+    """
+    State of a Q-Block transfer (RFC 9177). A Q-Block2 transfer keeps the snapshot of the representation and the
+    progress of the burst in flight, a Q-Block1 transfer the blocks received so far, in any order.
+    """
+    __slots__ = ("block", "size", "timestamp", "destination", "token", "path", "node", "version", "resource",
+                 "source", "etag", "content_type", "max_age", "snapshot", "next", "in_burst", "running", "event",
+                 "blocks", "body", "length", "reserved", "last", "timer", "retries")
+
+    def __init__(self, block, request, size):
+        """
+        Initialize a transfer.
+
+        :param block: 1 for Q-Block1, 2 for Q-Block2
+        :param request: the request starting the transfer
+        :param size: the block size
+        """
+        self.block = block
+        self.size = size
+        self.timestamp = time.time()
+        self.destination = request.source
+        self.token = request.token
+        # Q-Block2, see BlockwiseLayer.snapshot
+        self.path = None
+        self.node = None
+        self.version = None
+        self.resource = None
+        self.source = None
+        self.etag = None
+        self.content_type = None
+        self.max_age = None
+        self.snapshot = None
+        # Q-Block2: the next block of the burst, the blocks sent in the current set and if a burst is in flight
+        self.next = 1
+        self.in_burst = 1
+        self.running = False
+        # set when the client asks for the next set before NON_TIMEOUT
+        self.event = threading.Event()
+        # Q-Block1: the numbers of the blocks received, the body reassembled by the BlockwiseLayer, the bytes received
+        # and the memory reserved, the number of the last block
+        self.blocks = None
+        self.body = None
+        self.length = 0
+        self.reserved = 0
+        self.last = None
+        # Q-Block1: the timer asking for the missing blocks and how many times they have been asked for
+        self.timer = None
+        self.retries = 0
+
+
+class QuickBlockLayer(object):
+    """
+    Handles the Q-Block1 and Q-Block2 options (RFC 9177). The blocks of a Q-Block2 response are sent as NON
+    messages in bursts of MAX_PAYLOADS without waiting for a request per block, the missing ones are sent again
+    when the client asks for them. The blocks of a Q-Block1 request are accepted in any order and the missing
+    ones are asked for with a 4.08 response after NON_RECEIVE_TIMEOUT.
+
+    All the blocks of a transfer carry the token of the request which started it, and the requests asking for
+    missing blocks must use the same token.
+    """
+
+    def __init__(self, parent):
+        """
+        Initialize a Q-Block Layer.
+
+        :type parent: coapserver.CoAP
+        :param parent: the CoAP server
+        """
+        self._parent = parent
+        self._lock = threading.RLock()
+        # key -> QuickBlockSession, the least recently used transfers are the first ones
+        self._sessions = collections.OrderedDict()
+
+    @staticmethod
+    def _key(message):
+        host, port = message.source
+        return hash(str(host) + str(port) + str(message.token))
+
+    def get(self, key):
+        """
+        Get a transfer which is not expired.
+
+        :param key: the key of the transfer
+        :return: the transfer or None
+        """
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session.timestamp + defines.BLOCKWISE_SESSION_LIFETIME < time.time():
+                self.discard(key)
+                return None
+            return session
+
+    def store(self, key, session):
+        """
+        Store a transfer as the most recently used one and drop the least recently used transfers beyond
+        MAX_BLOCKWISE_SESSIONS.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        """
+        with self._lock:
+            session.timestamp = time.time()
+            old = self._sessions.pop(key, None)
+            if old is not None and old is not session:
+                self._drop(old)
+            self._sessions[key] = session
+            while len(self._sessions) > defines.MAX_BLOCKWISE_SESSIONS:
+                self._drop(self._sessions.popitem(last=False)[1])
+
+    def discard(self, key):
+        """
+        Remove a transfer.
+
+        :param key: the key of the transfer
+        """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                self._drop(session)
+
+    def purge(self, now=None):
+        """
+        Remove the idle transfers.
+
+        :param now: the current time
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            while len(self._sessions) > 0:
+                key, session = next(self._sessions.iteritems())
+                if session.timestamp + defines.BLOCKWISE_SESSION_LIFETIME >= now:
+                    break
+                del self._sessions[key]
+                self._drop(session)
+
+    def _drop(self, session):
+        """
+        Stop the timer and the burst of a dropped transfer, release the body of an upload.
+
+        :param session: the transfer
+        """
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        if session.block == 1:
+            self._parent.blockwise_layer.drop_body(session)
+        session.blocks = None
+        session.snapshot = None
+        session.event.set()
+
+    def start_block2(self, request, response, resource):
+        """
+        Start a Q-Block2 transfer if the representation does not fit in a block. The first block is returned and
+        the following ones are sent as NON messages.
+
+        :param request: the request message, with a Q-Block2 option
+        :param response: the response message, with the representation as payload
+        :param resource: the rendered resource, None if the payload is not produced by a resource
+        :return: the response
+        """
+        host, port = request.source
+        num, m, size = request.q_block2[0]
+        size = min(size, self._parent.endpoints.block_size((host, port), resource))
+        session = QuickBlockSession(2, request, size)
+        self._parent.blockwise_layer.snapshot(session, request, response, resource)
+        if num == 0 and len(session.snapshot) <= size:
+            return response
+        if session.etag is None:
+            # the blocks of a representation are tied by its ETag
+            session.etag = "%08x" % (zlib.crc32(session.snapshot.tobytes()) & 0xFFFFFFFF)
+            response.etag = session.etag
+        if resource is not None:
+            session.max_age = resource.max_age
+        key = self._key(request)
+        self.store(key, session)
+        response.payload = None
+        self._block(session, num, response)
+        if num == 0 or m == 1:
+            self._continue(key, session, num + 1)
+        return response
+
+    def serve(self, request, response):
+        """
+        Serve the blocks asked by a Q-Block2 request from the snapshot of a transfer in progress. A block with the
+        M bit asks for the following ones too, the others are missing blocks. A request for the block 0 with the M
+        bit starts a new transfer.
+
+        :param request: the request message
+        :param response: the response message
+        :return: the response with the first block asked for, or None if the resource must be rendered
+        """
+        requested = request.q_block2
+        if len(requested) == 0:
+            return None
+        key = self._key(request)
+        path = str("/" + request.uri_path)
+        with self._lock:
+            session = self.get(key)
+            if session is None or session.block != 2 or session.path != path:
+                return None
+            if len(requested) == 1 and requested[0][0] == 0 and requested[0][1] == 1:
+                self.discard(key)
+                return None
+            blocks = len(session.snapshot) // session.size + (1 if len(session.snapshot) % session.size else 0)
+            nums = [num for num, m, size in requested if num < blocks]
+            if len(nums) == 0:
+                self.discard(key)
+                return self._parent.send_error(request, response, 'REQUEST_ENTITY_INCOMPLETE')
+            self.store(key, session)
+            response.code = defines.responses['CONTENT']
+            response.token = request.token
+            self._headers(session, response)
+            self._block(session, nums[0], response)
+            if requested[-1][1] == 1:
+                # the last block asked for and the following ones
+                self._continue(key, session, requested[-1][0] + 1)
+        for num in nums[1:]:
+            self._send_block(session, num)
+        response = self._parent.message_layer.reliability_response(request, response)
+        response = self._parent.message_layer.matcher_response(response)
+        return response
+
+    def _block(self, session, num, response):
+        """
+        Put a block of the snapshot in a response.
+
+        :param session: the transfer
+        :param num: the block number
+        :param response: the response message
+        """
+        start = num * session.size
+        m = 1 if start + session.size < len(session.snapshot) else 0
+        response.del_option_name("Q-Block2")
+        response.add_q_block2(num, m, session.size)
+        response.payload = session.snapshot[start:start + session.size]
+
+    @staticmethod
+    def _headers(session, response):
+        """
+        Put the options describing the representation in a response carrying one of its blocks.
+
+        :param session: the transfer
+        :param response: the response message
+        """
+        response.etag = session.etag
+        if session.content_type is not None:
+            response.content_type = session.content_type
+        if session.max_age is not None:
+            response.max_age = session.max_age
+
+    def _send_block(self, session, num):
+        """
+        Send a block of the snapshot as a NON message.
+
+        :param session: the transfer
+        :param num: the block number
+        """
+        response = Response()
+        response.type = defines.inv_types["NON"]
+        response.code = defines.responses['CONTENT']
+        response.token = session.token
+        response.destination = session.destination
+        self._headers(session, response)
+        self._block(session, num, response)
+        response = self._parent.message_layer.matcher_response(response)
+        host, port = session.destination
+        self._parent.send(response, host, port)
+
+    def _continue(self, key, session, num):
+        """
+        Send the blocks from num on, in bursts of MAX_PAYLOADS. The first block of the set has already been sent.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        :param num: the first block to send
+        """
+        with self._lock:
+            session.next = num
+            session.in_burst = 1
+            session.event.set()
+            if session.running:
+                return
+            session.running = True
+        self._parent.pending_futures.append(self._parent.executor.submit(self._burst, key, session))
+
+    def _burst(self, key, session):
+        """
+        Send the blocks of a Q-Block2 transfer, waiting NON_TIMEOUT or the request of the next set from the
+        client after MAX_PAYLOADS blocks. Executed in a thread.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        """
+        while True:
+            with self._lock:
+                if self._sessions.get(key) is not session or session.snapshot is None or \
+                        session.next * session.size >= len(session.snapshot):
+                    session.running = False
+                    return
+                num = session.next
+                session.next += 1
+                session.in_burst += 1
+                end_of_set = session.in_burst >= defines.MAX_PAYLOADS
+                if end_of_set:
+                    session.event.clear()
+            stopped = self._parent.stopped.isSet()
+            if not stopped:
+                try:
+                    self._send_block(session, num)
+                except socket.error:
+                    # the server has been closed meanwhile
+                    stopped = True
+            if stopped:
+                with self._lock:
+                    session.running = False
+                return
+            if end_of_set:
+                session.event.wait(defines.NON_TIMEOUT)
+                with self._lock:
+                    if session.in_burst >= defines.MAX_PAYLOADS:
+                        # NON_TIMEOUT expired, go on with the next set
+                        session.in_burst = 0
+
+    def handle_block1(self, request):
+        """
+        Add a block to a Q-Block1 upload. The request is processed only when all the blocks have been received,
+        with the whole body as payload. A 2.31 response is sent when a set of MAX_PAYLOADS blocks is complete.
+
+        :param request: the request message
+        :return: the request to be processed, the response to the block or None if no response is due
+        """
+        num, m, size = request.q_block1
+        key = self._key(request)
+        payload = request.payload if request.payload is not None else ""
+        with self._lock:
+            session = self.get(key)
+            if session is None or session.block != 1:
+                session = QuickBlockSession(1, request, size)
+                session.blocks = set()
+                # Q-Block1: the first block of the set following the last one confirmed with 2.31
+                session.next = 0
+            if size != session.size:
+                self.discard(key)
+                return self._error(request, 'REQUEST_ENTITY_INCOMPLETE')
+            total = num * size + len(payload)
+            if request.size1 is not None:
+                total = max(total, request.size1)
+            if total > defines.MAX_UPLOAD_SIZE:
+                self.discard(key)
+                return self._error(request, 'REQUEST_ENTITY_TOO_LARGE')
+            if num not in session.blocks:
+                # charged to the memory of the Block1 uploads, spilled to a temporary file as they are
+                if not self._parent.blockwise_layer.write(session, num * size, payload, total):
+                    self.discard(key)
+                    return self._error(request, 'REQUEST_ENTITY_TOO_LARGE')
+                session.blocks.add(num)
+            if m == 0:
+                session.last = num
+            session.retries = 0
+            if session.last is not None and len(session.blocks) == session.last + 1:
+                # complete, the request is processed with the whole body
+                request.payload = self._parent.blockwise_layer.body(session)
+                self.discard(key)
+                return request
+            self.store(key, session)
+            self._arm(key, session)
+            # the blocks may be received in any order
+            end = (num // defines.MAX_PAYLOADS + 1) * defines.MAX_PAYLOADS
+            complete_set = end > session.next and all(i in session.blocks for i in xrange(end))
+            if complete_set:
+                session.next = end
+        if complete_set:
+            response = Response()
+            response.destination = request.source
+            response.code = defines.responses["CONTINUE"]
+            response.token = request.token
+            response.q_block1 = (end - 1, 1, size)
+            response = self._parent.message_layer.reliability_response(request, response)
+            response = self._parent.message_layer.matcher_response(response)
+            return response
+        if request.type == defines.inv_types["CON"]:
+            request.acknowledged = True
+            return Message.new_ack(request)
+        return None
+
+    def _arm(self, key, session):
+        """
+        (Re)start the timer asking for the missing blocks of a Q-Block1 upload.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        """
+        if session.timer is not None:
+            session.timer.cancel()
+        session.timer = threading.Timer(defines.NON_RECEIVE_TIMEOUT, self._missing, (key, session))
+        session.timer.daemon = True
+        session.timer.start()
+
+    def _missing(self, key, session):
+        """
+        Ask for the missing blocks of a Q-Block1 upload with a 4.08 response listing them. The block following the
+        last one received is listed if the end of the body has not been received yet.
+
+        :param key: the key of the transfer
+        :param session: the transfer
+        """
+        with self._lock:
+            if self._sessions.get(key) is not session or session.blocks is None:
+                return
+            session.retries += 1
+            if session.retries > defines.NON_MAX_RETRANSMIT:
+                self.discard(key)
+                return
+            highest = max(session.blocks)
+            missing = [i for i in xrange(highest) if i not in session.blocks]
+            if session.last is None:
+                missing.append(highest + 1)
+            self._arm(key, session)
+        response = Response()
+        response.type = defines.inv_types["NON"]
+        response.code = defines.responses["REQUEST_ENTITY_INCOMPLETE"]
+        response.token = session.token
+        response.destination = session.destination
+        response.payload = (defines.inv_content_types["application/missing-blocks+cbor-seq"],
+                            encode_missing_blocks(missing))
+        response = self._parent.message_layer.matcher_response(response)
+        host, port = session.destination
+        if self._parent.stopped.isSet():
+            return
+        try:
+            self._parent.send(response, host, port)
+        except socket.error:
+            # the server has been closed meanwhile
+            pass
+
+    def _error(self, request, error):
+        response = Response()
+        response.destination = request.source
+        response = self._parent.send_error(request, response, error)
+        if error == 'REQUEST_ENTITY_TOO_LARGE':
+            response.size1 = defines.MAX_UPLOAD_SIZE
+        return response
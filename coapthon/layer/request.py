@@ -30,20 +30,27 @@ class RequestLayer(object):
         host, port = request.source
         key = hash(str(host) + str(port) + str(request.mid))
         if key not in self._parent.received:
+            self._parent.endpoints.delivered((host, port))
             if request.blockwise:
-                # Blockwise
-                last, request = self._parent.blockwise_layer.handle_request(request)
+                # Blockwise, a Block1 request is processed only when the body is complete
+                last, ret = self._parent.blockwise_layer.handle_request(request)
                 self._parent.received[key] = (request, time.time())
-                return request
+                return ret
+            elif request.q_block1 is not None:
+                # Q-Block1, the blocks are accepted in any order
+                self._parent.received[key] = (request, time.time())
+                return self._parent.quickblock_layer.handle_block1(request)
             else:
                 self._parent.received[key] = (request, time.time())
                 return request
         else:
+            # the client retransmitted, the request or its answer has been lost
+            self._parent.endpoints.lost((host, port))
             request, timestamp = self._parent.received.get(key)
             request.duplicated = True
             self._parent.received[key] = (request, timestamp)
             try:
-                response, timestamp = self._parent.sent.get(key)
+                response, timestamp, retransmissions = self._parent.sent.get(key)
             except TypeError:
                 response = None
             if isinstance(response, Response):
@@ -153,6 +160,13 @@ class RequestLayer(object):
         if path == defines.DISCOVERY_URL:
             response = self._parent.resource_layer.discover(request, response)
         else:
+            # Blockwise transfer in progress
+            ret = self._parent.blockwise_layer.serve_block2(request, response)
+            if ret is None:
+                # Q-Block2 transfer in progress
+                ret = self._parent.quickblock_layer.serve(request, response)
+            if ret is not None:
+                return ret
             try:
                 resource = self._parent.root[path]
             except KeyError:
@@ -1,4 +1,5 @@
 from coapthon import defines
+from coapthon.resources.link_format import LinkFormatIndex
 from coapthon.resources.resource import Resource
 
 __author__ = 'Giacomo Tanganelli'
@@ -17,6 +18,8 @@ class ResourceLayer(object):
         :param parent: the CoAP server
         """
         self._parent = parent
+        self.link_format = LinkFormatIndex()
+        self._parent.root.add_listener(self.link_format)
 
     def edit_resource(self, request, response, path):
         """
@@ -40,6 +43,8 @@ class ResourceLayer(object):
                 pass
             elif isinstance(resource, int):
                 return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
+            elif isinstance(resource, str) and resource in defines.responses:
+                return self._parent.send_error(request, response, resource)
             elif isinstance(resource, tuple) and len(resource) == 2:
                 resource, callback = resource
                 separate = True
@@ -56,6 +61,10 @@ class ResourceLayer(object):
                 if not isinstance(resource, Resource):
                     return self._parent.send_error(request, response, 'INTERNAL_SERVER_ERROR')
 
+            if resource.path is not None and resource.path.startswith(path + "/"):
+                # render_POST created a new resource below the target, e.g. a registration in a collection
+                return self.register_resource(request, response, resource, resource.path)
+
             resource.path = path
             resource.observe_count = resource_node.observe_count
 
@@ -112,6 +121,8 @@ class ResourceLayer(object):
                 pass
             elif isinstance(resource, int):
                 return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
+            elif isinstance(resource, str) and resource in defines.responses:
+                return self._parent.send_error(request, response, resource)
             elif isinstance(resource, tuple) and len(resource) == 2:
                 resource, callback = resource
                 separate = True
@@ -128,36 +139,48 @@ class ResourceLayer(object):
                 if not isinstance(resource, Resource):
                     return self._parent.send_error(request, response, 'INTERNAL_SERVER_ERROR')
 
-            resource.path = lp
+            return self.register_resource(request, response, resource, lp)
 
-            if resource.etag is not None:
-                response.etag = resource.etag
+        else:
+            return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
 
-            response.location_path = lp
+    def register_resource(self, request, response, resource, lp):
+        """
+        Add a resource created by a POST request to the server and fill the 2.01 response.
 
-            if resource.location_query is not None and len(resource.location_query) > 0:
-                response.location_query = resource.location_query
+        :param request: the request
+        :param response: the response
+        :param resource: the new resource
+        :param lp: the location_path attribute of the resource
+        :return: the response
+        """
+        resource.path = lp
 
-            response.code = defines.responses['CREATED']
-            response.payload = None
+        if resource.etag is not None:
+            response.etag = resource.etag
 
-            # Token
-            response.token = request.token
+        response.location_path = lp
 
-            # Blockwise
-            response, resource = self._parent.blockwise_response(request, response, resource)
+        if resource.location_query is not None and len(resource.location_query) > 0:
+            response.location_query = resource.location_query
 
-            # Reliability
-            response = self._parent.message_layer.reliability_response(request, response)
-            # Matcher
-            response = self._parent.message_layer.matcher_response(response)
+        response.code = defines.responses['CREATED']
+        response.payload = None
 
-            self._parent.root[lp] = resource
+        # Token
+        response.token = request.token
 
-            return response
+        # Blockwise
+        response, resource = self._parent.blockwise_response(request, response, resource)
 
-        else:
-            return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
+        # Reliability
+        response = self._parent.message_layer.reliability_response(request, response)
+        # Matcher
+        response = self._parent.message_layer.matcher_response(response)
+
+        self._parent.root[lp] = resource
+
+        return response
 
     def create_resource(self, path, request, response):
         """
@@ -213,6 +236,8 @@ class ResourceLayer(object):
                 pass
             elif isinstance(resource, int):
                 return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
+            elif isinstance(resource, str) and resource in defines.responses:
+                return self._parent.send_error(request, response, resource)
             elif isinstance(resource, tuple) and len(resource) == 2:
                 resource, callback = resource
                 separate = True
@@ -302,12 +327,8 @@ class ResourceLayer(object):
         """
         method = getattr(resource, 'render_GET', None)
         if hasattr(method, '__call__'):
-            resource.required_content_type = None
             # Accept
-            if request.accept is not None:
-                resource.required_content_type = request.accept
-                if resource.required_content_type in defines.content_types:
-                    response.content_type = resource.required_content_type
+            resource.required_content_type = request.accept
             # Render_GET
             timer = self._parent.message_layer.start_separate_timer(request)
             resource = method(request=request)
@@ -318,6 +339,8 @@ class ResourceLayer(object):
                 pass
             elif isinstance(resource, int):
                 return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
+            elif isinstance(resource, str) and resource in defines.responses:
+                return self._parent.send_error(request, response, resource)
             elif isinstance(resource, tuple) and len(resource) == 2:
                 resource, callback = resource
                 separate = True
@@ -339,7 +362,7 @@ class ResourceLayer(object):
                 response.code = defines.responses['CONTENT']
 
             try:
-                response.payload = resource.payload
+                self.set_representation(request, response, resource)
             except KeyError:
                 return self._parent.send_error(request, response, 'NOT_ACCEPTABLE')
 
@@ -356,6 +379,10 @@ class ResourceLayer(object):
             # Observe
             if request.observe == 0 and resource.observable:
                 response = self._parent.observe_layer.add_observing(resource, request, response)
+            elif request.observe == 1:
+                # deregistration
+                host, port = request.source
+                self._parent.observe_layer.remove_observer((host, port, request.token))
 
             response = self._parent.message_layer.reliability_response(request, response)
             response = self._parent.message_layer.matcher_response(response)
@@ -364,6 +391,22 @@ class ResourceLayer(object):
         else:
             return self._parent.send_error(request, response, 'METHOD_NOT_ALLOWED')
 
+    @staticmethod
+    def set_representation(request, response, resource):
+        """
+        Put in the response the cached representation of the resource negotiated with the Accept option.
+
+        :param request: the request
+        :param response: the response
+        :param resource: the resource
+        :raise KeyError: if the representation required by the Accept option is not available
+        """
+        content_type, payload = resource.representation(request.accept)
+        if content_type is not None and (request.accept is not None or
+                                         content_type != defines.inv_content_types["text/plain"]):
+            response.content_type = content_type
+        response.payload = payload
+
     def discover(self, request, response):
         """
         Render a GET request to the .well-know/core link.
@@ -373,16 +416,7 @@ class ResourceLayer(object):
         :return: the response
         """
         response.code = defines.responses['CONTENT']
-        payload = ""
-        for i in self._parent.root.dump():
-            if i == "/":
-                continue
-            resource = self._parent.root[i]
-            ret = self.valid(request.query, resource.attributes)
-            if ret:
-                payload += self.corelinkformat(resource)
-
-        response.payload = payload
+        response.payload = self.link_format.document(request.query)
         response.content_type = defines.inv_content_types["application/link-format"]
         response.token = request.token
         # Blockwise
@@ -390,41 +424,3 @@ class ResourceLayer(object):
         response = self._parent.message_layer.reliability_response(request, response)
         response = self._parent.message_layer.matcher_response(response)
         return response
-
-    @staticmethod
-    def valid(query, attributes):
-        for q in query:
-            q = str(q)
-            assert(isinstance(q, str))
-            tmp = q.split("=")
-            if len(tmp) > 1:
-                k = tmp[0]
-                v = tmp[1]
-                if k in attributes:
-                    if v == attributes[k]:
-                        continue
-                    else:
-                        return False
-                else:
-                    return False
-        return True
-
-    @staticmethod
-    def corelinkformat(resource):
-        """
-        Return a formatted string representation of the corelinkformat in the tree.
-
-        :return: the string
-        """
-        msg = "<" + resource.path + ">;"
-        assert(isinstance(resource, Resource))
-        for k in resource.attributes:
-            method = getattr(resource, defines.corelinkformat[k], None)
-            if method is not None and method != "":
-                v = method
-                msg = msg[:-1] + ";" + str(v) + ","
-            else:
-                v = resource.attributes[k]
-                if v is not None:
-                    msg = msg[:-1] + ";" + k + "=" + v + ","
-        return msg
\ No newline at end of file
@@ -1,6 +1,6 @@
 from coapthon import defines
 from coapthon.messages.option import Option
-from coapthon.utils import parse_blockwise
+from coapthon.utils import parse_blockwise, blockwise_value
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
@@ -40,6 +40,8 @@ class Message(object):
         self._canceled = False
         # Indicates if the message is a duplicate.
         self._duplicate = False
+        # Indicates if the message has been retransmitted.
+        self._retransmitted = False
         # The timestamp
         self._timestamp = None
         # The code
@@ -183,6 +185,24 @@ class Message(object):
         """
         self._duplicate = d
 
+    @property
+    def retransmitted(self):
+        """
+        Checks if this message has been retransmitted.
+
+        :return: True, if has been retransmitted
+        """
+        return self._retransmitted
+
+    @retransmitted.setter
+    def retransmitted(self, r):
+        """
+        Marks this message as retransmitted, its acknowledgement gives no RTT sample.
+
+        :param r: if retransmitted
+        """
+        self._retransmitted = r
+
     @property
     def acknowledged(self):
         """
@@ -414,6 +434,56 @@ class Message(object):
         self.del_option_name("Observe")
         self.add_option(option)
 
+    @property
+    def size1(self):
+        """
+        Get the Size1 option.
+
+        :return: the Size1 value or None if not specified by the message
+        """
+        for option in self.options:
+            if option.number == defines.inv_options['Size1']:
+                return option.value
+        return None
+
+    @size1.setter
+    def size1(self, size):
+        """
+        Set the Size1 option.
+
+        :param size: the size in bytes
+        """
+        option = Option()
+        option.number = defines.inv_options['Size1']
+        option.value = size
+        self.del_option_name("Size1")
+        self.add_option(option)
+
+    @property
+    def size2(self):
+        """
+        Get the Size2 option.
+
+        :return: the Size2 value or None if not specified by the message
+        """
+        for option in self.options:
+            if option.number == defines.inv_options['Size2']:
+                return option.value
+        return None
+
+    @size2.setter
+    def size2(self, size):
+        """
+        Set the Size2 option.
+
+        :param size: the size in bytes, 0 in a request to ask for it
+        """
+        option = Option()
+        option.number = defines.inv_options['Size2']
+        option.value = size
+        self.del_option_name("Size2")
+        self.add_option(option)
+
     @property
     def block1(self):
         """
@@ -461,3 +531,54 @@ class Message(object):
 
         option.value = value
         self.add_option(option)
+
+    @property
+    def q_block1(self):
+        """
+        Get the Q-Block1 option.
+
+        :return: (num, m, size) or None if not specified by the message
+        """
+        for option in self.options:
+            if option.number == defines.inv_options['Q-Block1']:
+                return parse_blockwise(option.raw_value)
+        return None
+
+    @q_block1.setter
+    def q_block1(self, value):
+        """
+        Set the Q-Block1 option.
+
+        :param value: the Q-Block1 value, (num, m, size)
+        """
+        option = Option()
+        option.number = defines.inv_options['Q-Block1']
+        option.value = blockwise_value(*value)
+        self.del_option_name("Q-Block1")
+        self.add_option(option)
+
+    @property
+    def q_block2(self):
+        """
+        Get the Q-Block2 options. A request carries one of them for each missing block it asks for.
+
+        :return: the list of (num, m, size)
+        """
+        value = []
+        for option in self.options:
+            if option.number == defines.inv_options['Q-Block2']:
+                value.append(parse_blockwise(option.raw_value))
+        return value
+
+    def add_q_block2(self, num, m, size):
+        """
+        Add a Q-Block2 option.
+
+        :param num: the block number
+        :param m: the M bit
+        :param size: the block size
+        """
+        option = Option()
+        option.number = defines.inv_options['Q-Block2']
+        option.value = blockwise_value(num, m, size)
+        self.add_option(option)
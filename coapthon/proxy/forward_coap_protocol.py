@@ -1,57 +1,89 @@
-import copy
-import hashlib
+import functools
+import heapq
 import random
-from threading import Timer
+import socket
+import threading
+import time
 from coapthon import defines
-from coapthon.client.coap_synchronous import HelperClientSynchronous
+from coapthon.client.multiplex import MultiplexClient
+from coapthon.endpoint import EndpointRegistry
 from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
 from coapthon.serializer import Serializer
 from coapthon.server.coap_protocol import CoAP
+from coapthon.utils import parse_uri, read_payload
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
 
 class ProxyCoAP(CoAP):
-    def __init__(self, server_address, multicast=False):
+    """
+    A CoAP forward proxy. The requests are forwarded through a single MultiplexClient, which keeps the RTT statistics
+    of each upstream server, and the handler returns as soon as the request is sent: the response is relayed by the
+    receiving thread of the client. A CON request still waiting for its response after SEPARATE_TIMEOUT is
+    acknowledged by the timer thread, and the response follows as a separate CON.
+    """
+    def __init__(self, server_address, multicast=False, client=None):
         """
         Initialize the CoAP protocol
 
+        :param server_address: the (host, port) of the proxy
+        :param multicast: True to join the multicast group
+        :param client: the MultiplexClient reaching the upstream servers, a new one by default
         """
         CoAP.__init__(self, server_address, multicast)
+        self._own_client = client is None
+        self.client = client if client is not None else MultiplexClient(endpoints=EndpointRegistry())
+        # kept by the reverse proxy: token -> request, mid -> request
         self._forward = {}
         self._forward_mid = {}
-        self._token = random.randint(1, 1000)
-        self.timer = {}
+        self._token = random.getrandbits(32)
+        self._lock = threading.Lock()
+        # (due, counter, request) of the CON requests to acknowledge if their response is late
+        self._acks = []
+        self._acks_counter = 0
+        self._acks_condition = threading.Condition(self._lock)
+        self._acks_thread = threading.Thread(target=self._separate)
+        self._acks_thread.daemon = True
+        self._acks_thread.start()
+
+    def close(self):
+        """
+        Stop the proxy, the client is closed if it has been created by the proxy.
+        """
+        CoAP.close(self)
+        with self._acks_condition:
+            self._acks_condition.notify()
+        self._acks_thread.join(timeout=2)
+        if self._own_client:
+            self.client.close()
+
+    def finish_request(self, args):
+        """
+        Handler for received UDP datagram.
 
-    def finish_request(self, request, client_address):
-       
-        
+        :param args: (data, (client_ip, client_port)
+        :return: the message to send at once, host and port, None if there is nothing to send
+        """
+        data, client_address = args
         host = client_address[0]
         port = client_address[1]
-        data = request[0]
-        self.socket = request[1]
- 
-        # log.msg("Datagram received from " + str(host) + ":" + str(port))
+
         serializer = Serializer()
         message = serializer.deserialize(data, host, port)
-        # print "Message received from " + host + ":" + str(port)
-        # print "----------------------------------------"
-        # print message
-        # print "----------------------------------------"
         if isinstance(message, Request):
-            # log.msg("Received request")
             ret = self.request_layer.handle_request(message)
             if isinstance(ret, Request):
-                self.forward_request(ret)
+                ret = self.forward_request(ret)
+            if ret is None:
+                return None
+            return ret, host, port
         elif isinstance(message, Response):
-            # log.err("Received response")
             rst = Message.new_rst(message)
             rst = self.message_layer.matcher_response(rst)
-            # log.msg("Send RST")
-            self.send(rst, host, port)
+            return rst, host, port
         elif isinstance(message, tuple):
             message, error = message
             response = Response()
@@ -59,234 +91,132 @@ class ProxyCoAP(CoAP):
             response.code = defines.responses[error]
             response = self.message_layer.reliability_response(message, response)
             response = self.message_layer.matcher_response(response)
-            # log.msg("Send Error")
-            self.send(response, host, port)
+            return response, host, port
         elif message is not None:
             # ACK or RST
-            # log.msg("Received ACK or RST")
             self.message_layer.handle_message(message)
-
-    def parse_path(self, path):
-        return self.parse_path_ipv6(path)
-        # m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*):([0-9]*)/(\S*)", path)
-        # if m is None:
-        #     m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*)/(\S*)", path)
-        #     if m is None:
-        #         m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.]*)", path)
-        #         if m is None:
-        #             ip, port, path = self.parse_path_ipv6(path)
-        #         else:
-        #             ip = m.group(2)
-        #             port = 5683
-        #             path = ""
-        #     else:
-        #         ip = m.group(2)
-        #         port = 5683
-        #         path = m.group(3)
-        # else:
-        #     ip = m.group(2)
-        #     port = int(m.group(3))
-        #     path = m.group(4)
-        #
-        # return ip, port, path
-
-    @staticmethod
-    def parse_path_ipv6(path):
-        m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]:([0-9]*)/(\S*)", path)
-        if m is None:
-            m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]/(\S*)", path)
-            if m is None:
-                m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:]*)\]", path)
-                ip = m.group(2)
-                port = 5683
-                path = ""
-            else:
-                ip = m.group(2)
-                port = 5683
-                path = m.group(3)
-        else:
-            ip = m.group(2)
-            port = int(m.group(3))
-            path = m.group(4)
-
-        return ip, port, path
+            return None
 
     def forward_request(self, request):
         """
-        Forward an incoming request to the specified server.
+        Forward an incoming request to the server of its Proxy-Uri, without waiting for the response.
 
         :param request: the request to be forwarded
-        :return: None if success, send an error otherwise
+        :return: None if the request has been forwarded, the error response otherwise
         """
         uri = request.proxy_uri
         response = Response()
         response.destination = request.source
-        if uri is None:
+        if uri is None or defines.codes.get(request.code) not in ("GET", "POST", "PUT", "DELETE"):
+            return self.send_error(request, response, "BAD_REQUEST")
+        try:
+            host, port, path = parse_uri(str(uri))
+        except ValueError:
             return self.send_error(request, response, "BAD_REQUEST")
-        host, port, path = self.parse_path(uri)
-        server = (str(host), int(port))
-        token = self.generate_token()
-        key = hash(str(host) + str(port) + str(token))
-        to_store = copy.deepcopy(request)
-        self._forward[key] = to_store
-        # print request
-        to_delete = []
-        for option in request.options:
-            if option.name == "Proxy-Uri" or not option.safe:
-                to_delete.append(option)
-
-        for option in to_delete:
-            request.del_option(option)
-
-        client = HelperClientSynchronous()
-        self._currentMID += 1
-        client.starting_mid = self._currentMID % (1 << 16)
-        method = defines.codes[request.code]
-        if method == 'GET':
-            function = client.get
-            req = copy.deepcopy(request)
-            req.destination = server
-            req.uri_path = path
-            req.token = str(token)
-
-        elif method == 'POST':
-            function = client.post
-            req = copy.deepcopy(request)
-            req.destination = server
-            req.uri_path = path
-            req.token = str(token)
-
-        elif method == 'PUT':
-            function = client.put
-            req = copy.deepcopy(request)
-            req.destination = server
-            req.uri_path = path
-            req.token = str(token)
 
-        elif method == 'DELETE':
-            function = client.delete
-            req = copy.deepcopy(request)
-            req.destination = server
+        req = Request()
+        req.code = request.code
+        req.type = request.type
+        req.destination = (host, port)
+        path, _, query = path.partition("?")
+        if path != "":
             req.uri_path = path
-            req.token = str(token)
-
-        else:
-            return self.send_error(to_store, response, "BAD_REQUEST")
-        req.source = None
-        args = (req,)
-
-        key = hash(str(host) + str(port) + str((client.starting_mid + 1) % (1 << 16)))
-        self._forward_mid[key] = req
-        # Render_GET
-        with ThreadPoolExecutor(max_workers=100) as executor:
-            self.timer[request.mid] = executor.submit(self.send_delayed_ack, request)
-        # with ThreadPoolExecutor(max_workers=100) as executor:
-        #     future = executor.submit(client.start, [(function, args, {})])
-        #     future.add_done_callback(self.result_forward)
-        # print req
-        operations = [(function, args, {})]
-        function, args, kwargs = operations[0]
-        response = function(*args, **kwargs)
-        self.result_forward(response=response)
+        for q in query.split("&") if query != "" else ():
+            req.add_query(q)
+        for option in request.options:
+            # the body of a Block1 transfer has already been reassembled
+            if option.safe and option.number not in (defines.inv_options["Block1"], defines.inv_options["Size1"]):
+                req.add_option(option)
+        req.payload = read_payload(request.payload)
+
+        try:
+            future = self.client.send(req)
+        except (socket.error, RuntimeError):
+            return self.send_error(request, response, "BAD_GATEWAY")
+        if request.type == defines.inv_types["CON"]:
+            with self._acks_condition:
+                self._acks_counter += 1
+                heapq.heappush(self._acks, (time.time() + defines.SEPARATE_TIMEOUT, self._acks_counter, request))
+                self._acks_condition.notify()
+        future.add_done_callback(functools.partial(self._forwarded, request))
         return None
 
-    def send_delayed_ack(self, request):
-        time.sleep(defines.SEPARATE_TIMEOUT)
-        self.send_ack([request])
-
-    def send_ack(self, list_request):
+    def _forwarded(self, request, future):
         """
-        Send an ack to the client. Used mostly with separate.
+        Relay the response of an upstream server, or the error, to the client.
 
-        :param list_request: the request to be acknowledge.
-        :type list_request: [Request] or Request
+        :param request: the request of the client
+        :param future: the future of the response
         """
-
-        if isinstance(list_request, list):
-            request = list_request[0]
+        try:
+            upstream = future.result()
+        except socket.timeout:
+            upstream = None
+        response = Response()
+        response.destination = request.source
+        if isinstance(upstream, Response):
+            response.code = upstream.code
+            for option in upstream.options:
+                response.add_option(option)
+            response.payload = upstream.payload
+        elif upstream is None:
+            response.code = defines.responses["GATEWAY_TIMEOUT"]
         else:
-            request = list_request
-        del self.timer[request.mid]
-        host, port = request.source
-        ack = Message.new_ack(request)
-        self.send(ack, host, port)
+            # the server rejected the request with a RST
+            response.code = defines.responses["BAD_GATEWAY"]
+        self.result_forward(response, request)
 
-    def result_forward(self, future=None, response=None):
+    def result_forward(self, response, request):
         """
-        Forward results to the client.
+        Send a response to the client, piggy-backed on the ACK unless the request has already been acknowledged.
 
-        :param future: the future object.
+        :param response: the response
+        :param request: the request of the client
         """
-        if future is not None:
-            print future
-            print future.result()
-            response = future.result()
-        host, port = response.source
-        key = hash(str(host) + str(port) + str(response.token))
-        request = self._forward.get(key)
-        if request.mid in self.timer and self.timer[request.mid].cancel():
+        response.token = request.token
+        response.destination = request.source
+        with self._lock:
+            piggyback = request.type == defines.inv_types["CON"] and not request.acknowledged
+            request.acknowledged = True
+        if piggyback:
             response.type = defines.inv_types["ACK"]
             response.mid = request.mid
+        elif request.type == defines.inv_types["CON"]:
+            response.type = defines.inv_types["CON"]
+        else:
+            response.type = defines.inv_types["NON"]
+        response = self.message_layer.matcher_response(response)
+        if response.type == defines.inv_types["CON"]:
+            self.outbound_layer.send(response)
         else:
-            if request.type == defines.inv_types["CON"]:
-                response.type = defines.inv_types["CON"]
-            else:
-                response.type = defines.inv_types["NON"]
-
-        if request is not None:
-            response.destination = request.source
-            response.token = request.token
-
-            del self._forward[key]
-            host, port = response.source
-            key = hash(str(host) + str(port) + str(response.mid))
-            try:
-                del self._forward_mid[key]
-            except KeyError:
-                # log.err("MID has not been deleted")
-                pass
             host, port = request.source
-            if response.mid is None:
-                response.mid = self._currentMID
             self.send(response, host, port)
 
-    def generate_token(self):
+    def _separate(self):
         """
-        Generate tokens.
-
-        :return: a token.
+        Acknowledge the CON requests whose response has not arrived within SEPARATE_TIMEOUT, until the proxy stops.
         """
-        self._token += 1
-        # md5 = hashlib.md5()
-        # md5.update(str(self._token))
-        # token = md5.digest()
-        # return token[0:15]
-        return str(self._token)
+        while not self.stopped.isSet():
+            with self._acks_condition:
+                now = time.time()
+                due = []
+                while len(self._acks) > 0 and self._acks[0][0] <= now:
+                    request = heapq.heappop(self._acks)[2]
+                    if not request.acknowledged:
+                        request.acknowledged = True
+                        due.append(request)
+                if len(due) == 0:
+                    self._acks_condition.wait(min(self._acks[0][0] - now, 1.0) if len(self._acks) > 0 else 1.0)
+            for request in due:
+                host, port = request.source
+                self.send(Message.new_ack(request), host, port)
 
-    def error(self, mid, host, port):
+    def generate_token(self):
         """
-        Handler of errors. Send an error message to the client.
+        Generate tokens, unique until 2^32 of them have been generated.
 
-        :param mid: the mid of the response that generates the error.
-        :param host: the host of the server.
-        :param port: the port of the server.
+        :return: a token.
         """
-        key = hash(str(host) + str(port) + str(mid))
-        request = self._forward_mid.get(key)
-        if request is not None:
-            response = Response()
-            host, port = request.source
-            response.destination = request.source
-            response.token = request.token
-            response._mid = self._currentMID
-            response.type = defines.inv_types["NON"]
-            response.code = defines.responses["GATEWAY_TIMEOUT"]
-            key = hash(str(host) + str(port) + str(response.token))
-            del self._forward[key]
-            key = hash(str(host) + str(port) + str(mid))
-            try:
-                del self._forward_mid[key]
-            except KeyError:
-                # log.err("MID has not been deleted")
-                pass
-            self.send(response, host, port)
\ No newline at end of file
+        with self._lock:
+            self._token = (self._token + 1) % (1 << 32)
+            return "%08x" % self._token
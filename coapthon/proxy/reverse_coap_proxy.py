@@ -3,7 +3,7 @@ import re
 from coapthon.messages.message import Message
 from coapthon.messages.response import Response
 from coapthon.serializer import Serializer
-from coapthon.utils import Tree
+from coapthon.utils import Tree, read_payload
 from twisted.python import log
 from coapthon import defines
 from coapthon.client.coap_protocol import HelperClient
@@ -210,7 +210,7 @@ class ReverseProxyCoAP(ProxyCoAP):
             new_request._mid = (self._currentMID + 1) % (1 << 16)
             new_request.code = request.code
             new_request.proxy_uri = "coap://" + str(host) + ":" + str(port) + "/" + path
-            new_request.payload = request.payload
+            new_request.payload = read_payload(request.payload)
             for option in request.options:
                 if option.name == defines.inv_options["Uri-Path"]:
                     continue
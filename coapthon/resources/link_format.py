@@ -0,0 +1,324 @@
+from coapthon import defines
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+def parse_link_format(payload):
+    """
+    Parse a CoRE Link Format document.
+
+    :param payload: the link-format document
+    :return: the list of (target, attributes) where attributes is a dict. Attributes without value are
+             mapped to None, repeated attributes are joined by a space.
+    :raise ValueError: if the document is malformed
+    """
+    links = []
+    payload = str(payload)
+    length = len(payload)
+    pos = 0
+    while pos < length:
+        while pos < length and payload[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= length:
+            break
+        if payload[pos] != "<":
+            raise ValueError("Link target expected at " + str(pos))
+        end = payload.find(">", pos)
+        if end == -1:
+            raise ValueError("Unterminated link target")
+        target = payload[pos + 1:end]
+        pos = end + 1
+        attributes = {}
+        while pos < length and payload[pos] == ";":
+            pos += 1
+            start = pos
+            while pos < length and payload[pos] not in "=;,":
+                pos += 1
+            name = payload[start:pos].strip()
+            value = None
+            if pos < length and payload[pos] == "=":
+                pos += 1
+                if pos < length and payload[pos] == "\"":
+                    end = payload.find("\"", pos + 1)
+                    if end == -1:
+                        raise ValueError("Unterminated quoted string")
+                    value = payload[pos + 1:end]
+                    pos = end + 1
+                else:
+                    start = pos
+                    while pos < length and payload[pos] not in ";,":
+                        pos += 1
+                    value = payload[start:pos].strip()
+            if name == "":
+                continue
+            if name in attributes and attributes[name] is not None and value is not None:
+                attributes[name] += " " + value
+            else:
+                attributes[name] = value
+        if pos < length and payload[pos] != ",":
+            raise ValueError("Unexpected character at " + str(pos))
+        links.append((target, attributes))
+    return links
+
+
+def link(target, attributes):
+    """
+    Encode a single link in CoRE Link Format.
+
+    :param target: the link target
+    :param attributes: the dict of attributes
+    :return: the encoded link
+    """
+    msg = "<" + target + ">"
+    for k, v in attributes.iteritems():
+        if v is None:
+            msg += ";" + k
+        elif isinstance(v, (int, long)) or (isinstance(v, str) and v.isdigit()):
+            msg += ";" + k + "=" + str(v)
+        else:
+            msg += ";" + k + "=\"" + str(v) + "\""
+    return msg
+
+
+class LinkFormatIndex(object):
+    """
+    Keeps the CoRE Link Format document of a server pre-encoded and an inverted index of the link attributes.
+    The document is updated incrementally when resources are added, removed or changed and filtered documents
+    are cached per query.
+    """
+    # Maximum number of filtered documents kept in cache
+    MAX_CACHED_QUERIES = 128
+
+    def __init__(self):
+        """
+        Initialize an empty index.
+
+        """
+        # path -> encoded link
+        self._links = {}
+        # path -> [(attribute, value)] as indexed
+        self._indexed = {}
+        # attribute -> value -> set of paths
+        self._index = {}
+        # the whole document, None if it must be joined again
+        self._document = None
+        # query key -> filtered document
+        self._queries = {}
+        # handlers of path templates, their instances are listed when the document is requested
+        self._templates = []
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, path):
+        return path in self._links
+
+    def resource_added(self, path, resource):
+        """
+        Add or replace the link of a resource. Invisible resources are removed from the document.
+
+        :param path: the path of the resource
+        :param resource: the resource
+        """
+        if path in self._links:
+            self.resource_removed(path)
+        if not resource.visible:
+            return
+        self._links[path] = self.corelinkformat(resource)
+        indexed = list(self.attribute_values(resource.attributes))
+        for k, v in indexed:
+            self._index.setdefault(k, {}).setdefault(v, set()).add(path)
+        self._indexed[path] = indexed
+        self._invalidate()
+
+    def resource_removed(self, path):
+        """
+        Remove the link of a resource.
+
+        :param path: the path of the resource
+        """
+        if path not in self._links:
+            return
+        del self._links[path]
+        for k, v in self._indexed.pop(path, []):
+            values = self._index[k]
+            paths = values[v]
+            paths.discard(path)
+            if len(paths) == 0:
+                del values[v]
+                if len(values) == 0:
+                    del self._index[k]
+        self._invalidate()
+
+    def template_added(self, handler):
+        """
+        Add the handler of a path template. Its instances are enumerated lazily at every discovery.
+
+        :type handler: coapthon.resources.template.TemplateResource
+        :param handler: the handler
+        """
+        self._templates.append(handler)
+
+    def update(self, resource):
+        """
+        Re-encode the link of a resource after its attributes have been changed.
+
+        :param resource: the resource
+        """
+        if resource.path is not None:
+            self.resource_added(resource.path, resource)
+
+    def _invalidate(self):
+        self._document = None
+        self._queries = {}
+
+    def document(self, query=None):
+        """
+        Get the link-format document, filtered by the Uri-Query if specified.
+
+        :param query: the list of Uri-Query of the discovery request
+        :return: the encoded document
+        """
+        filters = self.parse_query(query)
+        if len(self._templates) > 0:
+            return self._static_document(filters) + "".join(self._template_links(filters))
+        return self._static_document(filters)
+
+    def _static_document(self, filters):
+        if len(filters) == 0:
+            if self._document is None:
+                self._document = "".join(self._links.itervalues())
+            return self._document
+        key = tuple(filters)
+        ret = self._queries.get(key)
+        if ret is None:
+            matched = self.match(filters)
+            if len(matched) == 0:
+                ret = ""
+            else:
+                # keep the order of the whole document
+                ret = "".join([encoded for path, encoded in self._links.iteritems() if path in matched])
+            if len(self._queries) >= self.MAX_CACHED_QUERIES:
+                self._queries = {}
+            self._queries[key] = ret
+        return ret
+
+    def match(self, filters):
+        """
+        Get the paths matching all the filters.
+
+        :param filters: list of (attribute, value)
+        :return: the set of matching paths
+        """
+        matched = None
+        for k, v in filters:
+            if k == "href":
+                if v.endswith("*"):
+                    paths = set([p for p in self._links if p.startswith(v[:-1])])
+                elif v in self._links:
+                    paths = {v}
+                else:
+                    paths = set()
+            else:
+                values = self._index.get(k, {})
+                if v.endswith("*"):
+                    paths = set()
+                    for value, p in values.iteritems():
+                        if value.startswith(v[:-1]):
+                            paths |= p
+                else:
+                    paths = values.get(v, set())
+            if matched is None:
+                matched = set(paths)
+            else:
+                matched &= paths
+            if len(matched) == 0:
+                break
+        return matched
+
+    def _template_links(self, filters):
+        """
+        Encode the links of the instances of the path templates matching the filters.
+
+        :param filters: list of (attribute, value)
+        :return: generator of encoded links
+        """
+        hrefs = [v for k, v in filters if k == "href"]
+        others = [(k, v) for k, v in filters if k != "href"]
+        for handler in self._templates:
+            if not handler.visible:
+                continue
+            # the attributes are shared by all the instances
+            values = {}
+            for k, v in self.attribute_values(handler.attributes):
+                values.setdefault(k, []).append(v)
+            if not all([self._value_matches(v, values.get(k, [])) for k, v in others]):
+                continue
+            suffix = self.corelinkformat(handler)[len(handler.path) + 2:]
+            for params in handler.instances():
+                path = handler.template.expand(params)
+                if all([self._value_matches(v, [path]) for v in hrefs]):
+                    yield "<" + path + ">" + suffix
+
+    @staticmethod
+    def _value_matches(v, values):
+        if v.endswith("*"):
+            return any([value.startswith(v[:-1]) for value in values])
+        return v in values
+
+    @staticmethod
+    def parse_query(query):
+        """
+        Parse the Uri-Query of a discovery request.
+
+        :param query: the list of Uri-Query
+        :return: the sorted list of (attribute, value)
+        """
+        filters = []
+        if query is None:
+            return filters
+        for q in query:
+            tmp = str(q).split("=", 1)
+            if len(tmp) > 1:
+                filters.append((tmp[0], tmp[1].strip("\"")))
+        filters.sort()
+        return filters
+
+    @staticmethod
+    def attribute_values(attributes):
+        """
+        Get the (attribute, value) pairs to be indexed. Space separated values are indexed one by one.
+
+        :param attributes: the attributes of a resource
+        :return: generator of (attribute, value)
+        """
+        for k, v in attributes.iteritems():
+            if v is None:
+                continue
+            if isinstance(v, (list, tuple, set)):
+                lst = [str(x) for x in v]
+            else:
+                lst = str(v).strip("\"").split()
+            for x in lst:
+                yield k, x
+
+    @staticmethod
+    def corelinkformat(resource):
+        """
+        Return a formatted string representation of the corelinkformat of a resource.
+
+        :return: the string
+        """
+        msg = "<" + resource.path + ">;"
+        for k in resource.attributes:
+            name = defines.corelinkformat.get(k)
+            method = getattr(resource, name, None) if name is not None else None
+            if method is not None and method != "":
+                v = method
+                msg = msg[:-1] + ";" + str(v) + ","
+            else:
+                v = resource.attributes[k]
+                if v is not None:
+                    msg = msg[:-1] + ";" + k + "=" + str(v) + ","
+        return msg
@@ -26,10 +26,14 @@ class Resource(object):
             self._required_content_type = name.required_content_type
             self._allow_children = name.allow_children
             self.observe_count = name.observe_count
-            self._payload = name.payload
+            self._payload = dict(name.raw_payload)
+            self._encoders = name._encoders
+            self._representations = {}
             self._etag = name.etag
             self._location_query = name.location_query
             self._max_age = name.max_age
+            self._block_size = name.block_size
+            self._notification_policy = name.notification_policy
             self._coap_server = name._coap_server
         else:
             # The attributes of this resource.
@@ -51,8 +55,15 @@ class Resource(object):
 
             self._observe_count = 1
 
+            # Content-Type -> payload set by the application
             self._payload = {}
 
+            # Content-Type -> (source Content-Type, encoder)
+            self._encoders = {}
+
+            # Content-Type -> encoded representation, valid until the payload changes
+            self._representations = {}
+
             self._required_content_type = None
 
             self._etag = []
@@ -61,6 +72,12 @@ class Resource(object):
 
             self._max_age = None
 
+            # block size of the blockwise transfers, None to choose it per endpoint
+            self._block_size = None
+
+            # (count, period) of the CON notifications, None to use the policy of the server
+            self._notification_policy = None
+
             self._coap_server = coap_server
 
     @property
@@ -128,6 +145,44 @@ class Resource(object):
         """
         self._max_age = ma
 
+    @property
+    def block_size(self):
+        """
+        Get the block size forced for the blockwise transfers of the resource.
+
+        :return: the block size or None if it is chosen per endpoint
+        """
+        return self._block_size
+
+    @block_size.setter
+    def block_size(self, size):
+        """
+        Force the block size of the blockwise transfers of the resource.
+
+        :param size: the block size (16 to 1024, a power of two), None to choose it per endpoint
+        """
+        assert size is None or size in (16, 32, 64, 128, 256, 512, 1024)
+        self._block_size = size
+
+    @property
+    def notification_policy(self):
+        """
+        Get the reliability of the notifications of the resource.
+
+        :return: (count, period) or None if the policy of the server is used
+        """
+        return self._notification_policy
+
+    @notification_policy.setter
+    def notification_policy(self, policy):
+        """
+        Set the reliability of the notifications of the resource. The notifications are NON, one every count
+        notifications or every period seconds is CON to check that the observer is still interested.
+
+        :param policy: (count, period), either can be None to disable it, None to use the policy of the server
+        """
+        self._notification_policy = policy
+
     @property
     def payload(self):
         """
@@ -137,35 +192,87 @@ class Resource(object):
         :return: the payload.
         """
         if self._required_content_type is not None:
-            if isinstance(self._payload, dict):
-                try:
-                    return self._payload[self._required_content_type]
-                except KeyError:
-                    raise KeyError("Content-Type not available")
+            if self._required_content_type in self._payload:
+                return self._payload[self._required_content_type]
+            return self.representation(self._required_content_type)[1]
+        if defines.inv_content_types["text/plain"] in self._payload:
+            return self._payload[defines.inv_content_types["text/plain"]]
+        elif len(self._payload) == 0:
+            return None
         else:
-            if isinstance(self._payload, dict):
-                if defines.inv_content_types["text/plain"] in self._payload:
-                    return self._payload[defines.inv_content_types["text/plain"]]
-                else:
-                    val = self._payload.keys()
-                    return val[0], self._payload[val[0]]
-
-        return self._payload
+            val = self._payload.keys()
+            return val[0], self._payload[val[0]]
 
     @payload.setter
     def payload(self, p):
         """
-        Set the payload of the resource.
+        Set the payload of the resource. The cached representations are discarded.
 
-        :param p: the new payload
+        :param p: the new payload, or a dict of payloads by Content-Type
         """
         if isinstance(p, dict):
-            self._payload = {}
-            for k in p.keys():
-                v = p[k]
-                self._payload[k] = v
+            self._payload = dict(p)
         else:
             self._payload = {defines.inv_content_types["text/plain"]: p}
+        self._representations = {}
+
+    def add_encoder(self, content_type, encoder, source=None):
+        """
+        Register an encoder producing a representation of the resource in a Content-Type which is not set by the
+        application. The representation is encoded at the first request and cached until the payload changes.
+
+        :param content_type: the Content-Type produced by the encoder
+        :param encoder: callable receiving the source payload and returning the encoded string
+        :param source: the Content-Type of the payload passed to the encoder, by default "text/plain" or the first
+                       Content-Type set
+        """
+        if isinstance(content_type, str):
+            content_type = defines.inv_content_types[content_type]
+        if isinstance(source, str):
+            source = defines.inv_content_types[source]
+        self._encoders[content_type] = (source, encoder)
+        self._representations.pop(content_type, None)
+
+    def representation(self, content_type=None):
+        """
+        Get the encoded representation of the resource in a Content-Type.
+
+        :param content_type: the required Content-Type, None for "text/plain" or the first Content-Type set
+        :return: (Content-Type, encoded payload), (None, None) if the resource has no payload
+        :raise KeyError: if the representation is not available
+        """
+        if isinstance(content_type, str):
+            content_type = defines.inv_content_types[content_type]
+        if content_type is None:
+            content_type = self._default_content_type()
+            if content_type is None:
+                return None, None
+        try:
+            return content_type, self._representations[content_type]
+        except KeyError:
+            pass
+        if content_type in self._payload:
+            ret = self._payload[content_type]
+            if ret is not None:
+                ret = str(ret)
+        elif content_type in self._encoders:
+            source, encoder = self._encoders[content_type]
+            if source is None:
+                source = self._default_content_type()
+            if source not in self._payload:
+                raise KeyError("Content-Type not available")
+            ret = str(encoder(self._payload[source]))
+        else:
+            raise KeyError("Content-Type not available")
+        self._representations[content_type] = ret
+        return content_type, ret
+
+    def _default_content_type(self):
+        if defines.inv_content_types["text/plain"] in self._payload:
+            return defines.inv_content_types["text/plain"]
+        elif len(self._payload) > 0:
+            return self._payload.keys()[0]
+        return None
 
     @property
     def raw_payload(self):
@@ -194,6 +301,7 @@ class Resource(object):
         :param att: the attributes
         """
         self._attributes = att
+        self.update_link()
 
     @property
     def visible(self):
@@ -213,6 +321,7 @@ class Resource(object):
         """
         assert isinstance(v, bool)
         self._visible = v
+        self.update_link()
 
     @property
     def observable(self):
@@ -326,6 +435,7 @@ class Resource(object):
                 value.append(ct)
         if len(value) > 0:
             self._attributes["ct"] = value
+            self.update_link()
 
     def add_content_type(self, ct):
         """
@@ -339,6 +449,7 @@ class Resource(object):
         ct = defines.inv_content_types[ct]
         lst.append(ct)
         self._attributes["ct"] = lst
+        self.update_link()
 
     @property
     def resource_type(self):
@@ -363,6 +474,7 @@ class Resource(object):
         :param rt: the CoRE Link Format rt attribute
         """
         self._attributes["rt"] = rt
+        self.update_link()
 
     @property
     def interface_type(self):
@@ -387,6 +499,7 @@ class Resource(object):
         :param ift: the CoRE Link Format if attribute
         """
         self._attributes["if"] = ift
+        self.update_link()
 
     @property
     def maximum_size_estimated(self):
@@ -411,6 +524,19 @@ class Resource(object):
         :param sz: the CoRE Link Format sz attribute
         """
         self._attributes["sz"] = sz
+        self.update_link()
+
+    def update_link(self):
+        """
+        Update the link of the resource in the .well-known/core document of the server. It must be called after
+        changing the attributes dict in place.
+
+        """
+        if self._coap_server is None or self.path is None:
+            return
+        resource_layer = getattr(self._coap_server, "resource_layer", None)
+        if resource_layer is not None and self._coap_server.root.tree.get(self.path) is self:
+            resource_layer.link_format.update(self)
 
     def render_GET(self, request):
         """
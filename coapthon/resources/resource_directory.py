@@ -0,0 +1,561 @@
+import heapq
+import threading
+import time
+from coapthon import defines
+from coapthon.resources.link_format import LinkFormatIndex, parse_link_format, link
+from coapthon.resources.resource import Resource
+from coapthon.utils import read_payload
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+# Default registration lifetime in seconds (RFC 9176)
+DEFAULT_LIFETIME = 90000
+
+# Registration parameters which are not stored as endpoint attributes
+REGISTRATION_PARAMETERS = ("ep", "d", "lt", "base")
+
+# Maximum number of expired registrations removed at each step
+EXPIRY_BATCH = 1000
+
+# Seconds between two expiry steps
+EXPIRY_PERIOD = 1
+
+
+class Registration(object):
+    """
+    A registration of an endpoint in the Resource Directory.
+    """
+    __slots__ = ("id", "path", "ep", "d", "base", "lt", "attributes", "links", "expires", "generation")
+
+    def __init__(self, reg_id, path, ep, d):
+        """
+        Initialize a registration.
+
+        :param reg_id: the registration id
+        :param path: the path of the registration resource
+        :param ep: the endpoint name
+        :param d: the sector, or None
+        """
+        self.id = reg_id
+        self.path = path
+        self.ep = ep
+        self.d = d
+        self.base = None
+        self.lt = DEFAULT_LIFETIME
+        # extra endpoint attributes, e.g. et
+        self.attributes = {}
+        # [(target, attributes)]
+        self.links = []
+        self.expires = 0
+        self.generation = 0
+
+    def endpoint_attributes(self):
+        """
+        Get the attributes used to index and to describe the endpoint.
+
+        :return: the dict of attributes
+        """
+        ret = dict(self.attributes)
+        ret["ep"] = self.ep
+        if self.d is not None:
+            ret["d"] = self.d
+        if self.base is not None:
+            ret["base"] = self.base
+        ret["lt"] = str(self.lt)
+        return ret
+
+    def target(self, n):
+        """
+        Get the target URI of a link resolved against the base URI.
+
+        :param n: the position of the link
+        :return: the absolute target URI
+        """
+        target = self.links[n][0]
+        if self.base is not None and target.startswith("/"):
+            return self.base.rstrip("/") + target
+        return target
+
+
+class ResourceDirectory(object):
+    """
+    Resource Directory (RFC 9176). Endpoints register their links with a POST to the directory resource and the
+    registrations are indexed by ep, d, rt, if and href to serve the endpoint and resource lookup interfaces.
+    """
+
+    def __init__(self, coap_server, path="rd", lookup_path="rd-lookup"):
+        """
+        Initialize the Resource Directory and add its resources to the server.
+
+        :type coap_server: coapthon.server.coap_protocol.CoAP
+        :param coap_server: the CoAP server
+        :param path: the path of the registration interface
+        :param lookup_path: the path of the lookup interfaces
+        """
+        self._server = coap_server
+        self._lock = threading.RLock()
+        self._path = "/" + path.strip("/")
+        self._current_id = 0
+        # id -> Registration
+        self._registrations = {}
+        # (ep, d) -> id
+        self._endpoints = {}
+        # attribute -> value -> set of ids
+        self._endpoint_index = {}
+        # attribute -> value -> set of (id, link position)
+        self._resource_index = {}
+        # heap of (expires, id, generation)
+        self._expiry = []
+        self._timer = None
+        self._stopped = threading.Event()
+
+        coap_server.add_resource(path, DirectoryResource(self, coap_server=coap_server))
+        lookup = Resource("rd-lookup", coap_server, visible=False, observable=False, allow_children=True)
+        coap_server.add_resource(lookup_path, lookup)
+        coap_server.add_resource(lookup_path.strip("/") + "/ep", LookupResource(self, "ep", coap_server=coap_server))
+        coap_server.add_resource(lookup_path.strip("/") + "/res", LookupResource(self, "res",
+                                                                                 coap_server=coap_server))
+        self.schedule_expiry()
+
+    def __len__(self):
+        return len(self._registrations)
+
+    def get(self, reg_id):
+        """
+        Get a registration.
+
+        :param reg_id: the registration id
+        :return: the registration or None
+        """
+        return self._registrations.get(reg_id)
+
+    def register(self, ep, d=None, lt=None, base=None, attributes=None, links=None):
+        """
+        Register an endpoint. A registration with the same ep and d is replaced.
+
+        :param ep: the endpoint name
+        :param d: the sector
+        :param lt: the lifetime in seconds
+        :param base: the base URI of the links
+        :param attributes: the extra endpoint attributes
+        :param links: the list of (target, attributes)
+        :return: the registration
+        """
+        with self._lock:
+            self.expire()
+            reg_id = self._endpoints.get((ep, d))
+            if reg_id is not None:
+                registration = self._registrations[reg_id]
+                self._unindex(registration)
+            else:
+                self._current_id += 1
+                reg_id = self._current_id
+                registration = Registration(reg_id, self._path + "/" + "%x" % reg_id, ep, d)
+                self._registrations[reg_id] = registration
+                self._endpoints[(ep, d)] = reg_id
+            registration.lt = lt if lt is not None else DEFAULT_LIFETIME
+            registration.base = base
+            registration.attributes = attributes if attributes is not None else {}
+            registration.links = links if links is not None else []
+            self._index(registration)
+            self._refresh(registration)
+            return registration
+
+    def update(self, reg_id, lt=None, base=None, attributes=None, links=None):
+        """
+        Update a registration and extend its lifetime.
+
+        :param reg_id: the registration id
+        :param lt: the new lifetime, None to keep the previous one
+        :param base: the new base URI, None to keep the previous one
+        :param attributes: the endpoint attributes to change
+        :param links: the new links, None to keep the previous ones
+        :return: the registration or None if not registered
+        """
+        with self._lock:
+            self.expire()
+            registration = self._registrations.get(reg_id)
+            if registration is None:
+                return None
+            if lt is not None or base is not None or attributes or links is not None:
+                self._unindex(registration)
+                if lt is not None:
+                    registration.lt = lt
+                if base is not None:
+                    registration.base = base
+                if attributes:
+                    registration.attributes.update(attributes)
+                if links is not None:
+                    registration.links = links
+                self._index(registration)
+            self._refresh(registration)
+            return registration
+
+    def remove(self, reg_id, from_tree=True):
+        """
+        Remove a registration.
+
+        :param reg_id: the registration id
+        :param from_tree: True if the registration resource must be removed from the server
+        :return: the removed registration or None
+        """
+        with self._lock:
+            registration = self._registrations.pop(reg_id, None)
+            if registration is None:
+                return None
+            self._unindex(registration)
+            del self._endpoints[(registration.ep, registration.d)]
+            if from_tree:
+                try:
+                    del self._server.root[registration.path]
+                except KeyError:
+                    pass
+            return registration
+
+    def expire(self, now=None, max_count=EXPIRY_BATCH):
+        """
+        Remove the expired registrations, at most max_count of them.
+
+        :param now: the current time
+        :param max_count: the maximum number of registrations to remove
+        :return: the number of removed registrations
+        """
+        if now is None:
+            now = time.time()
+        removed = 0
+        with self._lock:
+            while len(self._expiry) > 0 and self._expiry[0][0] <= now and removed < max_count:
+                expires, reg_id, generation = heapq.heappop(self._expiry)
+                registration = self._registrations.get(reg_id)
+                if registration is not None and registration.generation == generation:
+                    self.remove(reg_id)
+                    removed += 1
+        return removed
+
+    def schedule_expiry(self):
+        """
+        Remove the expired registrations periodically.
+
+        """
+        if self._stopped.isSet():
+            return
+        self._timer = threading.Timer(EXPIRY_PERIOD, self.schedule_expiry)
+        self._timer.setDaemon(True)
+        self._timer.start()
+        self.expire()
+
+    def close(self):
+        """
+        Stop the periodic expiry of registrations.
+
+        """
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _refresh(self, registration):
+        registration.generation += 1
+        registration.expires = time.time() + registration.lt
+        heapq.heappush(self._expiry, (registration.expires, registration.id, registration.generation))
+        if len(self._expiry) > 2 * len(self._registrations) + EXPIRY_BATCH:
+            # drop the entries superseded by refreshes
+            self._expiry = [(r.expires, r.id, r.generation) for r in self._registrations.itervalues()]
+            heapq.heapify(self._expiry)
+
+    def _index(self, registration):
+        for k, v in LinkFormatIndex.attribute_values(registration.endpoint_attributes()):
+            self._endpoint_index.setdefault(k, {}).setdefault(v, set()).add(registration.id)
+        for n in xrange(len(registration.links)):
+            for k, v in self._link_values(registration, n):
+                self._resource_index.setdefault(k, {}).setdefault(v, set()).add((registration.id, n))
+
+    def _unindex(self, registration):
+        for k, v in LinkFormatIndex.attribute_values(registration.endpoint_attributes()):
+            self._discard(self._endpoint_index, k, v, registration.id)
+        for n in xrange(len(registration.links)):
+            for k, v in self._link_values(registration, n):
+                self._discard(self._resource_index, k, v, (registration.id, n))
+
+    @staticmethod
+    def _link_values(registration, n):
+        target, attributes = registration.links[n]
+        yield "href", registration.target(n)
+        for k, v in LinkFormatIndex.attribute_values(attributes):
+            yield k, v
+
+    @staticmethod
+    def _discard(index, k, v, item):
+        values = index.get(k)
+        if values is None:
+            return
+        items = values.get(v)
+        if items is None:
+            return
+        items.discard(item)
+        if len(items) == 0:
+            del values[v]
+            if len(values) == 0:
+                del index[k]
+
+    @staticmethod
+    def _match(index, k, v):
+        values = index.get(k, {})
+        if v.endswith("*"):
+            ret = set()
+            for value, items in values.iteritems():
+                if value.startswith(v[:-1]):
+                    ret |= items
+            return ret
+        return values.get(v, set())
+
+    def _is_endpoint_filter(self, k):
+        return k in REGISTRATION_PARAMETERS or (k in self._endpoint_index and k not in self._resource_index)
+
+    def lookup_endpoints(self, filters):
+        """
+        Endpoint lookup. Filters on resource attributes select the endpoints with at least one matching link.
+
+        :param filters: the list of (attribute, value)
+        :return: the list of matching registrations sorted by id
+        """
+        with self._lock:
+            self.expire()
+            ids = None
+            for k, v in filters:
+                if self._is_endpoint_filter(k):
+                    matched = self._match(self._endpoint_index, k, v)
+                else:
+                    matched = set([reg_id for reg_id, n in self._match(self._resource_index, k, v)])
+                ids = set(matched) if ids is None else ids & matched
+                if len(ids) == 0:
+                    return []
+            if ids is None:
+                ids = self._registrations.keys()
+            return [self._registrations[reg_id] for reg_id in sorted(ids)]
+
+    def lookup_resources(self, filters):
+        """
+        Resource lookup. Filters on endpoint attributes select the links of the matching endpoints.
+
+        :param filters: the list of (attribute, value)
+        :return: the list of matching (registration, link position) sorted by registration
+        """
+        with self._lock:
+            self.expire()
+            ids = None
+            pairs = None
+            for k, v in filters:
+                if self._is_endpoint_filter(k):
+                    matched = self._match(self._endpoint_index, k, v)
+                    ids = set(matched) if ids is None else ids & matched
+                    if len(ids) == 0:
+                        return []
+                else:
+                    matched = self._match(self._resource_index, k, v)
+                    pairs = set(matched) if pairs is None else pairs & matched
+                    if len(pairs) == 0:
+                        return []
+            if pairs is None:
+                if ids is None:
+                    ids = self._registrations.keys()
+                pairs = [(reg_id, n) for reg_id in ids for n in xrange(len(self._registrations[reg_id].links))]
+            elif ids is not None:
+                pairs = [(reg_id, n) for reg_id, n in pairs if reg_id in ids]
+            return [(self._registrations[reg_id], n) for reg_id, n in sorted(pairs)]
+
+    @staticmethod
+    def parse_registration(request):
+        """
+        Parse the Uri-Query of a registration request.
+
+        :param request: the request
+        :return: (ep, d, lt, base, attributes)
+        :raise ValueError: if a parameter is not valid
+        """
+        ep = None
+        d = None
+        lt = None
+        base = None
+        attributes = {}
+        for q in request.query:
+            tmp = str(q).split("=", 1)
+            k = tmp[0]
+            v = tmp[1] if len(tmp) > 1 else None
+            if k == "ep":
+                ep = v
+            elif k == "d":
+                d = v
+            elif k == "lt":
+                if v is None:
+                    raise ValueError("Missing lifetime")
+                lt = int(v)
+                if lt <= 0:
+                    raise ValueError("Invalid lifetime")
+            elif k == "base":
+                base = v
+            elif k != "":
+                attributes[k] = v
+        return ep, d, lt, base, attributes
+
+    @staticmethod
+    def parse_links(request, payload):
+        """
+        Parse the link-format payload of a registration request.
+
+        :param request: the request
+        :param payload: the payload of the request, read by the caller
+        :return: the list of (target, attributes)
+        :raise ValueError: if the payload is not a valid link-format document
+        """
+        if request.content_type not in (defines.inv_content_types["text/plain"],
+                                        defines.inv_content_types["application/link-format"]):
+            raise ValueError("Unsupported Content-Format")
+        if payload is None or len(payload) == 0:
+            return []
+        return parse_link_format(payload)
+
+
+class DirectoryResource(Resource):
+    """
+    The registration interface of the Resource Directory.
+    """
+
+    def __init__(self, directory, name="ResourceDirectory", coap_server=None):
+        super(DirectoryResource, self).__init__(name, coap_server, visible=True, observable=False,
+                                                allow_children=True)
+        self.directory = directory
+        self.resource_type = "core.rd"
+        self.add_content_type("application/link-format")
+
+    def render_POST(self, request):
+        try:
+            ep, d, lt, base, attributes = self.directory.parse_registration(request)
+            links = self.directory.parse_links(request, read_payload(request.payload))
+        except ValueError:
+            return "BAD_REQUEST"
+        if ep is None:
+            return "BAD_REQUEST"
+        if base is None and request.source is not None:
+            host, port = request.source
+            if ":" in host:
+                host = "[" + host + "]"
+            base = "coap://" + host + ":" + str(port)
+        registration = self.directory.register(ep, d, lt, base, attributes, links)
+        try:
+            resource = self._coap_server.root[registration.path]
+        except KeyError:
+            resource = RegistrationResource(self.directory, registration.id, coap_server=self._coap_server)
+        resource.path = registration.path
+        return resource
+
+
+class RegistrationResource(Resource):
+    """
+    The resource of a single registration, used to update and remove it.
+    """
+
+    def __init__(self, directory, reg_id, name="Registration", coap_server=None):
+        super(RegistrationResource, self).__init__(name, coap_server, visible=False, observable=False,
+                                                   allow_children=False)
+        self.directory = directory
+        self.reg_id = reg_id
+
+    def render_GET(self, request):
+        registration = self.directory.get(self.reg_id)
+        if registration is None:
+            return "NOT_FOUND"
+        res = Resource(self.name, visible=False, observable=False, allow_children=False)
+        res.required_content_type = self.required_content_type
+        res.payload = {defines.inv_content_types["application/link-format"]:
+                       ",".join([link(target, attributes) for target, attributes in registration.links])}
+        return res
+
+    def render_POST(self, request):
+        try:
+            ep, d, lt, base, attributes = self.directory.parse_registration(request)
+            links = None
+            payload = read_payload(request.payload)
+            if payload is not None and len(payload) > 0:
+                links = self.directory.parse_links(request, payload)
+        except ValueError:
+            return "BAD_REQUEST"
+        if self.directory.update(self.reg_id, lt, base, attributes, links) is None:
+            return "NOT_FOUND"
+        return self
+
+    def render_DELETE(self, request):
+        self.directory.remove(self.reg_id, from_tree=False)
+        return True
+
+
+class LookupResource(Resource):
+    """
+    The endpoint and the resource lookup interfaces.
+    """
+
+    def __init__(self, directory, lookup_type, name="Lookup", coap_server=None):
+        super(LookupResource, self).__init__(name, coap_server, visible=True, observable=False,
+                                             allow_children=False)
+        self.directory = directory
+        self.lookup_type = lookup_type
+        self.resource_type = "core.rd-lookup-" + lookup_type
+        self.add_content_type("application/link-format")
+
+    def render_GET(self, request):
+        query = []
+        page = None
+        count = None
+        try:
+            # parsed before the filters, which ignore the items without a value
+            for q in request.query:
+                name, _, value = str(q).partition("=")
+                if name == "page":
+                    page = self.paging(name, value)
+                elif name == "count":
+                    count = self.paging(name, value)
+                else:
+                    query.append(q)
+        except ValueError:
+            return "BAD_REQUEST"
+        filters = LinkFormatIndex.parse_query(query)
+
+        if self.lookup_type == "ep":
+            result = self.directory.lookup_endpoints(filters)
+        else:
+            result = self.directory.lookup_resources(filters)
+        if count is not None:
+            start = (page if page is not None else 0) * count
+            result = result[start:start + count]
+
+        if self.lookup_type == "ep":
+            links = [link(registration.path, registration.endpoint_attributes()) for registration in result]
+        else:
+            links = []
+            for registration, n in result:
+                attributes = dict(registration.links[n][1])
+                if registration.base is not None:
+                    attributes["anchor"] = registration.base
+                links.append(link(registration.target(n), attributes))
+
+        res = Resource(self.name, visible=False, observable=False, allow_children=False)
+        res.required_content_type = self.required_content_type
+        res.payload = {defines.inv_content_types["application/link-format"]: ",".join(links)}
+        return res
+
+    @staticmethod
+    def paging(name, value):
+        """
+        Parse the page or count parameter of a lookup.
+
+        :param name: the name of the parameter
+        :param value: the value of the parameter
+        :return: the value as a non-negative int
+        :raise ValueError: if the value is missing, not an int or negative
+        """
+        if value == "":
+            raise ValueError("Missing " + name)
+        value = int(value)
+        if value < 0:
+            raise ValueError("Negative " + name)
+        return value
@@ -0,0 +1,258 @@
+import collections
+import re
+import threading
+import weakref
+from coapthon import defines
+from coapthon.resources.resource import Resource
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class PathTemplate(object):
+    """
+    A path with parameters, e.g. /sensors/{id}/temp. Each parameter matches exactly one path segment.
+    """
+    _PARAMETER = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+    def __init__(self, template):
+        """
+        Compile a path template.
+
+        :param template: the template
+        :raise ValueError: if the template has no parameters or a parameter is repeated
+        """
+        self.template = "/" + template.strip("/")
+        self.names = self._PARAMETER.findall(self.template)
+        if len(self.names) == 0:
+            raise ValueError("No parameters in " + self.template)
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Repeated parameter in " + self.template)
+        regex = ""
+        pos = 0
+        for m in self._PARAMETER.finditer(self.template):
+            regex += re.escape(self.template[pos:m.start()]) + "(?P<" + m.group(1) + ">[^/]+)"
+            pos = m.end()
+        regex += re.escape(self.template[pos:])
+        self._regex = re.compile(regex + "$")
+        # the part before the first parameter, used to discard paths quickly
+        self.prefix = self.template[:self.template.index("{")]
+
+    def __str__(self):
+        return self.template
+
+    def match(self, path):
+        """
+        Match a concrete path against the template.
+
+        :param path: the path
+        :return: the dict of bound parameters or None if the path does not match
+        """
+        if not path.startswith(self.prefix):
+            return None
+        m = self._regex.match(path)
+        if m is None:
+            return None
+        return m.groupdict()
+
+    def expand(self, params):
+        """
+        Build the concrete path for a set of parameters.
+
+        :param params: the dict of parameters
+        :return: the path
+        """
+        return self._PARAMETER.sub(lambda m: str(params[m.group(1)]), self.template)
+
+
+class TemplateState(object):
+    """
+    The state of a concrete path kept across its instances: the ETags and the Observe counter.
+    """
+    __slots__ = ("etag", "observe_count")
+
+    def __init__(self):
+        self.etag = []
+        self.observe_count = 1
+
+
+class TemplateResource(Resource):
+    """
+    A single handler serving every path matching a template. The render methods receive the request and the
+    TemplateInstance of the concrete path, which carries the bound parameters, and must return the instance (or
+    another resource) like the render methods of Resource.
+    """
+    def __init__(self, name, coap_server=None, visible=True, observable=True, allow_children=False,
+                 provider=None):
+        """
+        Initialize a handler for a path template.
+
+        :param name: the name of the resource
+        :param visible: if the instances are listed in .well-known/core
+        :param observable: if the instances are observable
+        :param allow_children: if the instances could have children
+        :param provider: callable returning the parameters (dicts) of the existing instances, used for discovery
+        """
+        super(TemplateResource, self).__init__(name, coap_server, visible, observable, allow_children)
+        self.template = None
+        self._provider = provider
+        self._lock = threading.Lock()
+        # path -> instance, kept only while referenced, e.g. by an observe relation
+        self._instances = weakref.WeakValueDictionary()
+        # path -> TemplateState, the least recently used are dropped beyond MAX_TEMPLATE_STATES
+        self._states = collections.OrderedDict()
+
+    def bind(self, template):
+        """
+        Bind the handler to a path template.
+
+        :param template: the path template
+        """
+        self.template = PathTemplate(template)
+        self.path = self.template.template
+
+    def instance(self, path, params=None):
+        """
+        Get the instance of a concrete path. The same object is returned while it is in use, so observe relations
+        are kept per path. The ETags and the Observe counter of the path outlive the instance.
+
+        :param path: the concrete path
+        :param params: the bound parameters, None to match them from the path
+        :return: the instance or None if the path does not match the template
+        """
+        with self._lock:
+            instance = self._instances.get(path)
+            if instance is not None:
+                return instance
+            if params is None:
+                params = self.template.match(path)
+                if params is None:
+                    return None
+            state = self._states.pop(path, None)
+            if state is None:
+                state = TemplateState()
+                if len(self._states) >= defines.MAX_TEMPLATE_STATES:
+                    self._states.popitem(last=False)
+            self._states[path] = state
+            instance = TemplateInstance(self, path, params, state)
+            self._instances[path] = instance
+            return instance
+
+    def discard(self, path):
+        """
+        Forget the instance of a concrete path, e.g. after a DELETE.
+
+        :param path: the concrete path
+        """
+        with self._lock:
+            self._instances.pop(path, None)
+            self._states.pop(path, None)
+
+    def instances(self):
+        """
+        Enumerate the parameters of the existing instances. Redefine it or pass a provider to list the instances
+        in .well-known/core.
+
+        :return: iterable of dicts of parameters
+        """
+        if self._provider is None:
+            return []
+        return self._provider()
+
+    def render_GET(self, request, instance):
+        """
+        Method to be redefined to render a GET request on an instance.
+
+        :param request: the request
+        :param instance: the instance of the requested path
+        :return: the response
+        """
+        return -1
+
+    def render_PUT(self, request, instance):
+        """
+        Method to be redefined to render a PUT request on an instance.
+
+        :param request: the request
+        :param instance: the instance of the requested path
+        :return: the response
+        """
+        return -1
+
+    def render_POST(self, request, instance):
+        """
+        Method to be redefined to render a POST request on an instance.
+
+        :param request: the request
+        :param instance: the instance of the requested path
+        :return: the response
+        """
+        return -1
+
+    def render_DELETE(self, request, instance):
+        """
+        Method to be redefined to render a DELETE request on an instance.
+
+        :param request: the request
+        :param instance: the instance of the requested path
+        """
+        return -1
+
+
+class TemplateInstance(Resource):
+    """
+    The resource of a concrete path matching a template. It shares the attributes and the encoders of its handler
+    and delegates the render methods to it.
+    """
+    def __init__(self, handler, path, params, state=None):
+        """
+        Initialize an instance.
+
+        :type handler: TemplateResource
+        :param handler: the handler of the template
+        :param path: the concrete path
+        :param params: the bound parameters
+        :param state: the TemplateState of the path, a new one by default
+        """
+        super(TemplateInstance, self).__init__(handler.name, handler._coap_server, handler.visible,
+                                               handler.observable, handler.allow_children)
+        self._attributes = handler.attributes
+        self._encoders = handler._encoders
+        self._block_size = handler.block_size
+        self.path = path
+        self.params = params
+        self.handler = handler
+        self._state = state if state is not None else TemplateState()
+        # the ETags are appended to the list of the state
+        self._etag = self._state.etag
+
+    @property
+    def observe_count(self):
+        """
+        Get the Observe counter of the path.
+
+        :return: the Observe counter value
+        """
+        return self._state.observe_count
+
+    @observe_count.setter
+    def observe_count(self, v):
+        """
+        Set the Observe counter of the path.
+
+        :param v: the Observe counter value
+        """
+        assert isinstance(v, int)
+        self._state.observe_count = v
+
+    def render_GET(self, request):
+        return self.handler.render_GET(request, self)
+
+    def render_PUT(self, request):
+        return self.handler.render_PUT(request, self)
+
+    def render_POST(self, request):
+        return self.handler.render_POST(request, self)
+
+    def render_DELETE(self, request):
+        return self.handler.render_DELETE(request, self)
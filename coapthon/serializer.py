@@ -250,6 +250,9 @@ class Serializer(object):
             fmt += "B"
             values.append(defines.PAYLOAD_MARKER)
 
+            if isinstance(payload, memoryview):
+                # a block of a blockwise transfer
+                payload = payload.tobytes()
             for b in str(payload):
                 fmt += "c"
                 values.append(b)
@@ -4,15 +4,19 @@ import socket
 import threading
 import time
 from coapthon import defines
+from coapthon.endpoint import EndpointRegistry
 from coapthon.layer.blockwise import BlockwiseLayer
 from coapthon.layer.message import MessageLayer
-from coapthon.layer.observe import ObserveLayer
+from coapthon.layer.observe import ObserveLayer, ObserverRegistry
+from coapthon.layer.outbound import OutboundLayer
+from coapthon.layer.quickblock import QuickBlockLayer
 from coapthon.layer.request import RequestLayer
 from coapthon.layer.resource import ResourceLayer
 from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
 from coapthon.resources.resource import Resource
+from coapthon.resources.template import TemplateResource
 from coapthon.serializer import Serializer
 import concurrent.futures
 import logging
@@ -54,8 +58,16 @@ class CoAP(object):
         self.received = {}
         self.sent = {}
         self.call_id = {}
-        self.relation = {}
-        self.blockwise = {}
+        # observe relations, managed by the observe layer
+        self.relation = ObserverRegistry()
+        # (count, period) of the CON notifications of the resources without their own policy
+        self.notification_policy = (defines.NOTIFICATION_CON_COUNT, defines.NOTIFICATION_CON_PERIOD)
+        # key -> BlockwiseSession, managed by the blockwise layer
+        self.blockwise = None
+        # RTT and loss statistics of the clients, used to choose the block sizes
+        self.endpoints = EndpointRegistry()
+        # maximum number of CON messages outstanding to each client, the following ones are queued
+        self.nstart = defines.NSTART
         if starting_mid is None:
             self._currentMID = random.randint(1, 1000)
         else:
@@ -70,9 +82,11 @@ class CoAP(object):
         # Initialize layers
         self.request_layer = RequestLayer(self)
         self.blockwise_layer = BlockwiseLayer(self)
+        self.quickblock_layer = QuickBlockLayer(self)
         self.resource_layer = ResourceLayer(self)
         self.message_layer = MessageLayer(self)
         self.observe_layer = ObserveLayer(self)
+        self.outbound_layer = OutboundLayer(self)
 
         # Clean MIDs
         self.timer_mid = threading.Timer(defines.EXCHANGE_LIFETIME, self.purge_mids)
@@ -126,7 +140,17 @@ class CoAP(object):
         serializer = Serializer()
         message = serializer.serialize(message)
 
-        self._socket.sendto(message, (host, port))
+        self.send_datagram(message, host, port)
+
+    def send_datagram(self, datagram, host, port):
+        """
+        Send an encoded message.
+
+        :param datagram: the encoded message
+        :param host: destination host
+        :param port: destination port
+        """
+        self._socket.sendto(datagram, (host, port))
 
     def listen(self, timeout=10):
         """
@@ -181,6 +205,7 @@ class CoAP(object):
             pass
         finally:
             self.timer_mid = None
+        self.observe_layer.close()
         self._socket.close()
 
     def done_callback(self, future):
@@ -219,7 +244,13 @@ class CoAP(object):
                 response = self.request_layer.process(ret)
             else:
                 response = ret
-            self.schedule_retrasmission(response)
+            if response is None:
+                # e.g. a Q-Block1 block which needs no response
+                return None
+            if response.type == defines.inv_types["CON"]:
+                # a separate response, it may have to wait for the other CON messages to the client
+                self.outbound_layer.send(response)
+                return None
             # log.msg("Send Response")
             return response, host, port
         elif isinstance(message, Response):
@@ -255,7 +286,7 @@ class CoAP(object):
             now = time.time()
             sent_key_to_delete = []
             for key in self.sent.keys():
-                message, timestamp = self.sent.get(key)
+                message, timestamp, retransmissions = self.sent.get(key)
                 if timestamp + defines.EXCHANGE_LIFETIME <= now:
                     sent_key_to_delete.append(key)
             received_key_to_delete = []
@@ -267,6 +298,8 @@ class CoAP(object):
                 del self.sent[key]
             for key in received_key_to_delete:
                 del self.received[key]
+            self.blockwise_layer.purge(now)
+            self.quickblock_layer.purge(now)
             for future in self.pending_futures:
                 if future.done():
                     self.pending_futures.remove(future)
@@ -274,13 +307,18 @@ class CoAP(object):
 
     def add_resource(self, path, resource):
         """
-        Helper function to add resources to the resource directory during server initialization.
+        Helper function to add resources to the resource directory during server initialization. A TemplateResource
+        is registered as the handler of a path template, e.g. sensors/{id}/temp.
 
         :param path: path of the resource to create
         :param resource: the actual resource to create
         :return: True, if successful
         """
         assert isinstance(resource, Resource)
+        if isinstance(resource, TemplateResource):
+            resource.bind(path)
+            self.root.add_template(resource)
+            return True
         path = path.strip("/")
         paths = path.split("/")
         actual_path = ""
@@ -327,15 +365,25 @@ class CoAP(object):
         :param resource: the resource to be put into the message
         :return: the response after blockwise layer and the resource
         """
+        if len(request.q_block2) > 0 and request.code == defines.inv_codes["GET"]:
+            # Q-Block2 transfer
+            return self.quickblock_layer.start_block2(request, response, resource), resource
         host, port = request.source
         key = hash(str(host) + str(port) + str(request.token))
         if key in self.blockwise:
             # Handle Blockwise transfer
-            return self.blockwise_layer.handle_response(key, response, resource), resource
-        if resource is not None and len(resource.payload) > defines.MAX_PAYLOAD \
-                and request.code == defines.inv_codes["GET"]:
-            self.blockwise_layer.start_block2(request)
-            return self.blockwise_layer.handle_response(key, response, resource), resource
+            return self.blockwise_layer.handle_response(key, response, resource, request), resource
+        if response.payload is None and resource is not None:
+            payload = resource.payload
+        else:
+            payload = response.payload
+        if isinstance(payload, tuple):
+            # (Content-Type, payload)
+            payload = payload[1]
+        if payload is not None and request.code == defines.inv_codes["GET"] \
+                and len(payload) > self.endpoints.block_size((host, port), resource):
+            self.blockwise_layer.start_block2(request, resource)
+            return self.blockwise_layer.handle_response(key, response, resource, request), resource
         return response, resource
 
     def notify(self, resource):
@@ -383,26 +431,37 @@ class CoAP(object):
         """
         Create the notification message and sends it from the main Thread.
 
-        :type t: (resource, request, response)
+        :type t: (resource, relation)
         :param t: the arguments of the notification message
         :return: the notification message
         """
-        resource, request, notification = self.observe_layer.prepare_notification(t)
+        resource, relation, notification = self.observe_layer.prepare_notification(t)
         if notification is not None:
-            self.observe_layer.send_notification((resource, request, notification))
+            self.observe_layer.send_notification((resource, relation, notification))
+
+    def prepare_notifications(self, t):
+        """
+        Create the notifications of an update for all the observers of a resource and send them.
+
+        :type t: (resource, [relation])
+        :param t: the resource and its observers
+        """
+        for resource, relation, notification, datagram in self.observe_layer.prepare_notifications(t):
+            if notification is not None:
+                self.observe_layer.send_notification((resource, relation, notification), datagram)
 
     def prepare_notification_deletion(self, t):
         """
         Create the notification message for deleted resource and sends it from the main Thread.
 
 
-        :type t: (resource, request, notification)
+        :type t: (resource, relation)
         :param t: the arguments of the notification message
         :return: the notification message
         """
-        resource, request, notification = self.observe_layer.prepare_notification_deletion(t)
+        resource, relation, notification = self.observe_layer.prepare_notification_deletion(t)
         if notification is not None:
-            self.observe_layer.send_notification((resource, request, notification))
+            self.observe_layer.send_notification((resource, relation, notification))
 
     def schedule_retrasmission(self, message):
         """
@@ -412,7 +471,7 @@ class CoAP(object):
         """
         host, port = message.destination
         if message.type == defines.inv_types['CON']:
-            future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
+            future_time = self.endpoints.timeout((host, port))
             key = hash(str(host) + str(port) + str(message.mid))
             self.call_id[key] = self.executor.submit(self.retransmit, (message, future_time, 0))
             self.pending_futures.append(self.call_id[key])
@@ -438,21 +497,33 @@ class CoAP(object):
 
         if retransmit_count < defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected):
             retransmit_count += 1
-            self.sent[key] = (message, time.time())
+            self.endpoints.lost((host, port))
+            self.pending_futures.remove(self.call_id.pop(key))
+            # a notification superseded while in transmission is replaced by the newest one
+            replaced = self.observe_layer.replace_notification(message)
+            if replaced is message:
+                # the RTT is measured from the first transmission
+                message, timestamp, retransmissions = self.sent.get(key, (message, time.time(), 0))
+                self.sent[key] = (message, timestamp, retransmissions + 1)
+            else:
+                # the newer notification holds the slot, a late ACK of the former one does not free it
+                self.outbound_layer.transfer(message, replaced)
+                message = replaced
+                key = hash(str(host) + str(port) + str(message.mid))
+                self.sent[key] = (message, time.time(), 0)
+            message.retransmitted = True
             self.send(message, host, port)
-            future_time *= 2
-            self.pending_futures.remove(self.call_id[key])
+            future_time = self.endpoints.backoff((host, port), future_time)
             self.call_id[key] = self.executor.submit(self.retransmit, (message, future_time, retransmit_count))
             self.pending_futures.append(self.call_id[key])
         elif retransmit_count >= defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected):
             print "Give up on Message " + str(message.mid)
             print "----------------------------------------"
             message.timeouted = True
+            self.outbound_layer.release(message)
             if message is not None and message.observe is not None:
-                for resource in self.relation.keys():
-                    host, port = message.destination
-                    key = hash(str(host) + str(port) + str(message.token))
-                    self.observe_layer.remove_observer(resource, key)
+                # the client went away, its other observations would time out as well
+                self.observe_layer.remove_endpoint(host, port)
             self.pending_futures.remove(self.call_id[key])
             del self.call_id[key]
 
@@ -1,3 +1,5 @@
+import re
+
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
@@ -34,10 +36,68 @@ def bit_len(int_type):
         length += 1
     return length
 
+
+def read_payload(payload):
+    """
+    Get the payload of a request as a string, reading and closing it if it is a file, as the bodies of the
+    blockwise uploads spilled to disk.
+
+    :param payload: the payload
+    :return: the payload as a string
+    """
+    if hasattr(payload, "read"):
+        try:
+            return payload.read()
+        finally:
+            payload.close()
+    return payload
+
    
 class Tree(object):
     def __init__(self):
         self.tree = {}
+        self._listeners = []
+        # handlers of path templates, see coapthon.resources.template
+        self._templates = []
+
+    def add_listener(self, listener):
+        """
+        Register an object to be informed when resources are added or removed. The listener must implement
+        resource_added(path, resource) and resource_removed(path).
+
+        :param listener: the listener
+        """
+        self._listeners.append(listener)
+        for key, value in self.tree.iteritems():
+            listener.resource_added(key, value)
+        if hasattr(listener, "template_added"):
+            for handler in self._templates:
+                listener.template_added(handler)
+
+    def add_template(self, handler):
+        """
+        Register the handler of a path template. The concrete paths are resolved by the handler only when they are
+        not registered in the tree.
+
+        :type handler: coapthon.resources.template.TemplateResource
+        :param handler: the handler, already bound to its template
+        """
+        self._templates.append(handler)
+        for listener in self._listeners:
+            if hasattr(listener, "template_added"):
+                listener.template_added(handler)
+
+    def template(self, path):
+        """
+        Get the handler of the template matching a path.
+
+        :param path: the path
+        :return: the handler or None
+        """
+        for handler in self._templates:
+            if handler.template.match(path) is not None:
+                return handler
+        return None
 
     def dump(self):
         """
@@ -48,10 +108,19 @@ class Tree(object):
         return self.tree.keys()
 
     def with_prefix(self, path):
+        """
+        Get the registered paths which are prefixes of (or equal to) the path. Only the prefixes of the path are
+        looked up, so the cost does not depend on the number of registered resources.
+
+        :param path: the path
+        :return: the list of registered paths
+        """
         ret = []
-        for key in self.tree.keys():
-            if path.startswith(key):
-                ret.append(key)
+        for i in xrange(1, len(path) + 1):
+            if path[:i] in self.tree:
+                ret.append(path[:i])
+        if path not in self.tree and self.template(path) is not None:
+            ret.append(path)
 
         if len(ret) > 0:
             return ret
@@ -68,13 +137,33 @@ class Tree(object):
         raise KeyError
 
     def __getitem__(self, item):
-        return self.tree[item]
+        try:
+            return self.tree[item]
+        except KeyError:
+            handler = self.template(item)
+            if handler is None:
+                raise KeyError(item)
+            return handler.instance(item)
 
     def __setitem__(self, key, value):
+        handler = getattr(value, "handler", None)
+        if handler is not None and key not in self.tree and self.template(key) is handler:
+            # instance of a template, kept by its handler
+            return
         self.tree[key] = value
+        for listener in self._listeners:
+            listener.resource_added(key, value)
 
     def __delitem__(self, key):
+        if key not in self.tree:
+            handler = self.template(key)
+            if handler is None:
+                raise KeyError(key)
+            handler.discard(key)
+            return
         del self.tree[key]
+        for listener in self._listeners:
+            listener.resource_removed(key)
 
 
 def parse_blockwise(value):
@@ -105,3 +194,84 @@ def parse_blockwise(value):
         m >>= 3
         size = value & 0x000007
     return num, int(m), pow(2, (size + 4))
+
+
+def blockwise_value(num, m, size):
+    """
+    Format the value of a Block or Q-Block option.
+
+    :param num: the block number
+    :param m: the M bit
+    :param size: the block size, a power of two from 16 to 1024
+    :return: the option value
+    """
+    szx = min(max(bit_len(size) - 5, 0), 6)
+    return (num << 4) | (m << 3) | szx
+
+
+def encode_missing_blocks(nums):
+    """
+    Encode the numbers of the missing blocks of a Q-Block transfer as a CBOR sequence of unsigned integers
+    (application/missing-blocks+cbor-seq).
+
+    :param nums: the block numbers
+    :return: the payload
+    """
+    payload = ""
+    for num in nums:
+        if num < 24:
+            payload += chr(num)
+        elif num < 0x100:
+            payload += chr(0x18) + chr(num)
+        elif num < 0x10000:
+            payload += chr(0x19) + chr(num >> 8) + chr(num & 0xFF)
+        else:
+            payload += chr(0x1A) + "".join(chr((num >> shift) & 0xFF) for shift in (24, 16, 8, 0))
+    return payload
+
+
+def decode_missing_blocks(payload):
+    """
+    Decode the numbers of the missing blocks of a Q-Block transfer.
+
+    :param payload: the CBOR sequence of unsigned integers
+    :return: the list of block numbers
+    :raise ValueError: if the payload is not a sequence of unsigned integers
+    """
+    nums = []
+    pos = 0
+    payload = str(payload) if payload is not None else ""
+    while pos < len(payload):
+        first = ord(payload[pos])
+        pos += 1
+        if first >> 5 != 0:
+            raise ValueError("Not an unsigned integer")
+        info = first & 0x1F
+        if info < 24:
+            nums.append(info)
+            continue
+        length = {0x18: 1, 0x19: 2, 0x1A: 4}.get(info)
+        if length is None or pos + length > len(payload):
+            raise ValueError("Malformed unsigned integer")
+        value = 0
+        for c in payload[pos:pos + length]:
+            value = (value << 8) | ord(c)
+        nums.append(value)
+        pos += length
+    return nums
+
+
+def parse_uri(uri):
+    """
+    Split a coap:// URI.
+
+    :param uri: the URI, the host is a name, an IPv4 address or an IPv6 address between brackets
+    :return: host, port (5683 if not given) and path
+    """
+    m = re.match("([a-zA-Z]{4,5})://([a-zA-Z0-9.\-]*)(?::([0-9]*))?(?:/(\S*))?$", uri)
+    if m is None:
+        m = re.match("([a-zA-Z]{4,5})://\[([a-fA-F0-9:.]*)\](?::([0-9]*))?(?:/(\S*))?$", uri)
+    if m is None:
+        raise ValueError("Not a valid URI: " + uri)
+    port = int(m.group(3)) if m.group(3) else 5683
+    return m.group(2), port, m.group(4) or ""
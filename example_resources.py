@@ -1,5 +1,7 @@
 import time
 from coapthon.resources.resource import Resource
+from coapthon.resources.template import TemplateResource
+from coapthon.utils import read_payload
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
@@ -15,13 +17,13 @@ class BasicResource(Resource):
         return self
 
     def render_PUT(self, request):
-        self.payload = request.payload
+        self.payload = read_payload(request.payload)
         return self
 
     def render_POST(self, request):
         res = BasicResource()
         res.location_query = request.query
-        res.payload = request.payload
+        res.payload = read_payload(request.payload)
         return res
 
     def render_DELETE(self, request):
@@ -38,7 +40,7 @@ class Storage(Resource):
 
     def render_POST(self, request):
         res = BasicResource()
-        res.payload = request.payload
+        res.payload = read_payload(request.payload)
         res.location_query = request.query
         return res
 
@@ -52,13 +54,13 @@ class Child(Resource):
         return self
 
     def render_PUT(self, request):
-        self.payload = request.payload
+        self.payload = read_payload(request.payload)
         return self
 
     def render_POST(self, request):
         res = BasicResource()
         res.location_query = request.query
-        res.payload = request.payload
+        res.payload = read_payload(request.payload)
         return res
 
     def render_DELETE(self, request):
@@ -123,6 +125,33 @@ class Big(Resource):
 
     def render_POST(self, request):
         if request.payload is not None:
-            self.payload += request.payload
+            self.payload += read_payload(request.payload)
         return self
 
+
+class Sensor(TemplateResource):
+    def __init__(self, name="Sensor", coap_server=None):
+        super(Sensor, self).__init__(name, coap_server, visible=True, observable=True, allow_children=False,
+                                     provider=self.sensors)
+        self.resource_type = "temperature"
+        self.add_encoder("application/json", lambda value: "{\"temperature\": " + value + "}")
+        self.temperatures = {"1": 21, "2": 23}
+
+    def sensors(self):
+        return [{"id": sensor_id} for sensor_id in sorted(self.temperatures.keys())]
+
+    def render_GET(self, request, instance):
+        temperature = self.temperatures.get(instance.params["id"])
+        if temperature is None:
+            return "NOT_FOUND"
+        instance.payload = str(temperature)
+        return instance
+
+    def render_PUT(self, request, instance):
+        payload = read_payload(request.payload)
+        try:
+            self.temperatures[instance.params["id"]] = int(payload)
+        except ValueError:
+            return "BAD_REQUEST"
+        instance.payload = payload
+        return instance
@@ -462,7 +462,7 @@ class Tests(unittest.TestCase):
         expected.observe = 1
 
         expected2 = Response()
-        expected2.type = defines.inv_types["CON"]
+        expected2.type = defines.inv_types["NON"]
         expected2._mid = self.server_mid
         expected2.code = defines.responses["CONTENT"]
         expected2.token = None
@@ -496,7 +496,7 @@ class Tests(unittest.TestCase):
         self.current_mid += 1
 
         expected2 = Response()
-        expected2.type = defines.inv_types["CON"]
+        expected2.type = defines.inv_types["NON"]
         expected2._mid = self.server_mid
         expected2.code = defines.responses["CONTENT"]
         expected2.token = None
@@ -617,7 +617,7 @@ class Tests(unittest.TestCase):
         req._mid = self.current_mid
         req.destination = self.server_address
         req.payload = """"Me sabbee plenty"—grunted Queequeg, puffing away at his pipe """
-        req.block1 = (1, 1, 64)
+        req.block1 = (0, 1, 64)
 
         expected = Response()
         expected.type = defines.inv_types["ACK"]
@@ -625,7 +625,7 @@ class Tests(unittest.TestCase):
         expected.code = defines.responses["CONTINUE"]
         expected.token = None
         expected.payload = None
-        expected.block1 = (1, 1, 64)
+        expected.block1 = (0, 1, 64)
 
         exchange1 = (req, expected)
         self.current_mid += 1
@@ -638,7 +638,7 @@ class Tests(unittest.TestCase):
         req._mid = self.current_mid
         req.destination = self.server_address
         req.payload = """and sitting up in bed. "You gettee in," he added, motioning"""
-        req.block1 = (2, 0, 64)
+        req.block1 = (1, 0, 64)
 
         expected = Response()
         expected.type = defines.inv_types["ACK"]
@@ -3,6 +3,7 @@ import threading
 import time
 from coapthon import defines
 from coapthon.resources.resource import Resource
+from coapthon.utils import read_payload
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
@@ -18,22 +19,24 @@ class TestResource(Resource):
         return self
 
     def render_PUT(self, request):
+        payload = read_payload(request.payload)
         for option in request.options:
             if option.number == defines.inv_options["Content-Type"]:
-                self.payload = {option.value: request.payload}
+                self.payload = {option.value: payload}
                 return self
-        self.payload = request.payload
+        self.payload = payload
         return self
 
     def render_POST(self, request):
+        payload = read_payload(request.payload)
         res = TestResource()
         res.location_query = request.query
         for option in request.options:
             if option.number == defines.inv_options["Content-Type"]:
-                res.payload = {option.value: request.payload}
+                res.payload = {option.value: payload}
                 return res
 
-        res.payload = request.payload
+        res.payload = payload
         return res
 
     def render_DELETE(self, request):
@@ -110,20 +113,11 @@ class LargeUpdateResource(Resource):
         super(LargeUpdateResource, self).__init__(name, coap_server, visible=True, observable=False,
                                                   allow_children=False)
         self.payload = ""
-        self._temp_payload = {}
 
     def render_GET(self, request):
         return self
 
     def render_PUT(self, request):
-        if request.blockwise:
-            key = hash(str(request.source[0]) + str(request.source[1]) + str(request.token))
-            if key in self._temp_payload:
-                old = self._temp_payload[key]
-                old += request.payload
-                self._temp_payload[key] = old
-            else:
-                self._temp_payload[key] = request.payload
-            if request.last_block:
-                self.payload = self._temp_payload[key]
+        # the blocks are reassembled by the server
+        self.payload = str(read_payload(request.payload))
         return self
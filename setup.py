@@ -12,5 +12,6 @@ setup(
     description='CoAPthon is a python library to the CoAP protocol aligned with 18th version of the draft. '
                 'It is based on the Twisted Framework.',
     scripts=['coapserver.py', 'coapclient.py', 'example_resources.py', 'coapforwardproxy.py', 'coapreverseproxy.py',
+             'coapresourcedirectory.py',
              'reverse_proxy_mapping.xml'], requires=['twisted', 'sphinx', 'bitstring', 'futures']
 )
@@ -1,15 +1,34 @@
+import gc
+import Queue
 import random
 import socket
+import StringIO
+import subprocess
+import sys
 import threading
 import unittest
 import time
 from coapserver import CoAPServer
+from example_resources import Big, Sensor
 from coapthon import defines
+from coapthon.client.cache import ClientCache
+from coapthon.client.coap_synchronous import HelperClientSynchronous
+from coapthon.client.multiplex import MultiplexClient
+from coapthon.client.poller import Poller
+from coapthon.endpoint import EndpointRegistry
+from coapthon.layer.observe import ObserveCondition, ObserveRelation
+from coapthon.layer.outbound import OutboundLayer
 from coapthon.messages.message import Message
 from coapthon.messages.option import Option
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.proxy.forward_coap_protocol import ProxyCoAP
 from coapthon.serializer import Serializer
+try:
+    from coapthon.client.coap_asyncio import HelperClientAsyncio, asyncio
+except ImportError:
+    # neither asyncio nor trollius
+    HelperClientAsyncio = None
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
@@ -338,6 +357,211 @@ class Tests(unittest.TestCase):
 
         self._test(req, expected)
 
+    def test_post_and_discover_storage(self):
+        print "\nGET /.well-known/core?href=/storage* - POST /storage/data1 - GET /.well-known/core?href=/storage*\n"
+        path = defines.DISCOVERY_URL
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = path
+        req.add_query("href=/storage*")
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = "</storage>;"
+        option = Option()
+        option.number = defines.inv_options["Content-Type"]
+        option.value = defines.inv_content_types["application/link-format"]
+        expected.add_option(option)
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['POST']
+        req.uri_path = "/storage/data1"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.payload = "Created"
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CREATED"]
+        expected.token = None
+        expected.payload = None
+        option = Option()
+        option.number = defines.inv_options["Location-Path"]
+        option.value = "/storage/data1"
+        expected.add_option(option)
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = path
+        req.add_query("href=/storage*")
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = "</storage>;</storage/data1>;"
+        option = Option()
+        option.number = defines.inv_options["Content-Type"]
+        option.value = defines.inv_content_types["application/link-format"]
+        expected.add_option(option)
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+    def test_template_put_get_discover(self):
+        print "\nPUT /sensors/3/temp - GET /sensors/3/temp (text, json, xml) - GET /sensors/9/temp - " \
+              "GET /.well-known/core?href=/sensors*\n"
+        req = Request()
+        req.code = defines.inv_codes['PUT']
+        req.uri_path = "/sensors/3/temp"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.payload = "30"
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CHANGED"]
+        expected.token = None
+        expected.payload = None
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/sensors/3/temp"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = "30"
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/sensors/3/temp"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+        option = Option()
+        option.number = defines.inv_options["Accept"]
+        option.value = defines.inv_content_types["application/json"]
+        req.add_option(option)
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = "{\"temperature\": 30}"
+        option = Option()
+        option.number = defines.inv_options["Content-Type"]
+        option.value = defines.inv_content_types["application/json"]
+        expected.add_option(option)
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/sensors/3/temp"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+        option = Option()
+        option.number = defines.inv_options["Accept"]
+        option.value = defines.inv_content_types["application/xml"]
+        req.add_option(option)
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["NOT_ACCEPTABLE"]
+        expected.token = None
+        expected.payload = None
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/sensors/9/temp"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["NOT_FOUND"]
+        expected.token = None
+        expected.payload = None
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = defines.DISCOVERY_URL
+        req.add_query("href=/sensors*")
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = "</sensors/1/temp>;rt=\"temperature\",</sensors/2/temp>;rt=\"temperature\"," \
+                           "</sensors/3/temp>;rt=\"temperature\","
+        option = Option()
+        option.number = defines.inv_options["Content-Type"]
+        option.value = defines.inv_content_types["application/link-format"]
+        expected.add_option(option)
+
+        self.current_mid += 1
+        self._test(req, expected)
+
+        # the ETag and the Observe counter of a path outlive its instance
+        handler = Sensor()
+        handler.bind("/sensors/{id}/temp")
+        instance = handler.instance("/sensors/1/temp")
+        instance.etag = "v1"
+        instance.observe_count = 5
+        del instance
+        gc.collect()
+        instance = handler.instance("/sensors/1/temp")
+        self.assertEqual((instance.etag, instance.observe_count), ("v1", 5))
+
     def test_long(self):
         print "\nGET /long\n"
         args = ("/long",)
@@ -444,6 +668,964 @@ class Tests(unittest.TestCase):
         self.current_mid += 1
         self._test_modular([(req, expected), (req2, expected2)])
 
+    def test_big_changed_during_transfer(self):
+        print "\nGET /big - POST /big - GET /big Block2 1\n"
+        path = "/big"
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = path
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = Big().payload[:1024]
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 14
+        expected.add_option(option)
+
+        self.current_mid += 1
+
+        req2 = Request()
+        req2.code = defines.inv_codes['POST']
+        req2.uri_path = path
+        req2.type = defines.inv_types["CON"]
+        req2._mid = self.current_mid
+        req2.payload = "Updated"
+        req2.destination = self.server_address
+
+        expected2 = Response()
+        expected2.type = defines.inv_types["ACK"]
+        expected2._mid = self.current_mid
+        expected2.code = defines.responses["CREATED"]
+        expected2.token = None
+        expected2.payload = None
+        option = Option()
+        option.number = defines.inv_options["Location-Path"]
+        option.value = path
+        expected2.add_option(option)
+
+        self.current_mid += 1
+
+        req3 = Request()
+        req3.code = defines.inv_codes['GET']
+        req3.uri_path = path
+        req3.type = defines.inv_types["CON"]
+        req3._mid = self.current_mid
+        req3.destination = self.server_address
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 22
+        req3.add_option(option)
+
+        expected3 = Response()
+        expected3.type = defines.inv_types["ACK"]
+        expected3._mid = self.current_mid
+        expected3.code = defines.responses["REQUEST_ENTITY_INCOMPLETE"]
+        expected3.token = None
+        expected3.payload = None
+
+        self.current_mid += 1
+        self._test_modular([(req, expected), (req2, expected2), (req3, expected3)])
+
+    def test_adaptive_block_size(self):
+        print "\nGET /big 256 per subnet - GET /big Block2 1 - GET /big 512 per resource\n"
+        path = "/big"
+        self.server.endpoints.set_block_size("127.0.0.0/8", 256)
+
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = path
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTENT"]
+        expected.token = None
+        expected.payload = Big().payload[:256]
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 12
+        expected.add_option(option)
+
+        self.current_mid += 1
+
+        req2 = Request()
+        req2.code = defines.inv_codes['GET']
+        req2.uri_path = path
+        req2.type = defines.inv_types["CON"]
+        req2._mid = self.current_mid
+        req2.destination = self.server_address
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 20
+        req2.add_option(option)
+
+        expected2 = Response()
+        expected2.type = defines.inv_types["ACK"]
+        expected2._mid = self.current_mid
+        expected2.code = defines.responses["CONTENT"]
+        expected2.token = None
+        expected2.payload = Big().payload[256:512]
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 28
+        expected2.add_option(option)
+
+        self.current_mid += 1
+        self._test_modular([(req, expected), (req2, expected2)])
+
+        self.server.root[path].block_size = 512
+        req3 = Request()
+        req3.code = defines.inv_codes['GET']
+        req3.uri_path = path
+        req3.type = defines.inv_types["CON"]
+        req3._mid = self.current_mid
+        req3.destination = self.server_address
+
+        expected3 = Response()
+        expected3.type = defines.inv_types["ACK"]
+        expected3._mid = self.current_mid
+        expected3.code = defines.responses["CONTENT"]
+        expected3.token = None
+        expected3.payload = Big().payload[:512]
+        option = Option()
+        option.number = defines.inv_options["Block2"]
+        option.value = 13
+        expected3.add_option(option)
+
+        self.current_mid += 1
+        self._test_modular([(req3, expected3)])
+
+        endpoints = EndpointRegistry()
+        self.assertEqual(endpoints.block_size(("10.0.0.1", 5683)), defines.MAX_PAYLOAD)
+        for i in range(defines.BLOCK_SIZE_MIN_SAMPLES):
+            endpoints.lost(("10.0.0.1", 5683))
+        self.assertEqual(endpoints.block_size(("10.0.0.1", 5683)), 256)
+        self.assertEqual(endpoints.block_size(("10.0.0.2", 5683)), defines.MAX_PAYLOAD)
+        # another server on the same host has its own statistics
+        self.assertEqual(endpoints.block_size(("10.0.0.1", 5684)), defines.MAX_PAYLOAD)
+        self.assertEqual(endpoints.block_size(("::ffff:10.0.0.1", 5683)), 256)
+
+    def test_endpoint_rto(self):
+        print "\nCoCoA RTO - LAN, satellite and aging\n"
+        endpoints = EndpointRegistry()
+        self.assertEqual(endpoints.rto(("10.0.0.1", 5683)), defines.ACK_TIMEOUT)
+        for i in range(20):
+            endpoints.rtt(("10.0.0.1", 5683), 0.002)
+        self.assertEqual(endpoints.rto(("10.0.0.1", 5683)), defines.RTO_MIN)
+        self.assertEqual(endpoints.backoff(("10.0.0.1", 5683), 0.1), 0.1 * 3)
+        # with a moderate loss, a LAN endpoint keeps the largest blocks and a distant one gets the smallest ones
+        for i in range(20):
+            endpoints.rtt(("10.0.0.4", 5683), 0.3)
+        for address in (("10.0.0.1", 5683), ("10.0.0.4", 5683)):
+            endpoints.lost(address)
+            endpoints.lost(address)
+        self.assertEqual(endpoints.block_size(("10.0.0.1", 5683)), 1024)
+        self.assertEqual(endpoints.block_size(("10.0.0.4", 5683)), 256)
+        # only weak samples, the requests are answered after a retransmission
+        for i in range(20):
+            endpoints.rtt(("10.0.0.2", 5683), 4.5, 1)
+        self.assertGreater(endpoints.rto(("10.0.0.2", 5683)), 4)
+        self.assertEqual(endpoints.backoff(("10.0.0.2", 5683), 4), 6)
+        # beyond two retransmissions the RTT is not sampled
+        endpoints.rtt(("10.0.0.3", 5683), 10, 3)
+        stats = endpoints.stats()
+        self.assertEqual(stats[("10.0.0.3", 5683)]["rto"], defines.ACK_TIMEOUT)
+        self.assertIsNone(stats[("10.0.0.3", 5683)]["srtt_weak"])
+
+        endpoints.get(("10.0.0.1", 5683)).rto_timestamp -= 16 * defines.RTO_MIN + 1
+        self.assertAlmostEqual(endpoints.rto(("10.0.0.1", 5683)), 2 * defines.RTO_MIN)
+
+    def test_qblock(self):
+        print "\nGET /big Q-Block2 - PUT /basic Q-Block1 - GET /basic Q-Block2\n"
+        client = HelperClientSynchronous()
+        response = client.get_qblock(path="coap://127.0.0.1:5683/big", size=64)
+        self.assertEqual(response.code, defines.responses["CONTENT"])
+        self.assertEqual(response.payload, Big().payload)
+        self.assertEqual(response.q_block2, [])
+
+        payload = "".join(chr(ord("a") + i % 26) for i in xrange(1000))
+        response = client.put_qblock(path="coap://127.0.0.1:5683/basic", payload=payload, size=64)
+        self.assertEqual(response.code, defines.responses["CHANGED"])
+
+        response = client.get_qblock(path="coap://127.0.0.1:5683/basic", size=256)
+        self.assertEqual(response.code, defines.responses["CONTENT"])
+        self.assertEqual(response.payload, payload)
+
+        # reassembled in a temporary file beyond UPLOAD_SPILL_THRESHOLD, the memory is released once complete
+        payload = "".join(chr(ord("a") + i % 26) for i in xrange(defines.UPLOAD_SPILL_THRESHOLD + 1000))
+        response = client.put_qblock(path="coap://127.0.0.1:5683/basic", payload=payload, size=1024)
+        self.assertEqual(response.code, defines.responses["CHANGED"])
+        self.assertEqual(self.server.blockwise_layer._memory, 0)
+        response = client.get_qblock(path="coap://127.0.0.1:5683/basic", size=1024)
+        self.assertEqual(response.payload, payload)
+
+        # Q-Block1 is repeatable (RFC 9177, Table 1)
+        request = Request()
+        for num in (0, 1):
+            option = Option()
+            option.number = defines.inv_options["Q-Block1"]
+            option.value = num << 4
+            request.add_option(option)
+        self.assertEqual(len(request.options), 2)
+
+    def test_multiplex_client(self):
+        print "\nGET /basic x100 - GET /big - GET /basic Observe - PUT /basic\n"
+        client = MultiplexClient(endpoints=EndpointRegistry())
+        try:
+            futures = [client.get(path="coap://127.0.0.1:5683/basic") for i in xrange(100)]
+            futures.append(client.get(path="coap://127.0.0.1:5683/big"))
+            tokens = set()
+            for future in futures[:-1]:
+                response = future.result(timeout=30)
+                self.assertEqual(response.code, defines.responses["CONTENT"])
+                self.assertEqual(response.payload, "Basic Resource")
+                tokens.add(response.token)
+            self.assertEqual(len(tokens), 100)
+            self.assertEqual(futures[-1].result(timeout=30).payload, Big().payload[:1024])
+
+            notifications = []
+            response = client.observe(path="coap://127.0.0.1:5683/basic", callback=notifications.append).result(5)
+            self.assertEqual(response.observe, 1)
+            response = client.put(path="coap://127.0.0.1:5683/basic", payload="Edited").result(5)
+            self.assertEqual(response.code, defines.responses["CHANGED"])
+            deadline = time.time() + 5
+            while len(notifications) < 2 and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual([str(n.payload) for n in notifications], ["Basic Resource", "Edited"])
+
+            # a callback raising does not stop the thread receiving the responses of the client
+            def failing(notification):
+                raise ValueError("callback failure")
+            response = client.observe(path="coap://127.0.0.1:5683/storage", callback=failing).result(5)
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            response = client.get(path="coap://127.0.0.1:5683/basic").result(5)
+            self.assertEqual(response.payload, "Edited")
+        finally:
+            client.close()
+
+    def test_twisted_client(self):
+        print "\nGET /basic x8 - POST /storage/data1 request - PUT /basic, Twisted client window 4\n"
+        # the reactor runs once per process
+        script = """
+from twisted.internet import reactor
+from coapthon import defines
+from coapthon.client.coap_protocol import HelperClient
+from coapthon.messages.request import Request
+client = HelperClient(server=("127.0.0.1", 5683), max_in_flight=4)
+results = []
+def callback(response):
+    results.append(defines.inv_responses.get(response.code, response.code))
+def error(*args):
+    results.append(None)
+request = Request()
+request.uri_path = "/storage/data1"
+request.payload = "Created"
+operations = [(client.protocol.get, ("/basic",), {}, (callback, error)) for i in range(8)]
+operations.append((client.protocol.post, (request,), {}, (callback, error)))
+operations.append((client.protocol.put, ("/basic", "Edited"), {}, (callback, error)))
+client.start(operations)
+reactor.callLater(30, reactor.stop)
+reactor.run()
+print sorted(results)
+"""
+        output = subprocess.check_output([sys.executable, "-c", script], stderr=subprocess.STDOUT)
+        self.assertEqual(output.strip().splitlines()[-1], str(sorted(["CONTENT"] * 8 + ["CREATED", "CHANGED"])))
+
+    def test_twisted_shared_observe(self):
+        print "\nGET /basic Observe x2 - one leaves - PUT /basic, Twisted client\n"
+        script = """
+from twisted.internet import reactor
+from coapthon.client.coap_protocol import HelperClient
+client = HelperClient(server=("127.0.0.1", 5683))
+staying, leaving = [], []
+client.protocol.observe(staying.append, "/basic")
+client.protocol.observe(leaving.append, "/basic")
+# another bound method of the same list
+reactor.callLater(1, client.protocol.unobserve, leaving.append, "/basic")
+reactor.callLater(1.5, client.protocol.put, lambda response: None, "/basic", "Edited")
+
+def done():
+    print [str(r.payload) for r in staying], [str(r.payload) for r in leaving]
+    reactor.stop()
+reactor.callLater(3, done)
+reactor.run()
+"""
+        output = subprocess.check_output([sys.executable, "-c", script], stderr=subprocess.STDOUT)
+        self.assertEqual(output.strip().splitlines()[-1], "['Basic Resource', 'Edited'] ['Basic Resource']")
+        # the observation is shared, the server has a single observer
+        self.assertEqual(len(self.server.relation.get(self.server.root["/basic"])), 1)
+
+    def test_forward_proxy(self):
+        print "\nGET /basic x50 via proxy - GET /separate via proxy - GET without Proxy-Uri\n"
+        proxy = ProxyCoAP(("127.0.0.1", 5684))
+        proxy_thread = threading.Thread(target=proxy.listen, args=(1,))
+        proxy_thread.start()
+        client = MultiplexClient(endpoints=EndpointRegistry())
+
+        def request(uri):
+            req = Request()
+            req.code = defines.inv_codes["GET"]
+            req.destination = ("127.0.0.1", 5684)
+            if uri is not None:
+                req.proxy_uri = uri
+            return client.send(req)
+        try:
+            futures = [request("coap://127.0.0.1:5683/basic") for i in xrange(50)]
+            for future in futures:
+                response = future.result(timeout=30)
+                self.assertEqual(response.code, defines.responses["CONTENT"])
+                self.assertEqual(response.payload, "Basic Resource")
+
+            # acknowledged by the proxy before the server answers, the response follows as a CON
+            response = request("coap://127.0.0.1:5683/separate").result(timeout=30)
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            self.assertEqual(response.type, defines.inv_types["CON"])
+            self.assertEqual(response.payload, "Separate")
+
+            response = request(None).result(timeout=30)
+            self.assertEqual(response.code, defines.responses["BAD_REQUEST"])
+        finally:
+            client.close()
+            proxy.close()
+            proxy_thread.join(timeout=25)
+
+    def test_poller(self):
+        print "\nPoll /basic and /storage x20 every 0.5 s for 1.5 s\n"
+        results = Queue.Queue()
+        poller = Poller(client=MultiplexClient(endpoints=EndpointRegistry()), rate=100, queue=results)
+        try:
+            targets = [poller.add("coap://127.0.0.1:5683/" + ("basic" if i % 2 == 0 else "storage"), 0.5)
+                       for i in xrange(20)]
+            time.sleep(1.5)
+            poller.remove(targets[0])
+            stats = poller.stats()
+        finally:
+            poller.close()
+            poller.client.close()
+        self.assertGreaterEqual(stats["received"], 40)
+        self.assertEqual(stats["failed"], 0)
+        # 100 requests per second at most, one outstanding per device
+        self.assertLessEqual(stats["sent"], 100 * 1.5 + 1)
+        self.assertLessEqual(stats["in_flight"], 1)
+        polled = set()
+        while not results.empty():
+            target, response = results.get()
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            polled.add(target)
+        self.assertEqual(len(polled), 20)
+
+    @unittest.skipIf(HelperClientAsyncio is None, "asyncio not available")
+    def test_asyncio_client(self):
+        print "\nGET /basic x50 - GET /basic Observe - PUT /basic - cancel\n"
+        loop = asyncio.new_event_loop()
+        client = HelperClientAsyncio(loop=loop, endpoints=EndpointRegistry())
+        try:
+            futures = [client.get("coap://127.0.0.1:5683/basic") for i in xrange(50)]
+            responses = loop.run_until_complete(asyncio.gather(*futures, loop=loop))
+            self.assertEqual(set(response.payload for response in responses), {"Basic Resource"})
+            self.assertEqual(len(set(response.token for response in responses)), 50)
+
+            stream = client.observe("coap://127.0.0.1:5683/basic")
+            self.assertEqual(loop.run_until_complete(stream.receive()).observe, 1)
+            response = loop.run_until_complete(client.put("coap://127.0.0.1:5683/basic", "Edited"))
+            self.assertEqual(response.code, defines.responses["CHANGED"])
+            notification = loop.run_until_complete(asyncio.wait_for(stream.receive(), 5, loop=loop))
+            self.assertEqual(notification.payload, "Edited")
+            stream.cancel()
+            self.assertIsNone(loop.run_until_complete(stream.receive()))
+        finally:
+            client.close()
+            loop.close()
+
+    def test_pipelined_block2(self):
+        print "\nGET /big Block2 window 4 - GET /big Block2 stream 64\n"
+        client = HelperClientSynchronous(endpoints=EndpointRegistry())
+        response = client.get(path="coap://127.0.0.1:5683/big", window=4)
+        self.assertEqual(response.code, defines.responses["CONTENT"])
+        self.assertEqual(response.payload, Big().payload)
+        self.assertIsNone(client._block2(response))
+
+        self.server.endpoints.set_block_size("127.0.0.0/8", 64)
+        chunks = list(client.get_stream(path="coap://127.0.0.1:5683/big", window=8))
+        self.assertEqual(len(chunks), (len(Big().payload) + 63) // 64)
+        self.assertEqual("".join(chunks), Big().payload)
+
+        # the first block is answered with the smaller size, the window follows on the socket of the client, with
+        # the token of the transfer: the blocks are served from the snapshot of a single rendering
+        resource = self.server.root["/big"]
+        renders = []
+        render_get = resource.render_GET
+
+        def counting(request):
+            renders.append(request)
+            return render_get(request)
+        resource.render_GET = counting
+        response = client.get(path="coap://127.0.0.1:5683/big", window=4)
+        del resource.render_GET
+        self.assertEqual(response.payload, Big().payload)
+        self.assertEqual(len(renders), 1)
+        stats = client.endpoints.stats()
+        self.assertEqual(stats.keys(), [("127.0.0.1", 5683)])
+        self.assertGreaterEqual(stats[("127.0.0.1", 5683)]["samples"], (len(Big().payload) + 63) // 64)
+
+        # the blocks requested at once with the same token are each served from their own Block2 option
+        layer = self.server.blockwise_layer
+        requests = []
+        for num in (1, 4):
+            req = Request()
+            req.code = defines.inv_codes["GET"]
+            req.uri_path = "/big"
+            req.token = "pipe"
+            req.source = ("127.0.0.1", 40000)
+            req.add_block2(num, 0, 64)
+            layer.handle_request(req)
+            requests.append(req)
+        for req in requests:
+            response = Response()
+            response.payload = Big().payload
+            response = layer.handle_response(hash("127.0.0.1" + "40000" + "pipe"), response, Big(), req)
+            num = client._block2(req)[0]
+            self.assertEqual(client._block2(response)[0], num)
+            self.assertEqual(response.payload.tobytes(), Big().payload[num * 64:(num + 1) * 64])
+
+    def test_streaming_transfer(self):
+        print "\nPUT /basic Block1 stream - GET /basic Block2 into a file - GET /basic Block2 from block 10\n"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(20000))
+        client = HelperClientSynchronous(endpoints=EndpointRegistry())
+        try:
+            uploaded = []
+            chunks = (payload[i:i + 700] for i in range(0, len(payload), 700))
+            response = client.put_stream(chunks, path="coap://127.0.0.1:5683/basic", size=512, length=len(payload),
+                                         progress=lambda sent, total: uploaded.append((sent, total)))
+            self.assertEqual(response.code, defines.responses["CHANGED"])
+            self.assertEqual(len(uploaded), (len(payload) + 511) // 512)
+            self.assertEqual(uploaded[-1], (len(payload), len(payload)))
+
+            sink = StringIO.StringIO()
+            downloaded = []
+            written = client.download(sink, path="coap://127.0.0.1:5683/basic", window=4,
+                                      progress=lambda received, total: downloaded.append((received, total)))
+            self.assertEqual(written, len(payload))
+            self.assertEqual(sink.getvalue(), payload)
+            self.assertEqual(downloaded[-1][0], len(payload))
+
+            # resume an interrupted download
+            rest = "".join(client.get_stream(path="coap://127.0.0.1:5683/basic", start=10, size=512))
+            self.assertEqual(rest, payload[5120:])
+
+            # a body larger than UPLOAD_SPILL_THRESHOLD, reassembled in a temporary file, reaches the resource as
+            # the file
+            resource = self.server.root["/basic"]
+            bodies = []
+            render_put = resource.render_PUT
+
+            def recording(request):
+                bodies.append(request.payload)
+                return render_put(request)
+            resource.render_PUT = recording
+            payload = "x" * (defines.UPLOAD_SPILL_THRESHOLD + 1000)
+            response = client.put_stream(StringIO.StringIO(payload), path="coap://127.0.0.1:5683/basic", size=1024)
+            del resource.render_PUT
+            self.assertEqual(response.code, defines.responses["CHANGED"])
+            self.assertEqual(len(bodies), 1)
+            self.assertTrue(hasattr(bodies[0], "read"))
+            self.assertEqual(self.server.blockwise_layer._memory, 0)
+            sink = StringIO.StringIO()
+            client.download(sink, path="coap://127.0.0.1:5683/basic", window=4)
+            self.assertEqual(sink.getvalue(), payload)
+        finally:
+            client.close()
+
+    def test_client_cache(self):
+        print "\nGET /basic x2 - PUT /basic - GET /basic ETag - GET /big x2\n"
+        resource = self.server.root["/basic"]
+        resource.max_age = 60
+        resource.etag = "v1"
+        cache = ClientCache()
+        client = HelperClientSynchronous(endpoints=EndpointRegistry(), cache=cache)
+        try:
+            response = client.get(path="coap://127.0.0.1:5683/basic")
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            response = client.get(path="coap://127.0.0.1:5683/basic")
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(response.payload, "Basic Resource")
+            self.assertLessEqual(response.max_age, 60)
+
+            # the PUT marks the response as stale, it is revalidated with its ETag
+            response = client.put(path="coap://127.0.0.1:5683/basic", payload="Basic Resource")
+            self.assertEqual(response.code, defines.responses["CHANGED"])
+            response = client.get(path="coap://127.0.0.1:5683/basic")
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            self.assertEqual(response.payload, "Basic Resource")
+            self.assertEqual(cache.validations, 1)
+
+            # the representation reassembled from its blocks is cached as a whole
+            client.get(path="coap://127.0.0.1:5683/big")
+            response = client.get(path="coap://127.0.0.1:5683/big")
+            self.assertEqual(response.payload, Big().payload)
+            stats = cache.stats()
+            self.assertEqual((stats["hits"], stats["validations"], stats["misses"], stats["entries"]), (2, 1, 2, 2))
+            self.assertEqual(stats["hit_ratio"], 0.6)
+        finally:
+            client.close()
+
+    def test_observe_fanout(self):
+        print "\nGET /basic Observe x3 - PUT /basic - notifications\n"
+        serializer = Serializer()
+        observers = []
+        for token in (None, "a", "observer"):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+            req = Request()
+            req.code = defines.inv_codes['GET']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.token = token
+            req.observe = 0
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            datagram, source = sock.recvfrom(4096)
+            response = serializer.deserialize(datagram, source[0], source[1])
+            self.assertEqual(response.code, defines.responses["CONTENT"])
+            observers.append((sock, token))
+
+        req = Request()
+        req.code = defines.inv_codes['PUT']
+        req.uri_path = "/basic"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.payload = "Edited"
+        self.current_mid += 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(serializer.serialize(req), self.server_address)
+        datagram, source = sock.recvfrom(4096)
+        self.assertEqual(serializer.deserialize(datagram, source[0], source[1]).code, defines.responses["CHANGED"])
+        sock.close()
+
+        mids = set()
+        for sock, token in observers:
+            datagram, source = sock.recvfrom(4096)
+            notification = serializer.deserialize(datagram, source[0], source[1])
+            self.assertEqual(notification.type, defines.inv_types["NON"])
+            self.assertEqual(notification.code, defines.responses["CONTENT"])
+            self.assertEqual(notification.token, token)
+            self.assertEqual(notification.payload, "Edited")
+            self.assertEqual(notification.observe, 2)
+            # the patched datagram is the one the serializer would produce
+            self.assertEqual(datagram, serializer.serialize(notification).raw)
+            mids.add(notification.mid)
+            sock.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+            sock.close()
+        self.assertEqual(len(mids), 3)
+
+    def test_observe_conditions(self):
+        print "\nGET /basic Observe pmin=1 - PUT /basic x5 - GET /storage Observe pmax=1\n"
+        serializer = Serializer()
+        observer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        observer.settimeout(5)
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/basic"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.observe = 0
+        req.add_query("pmin=1")
+        self.current_mid += 1
+        observer.sendto(serializer.serialize(req), self.server_address)
+        datagram, source = observer.recvfrom(4096)
+        self.assertEqual(serializer.deserialize(datagram, source[0], source[1]).observe, 1)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(5):
+            req = Request()
+            req.code = defines.inv_codes['PUT']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.payload = str(i)
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            datagram, source = sock.recvfrom(4096)
+        sock.close()
+
+        # the updates within pmin are coalesced in a notification of the latest state
+        datagram, source = observer.recvfrom(4096)
+        notification = serializer.deserialize(datagram, source[0], source[1])
+        self.assertEqual(notification.payload, "4")
+        self.assertEqual(notification.observe, 6)
+        observer.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+        observer.settimeout(0.5)
+        self.assertRaises(socket.timeout, observer.recvfrom, 4096)
+        observer.close()
+
+        observer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        observer.settimeout(5)
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/storage"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.observe = 0
+        req.add_query("pmax=1")
+        self.current_mid += 1
+        observer.sendto(serializer.serialize(req), self.server_address)
+        datagram, source = observer.recvfrom(4096)
+        start = time.time()
+        # pmax elapsed without updates
+        datagram, source = observer.recvfrom(4096)
+        notification = serializer.deserialize(datagram, source[0], source[1])
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        self.assertEqual(notification.payload, "Storage Resource for PUT, POST and DELETE")
+        observer.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+        observer.close()
+
+        condition = ObserveCondition(None, ObserveCondition.parse(["st=2", "gt=30"]))
+        condition.value = 20.0
+        self.assertFalse(condition.changed(21.0))
+        self.assertTrue(condition.changed(22.5))
+        condition.value = 29.5
+        self.assertTrue(condition.changed(30.5))
+        self.assertIsNone(ObserveCondition.parse(["pmin=5", "pmax=2"]))
+
+    def test_observe_cancellation(self):
+        print "\nGET /storage Observe=0 - GET /storage Observe=1 - GET /basic Observe=0 - PUT /basic - RST\n"
+        serializer = Serializer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        for path, observe in (("/storage", 0), ("/storage", 1), ("/basic", 0)):
+            req = Request()
+            req.code = defines.inv_codes['GET']
+            req.uri_path = path
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.token = "t1"
+            req.observe = observe
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            datagram, source = sock.recvfrom(4096)
+            if observe == 1:
+                # deregistered
+                self.assertEqual(len(self.server.relation), 0)
+        key = ("127.0.0.1", sock.getsockname()[1], "t1")
+        self.assertIs(self.server.relation.resource(key), self.server.root["/basic"])
+        relation = self.server.relation.get(self.server.root["/basic"])[key]
+        # the registration messages are not kept
+        self.assertIsInstance(relation, ObserveRelation)
+        self.assertEqual(relation.query, ())
+
+        req = Request()
+        req.code = defines.inv_codes['PUT']
+        req.uri_path = "/basic"
+        req.type = defines.inv_types["NON"]
+        req._mid = self.current_mid
+        req.payload = "Edited"
+        self.current_mid += 1
+        sock.sendto(serializer.serialize(req), self.server_address)
+        notification = None
+        while notification is None or notification.observe is None:
+            datagram, source = sock.recvfrom(4096)
+            notification = serializer.deserialize(datagram, source[0], source[1])
+        sock.sendto(serializer.serialize(Message.new_rst(notification)), self.server_address)
+        time.sleep(0.5)
+        self.assertIsNone(self.server.relation.resource(key))
+        self.assertEqual(len(self.server.relation), 0)
+        sock.close()
+
+    def test_notification_policy(self):
+        print "\nGET /basic Observe - PUT /basic x4 - NON NON CON NON\n"
+        serializer = Serializer()
+        self.server.root["/basic"].notification_policy = (3, None)
+        observer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        observer.settimeout(5)
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/basic"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.observe = 0
+        self.current_mid += 1
+        observer.sendto(serializer.serialize(req), self.server_address)
+        observer.recvfrom(4096)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        types = []
+        for i in xrange(4):
+            req = Request()
+            req.code = defines.inv_codes['PUT']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.payload = str(i)
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            sock.recvfrom(4096)
+            datagram, source = observer.recvfrom(4096)
+            notification = serializer.deserialize(datagram, source[0], source[1])
+            self.assertEqual(notification.payload, str(i))
+            types.append(notification.type)
+            if notification.type == defines.inv_types["CON"]:
+                observer.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+        sock.close()
+        observer.close()
+        self.assertEqual(types, [defines.inv_types["NON"], defines.inv_types["NON"], defines.inv_types["CON"],
+                                 defines.inv_types["NON"]])
+
+    def test_nstart_queue(self):
+        print "\nGET /basic Observe x3 - PUT /basic x2 - one CON notification outstanding\n"
+        serializer = Serializer()
+        self.server.root["/basic"].notification_policy = (1, None)
+        observer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        observer.settimeout(5)
+        for token in ("a", "b", "c"):
+            req = Request()
+            req.code = defines.inv_codes['GET']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.token = token
+            req.observe = 0
+            self.current_mid += 1
+            observer.sendto(serializer.serialize(req), self.server_address)
+            observer.recvfrom(4096)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+
+        def put(payload):
+            req = Request()
+            req.code = defines.inv_codes['PUT']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.payload = payload
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            sock.recvfrom(4096)
+
+        def receive():
+            datagram, source = observer.recvfrom(4096)
+            return serializer.deserialize(datagram, source[0], source[1])
+
+        put("1")
+        first = receive()
+        self.assertEqual(first.type, defines.inv_types["CON"])
+        # the other two wait until the first one is acknowledged, their retransmissions are the only datagrams
+        observer.settimeout(1)
+        try:
+            while True:
+                self.assertEqual(receive().token, first.token)
+        except socket.timeout:
+            pass
+        self.assertEqual(self.server.outbound_layer.queued(("127.0.0.1", observer.getsockname()[1])), 2)
+        put("2")
+
+        observer.settimeout(5)
+        received = [(first.token, first.payload)]
+        notification = first
+        while True:
+            observer.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+            last = set((token, payload) for token, payload in received if payload == "2")
+            if len(last) == 3:
+                break
+            notification = receive()
+            if (notification.token, notification.payload) not in received:
+                received.append((notification.token, notification.payload))
+        sock.close()
+        observer.close()
+        # the queued notifications are replaced by the newer ones, the first one is followed by its replacement
+        expected = [(token, "2") for token in ("a", "b", "c")] + [(first.token, "1")]
+        self.assertEqual(sorted(received), sorted(expected))
+
+        # a late ACK of a notification replaced at its retransmission, or a duplicated ACK, frees no slot
+        class Parent(object):
+            nstart = 1
+
+            def __init__(self):
+                self.sent = {}
+                self.transmitted = []
+
+            def schedule_retrasmission(self, message):
+                pass
+
+            def send(self, message, host, port):
+                self.transmitted.append(message.mid)
+
+        parent = Parent()
+        layer = OutboundLayer(parent)
+        messages = []
+        for mid in (1, 2, 3):
+            message = Response()
+            message.type = defines.inv_types["CON"]
+            message.mid = mid
+            message.destination = ("127.0.0.1", 9)
+            messages.append(message)
+        self.assertTrue(layer.send(messages[0]))
+        self.assertFalse(layer.send(messages[2]))
+        layer.transfer(messages[0], messages[1])
+        layer.release(messages[0])
+        self.assertEqual(layer.queued(("127.0.0.1", 9)), 1)
+        layer.release(messages[1])
+        layer.release(messages[1])
+        self.assertEqual(parent.transmitted, [1, 3])
+        self.assertEqual(layer.queued(("127.0.0.1", 9)), 0)
+        # the dequeued message holds the only slot
+        self.assertFalse(layer.send(messages[1]))
+
+    def test_notification_replacement(self):
+        print "\nGET /basic Observe - PUT /basic x3 - CON 0 - CON 2 (retransmission)\n"
+        serializer = Serializer()
+        self.server.root["/basic"].notification_policy = (1, None)
+        observer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        observer.settimeout(10)
+        req = Request()
+        req.code = defines.inv_codes['GET']
+        req.uri_path = "/basic"
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.observe = 0
+        self.current_mid += 1
+        observer.sendto(serializer.serialize(req), self.server_address)
+        observer.recvfrom(4096)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        for i in xrange(3):
+            req = Request()
+            req.code = defines.inv_codes['PUT']
+            req.uri_path = "/basic"
+            req.type = defines.inv_types["CON"]
+            req._mid = self.current_mid
+            req.payload = str(i)
+            self.current_mid += 1
+            sock.sendto(serializer.serialize(req), self.server_address)
+            sock.recvfrom(4096)
+        sock.close()
+
+        # the first notification is not acknowledged, the updates replace it instead of starting new transmissions
+        datagram, source = observer.recvfrom(4096)
+        first = serializer.deserialize(datagram, source[0], source[1])
+        self.assertEqual(first.payload, "0")
+        datagram, source = observer.recvfrom(4096)
+        notification = serializer.deserialize(datagram, source[0], source[1])
+        self.assertEqual(notification.type, defines.inv_types["CON"])
+        self.assertEqual(notification.payload, "2")
+        self.assertEqual(notification.observe, first.observe + 2)
+        observer.sendto(serializer.serialize(Message.new_ack(notification)), self.server_address)
+        observer.settimeout(1)
+        self.assertRaises(socket.timeout, observer.recvfrom, 4096)
+        observer.close()
+
+    def test_block1_upload(self):
+        print "\nPUT /basic Block1 0 - PUT /basic Block1 1 - GET /basic - PUT /big Size1\n"
+        path = "/basic"
+
+        req = Request()
+        req.code = defines.inv_codes['PUT']
+        req.uri_path = path
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+        req.payload = "a" * 64
+        req.block1 = (0, 1, 64)
+
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses["CONTINUE"]
+        expected.token = None
+        expected.payload = None
+        expected.block1 = (0, 1, 64)
+
+        self.current_mid += 1
+
+        req2 = Request()
+        req2.code = defines.inv_codes['PUT']
+        req2.uri_path = path
+        req2.type = defines.inv_types["CON"]
+        req2._mid = self.current_mid
+        req2.destination = self.server_address
+        req2.payload = "b" * 10
+        req2.block1 = (1, 0, 64)
+
+        expected2 = Response()
+        expected2.type = defines.inv_types["ACK"]
+        expected2._mid = self.current_mid
+        expected2.code = defines.responses["CHANGED"]
+        expected2.token = None
+        expected2.payload = None
+
+        self.current_mid += 1
+
+        req3 = Request()
+        req3.code = defines.inv_codes['GET']
+        req3.uri_path = path
+        req3.type = defines.inv_types["CON"]
+        req3._mid = self.current_mid
+        req3.destination = self.server_address
+
+        expected3 = Response()
+        expected3.type = defines.inv_types["ACK"]
+        expected3._mid = self.current_mid
+        expected3.code = defines.responses["CONTENT"]
+        expected3.token = None
+        expected3.payload = "a" * 64 + "b" * 10
+
+        self.current_mid += 1
+
+        req4 = Request()
+        req4.code = defines.inv_codes['PUT']
+        req4.uri_path = "/big"
+        req4.type = defines.inv_types["CON"]
+        req4._mid = self.current_mid
+        req4.destination = self.server_address
+        req4.payload = "c" * 64
+        req4.block1 = (0, 1, 64)
+        req4.size1 = defines.MAX_UPLOAD_SIZE + 1
+
+        expected4 = Response()
+        expected4.type = defines.inv_types["ACK"]
+        expected4._mid = self.current_mid
+        expected4.code = defines.responses["REQUEST_ENTITY_TOO_LARGE"]
+        expected4.token = None
+        expected4.payload = None
+        expected4.size1 = defines.MAX_UPLOAD_SIZE
+
+        self.current_mid += 1
+
+        req5 = Request()
+        req5.code = defines.inv_codes['PUT']
+        req5.uri_path = path
+        req5.type = defines.inv_types["CON"]
+        req5._mid = self.current_mid
+        req5.destination = self.server_address
+        req5.token = "tail"
+        req5.payload = "TAIL"
+        req5.block1 = (5, 0, 64)
+
+        expected5 = Response()
+        expected5.type = defines.inv_types["ACK"]
+        expected5._mid = self.current_mid
+        expected5.code = defines.responses["REQUEST_ENTITY_INCOMPLETE"]
+        expected5.token = "tail"
+        expected5.payload = None
+
+        self.current_mid += 1
+        self._test_modular([(req, expected), (req2, expected2), (req3, expected3), (req4, expected4),
+                            (req5, expected5)])
+
     def test_get_separate(self):
         print "\nGET /separate\n"
         args = ("/separate",)
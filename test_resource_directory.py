@@ -0,0 +1,125 @@
+import random
+import socket
+import threading
+import unittest
+from coapresourcedirectory import CoAPResourceDirectory
+from coapthon import defines
+from coapthon.messages.option import Option
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+
+__author__ = 'Giacomo Tanganelli'
+__version__ = "2.0"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.server_address = ("127.0.0.1", 5683)
+        self.current_mid = random.randint(1, 1000)
+        self.server = CoAPResourceDirectory("127.0.0.1", 5683)
+        self.server_thread = threading.Thread(target=self.server.listen, args=(10,))
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.server_thread.join(timeout=25)
+        self.server = None
+
+    def _test_rd(self, message_list):
+        serializer = Serializer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for message, expected in message_list:
+            datagram = serializer.serialize(message)
+            sock.sendto(datagram, message.destination)
+            datagram, source = sock.recvfrom(4096)
+            host, port = source
+            received_message = serializer.deserialize(datagram, host, port)
+            self.assertEqual(received_message.type, expected.type)
+            self.assertEqual(received_message.mid, expected.mid)
+            self.assertEqual(received_message.code, expected.code)
+            self.assertEqual(received_message.token, expected.token)
+            self.assertEqual(received_message.payload, expected.payload)
+            self.assertEqual(received_message.options, expected.options)
+        sock.close()
+
+    def _request(self, code, path, query=None, payload=None):
+        req = Request()
+        req.code = defines.inv_codes[code]
+        req.uri_path = path
+        if query is not None:
+            req.add_query(query)
+        if payload is not None:
+            req.payload = payload
+            req.content_type = defines.inv_content_types["application/link-format"]
+        req.type = defines.inv_types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+        return req
+
+    def _expected(self, code, payload=None, location_path=None):
+        expected = Response()
+        expected.type = defines.inv_types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.responses[code]
+        expected.token = None
+        expected.payload = payload
+        if location_path is not None:
+            option = Option()
+            option.number = defines.inv_options["Location-Path"]
+            option.value = location_path
+            expected.add_option(option)
+        if payload is not None:
+            option = Option()
+            option.number = defines.inv_options["Content-Type"]
+            option.value = defines.inv_content_types["application/link-format"]
+            expected.add_option(option)
+        self.current_mid += 1
+        return expected
+
+    def test_register_lookup_delete(self):
+        print "\nPOST /rd?ep=node1 - GET /rd-lookup/res?rt=temperature - DELETE /rd/1 - GET /rd-lookup/ep\n"
+        exchanges = []
+        req = self._request("POST", "/rd", "ep=node1&base=coap://10.0.0.1",
+                            "</sensors/temp>;rt=\"temperature\";if=\"core.s\",</sensors/light>;rt=\"light-lux\"")
+        exchanges.append((req, self._expected("CREATED", location_path="/rd/1")))
+
+        req = self._request("POST", "/rd", "ep=node2&base=coap://10.0.0.2", "</temp>;rt=\"temperature\"")
+        exchanges.append((req, self._expected("CREATED", location_path="/rd/2")))
+
+        req = self._request("GET", "/rd-lookup/res", "rt=temperature")
+        expected = self._expected("CONTENT", "<coap://10.0.0.1/sensors/temp>;rt=\"temperature\";"
+                                             "anchor=\"coap://10.0.0.1\";if=\"core.s\","
+                                             "<coap://10.0.0.2/temp>;rt=\"temperature\";anchor=\"coap://10.0.0.2\"")
+        exchanges.append((req, expected))
+
+        req = self._request("GET", "/rd-lookup/res", "rt=temp*&ep=node2")
+        expected = self._expected("CONTENT", "<coap://10.0.0.2/temp>;rt=\"temperature\";anchor=\"coap://10.0.0.2\"")
+        exchanges.append((req, expected))
+
+        req = self._request("GET", "/rd-lookup/res", "rt=temperature&page=1&count=1")
+        expected = self._expected("CONTENT", "<coap://10.0.0.2/temp>;rt=\"temperature\";anchor=\"coap://10.0.0.2\"")
+        exchanges.append((req, expected))
+
+        for query in ("rt=temperature&count", "count=-1", "page=-1&count=1"):
+            req = self._request("GET", "/rd-lookup/res", query)
+            exchanges.append((req, self._expected("BAD_REQUEST")))
+
+        req = self._request("DELETE", "/rd/1")
+        exchanges.append((req, self._expected("DELETED")))
+
+        req = self._request("GET", "/rd-lookup/ep", "rt=temperature")
+        expected = self._expected("CONTENT", "</rd/2>;lt=90000;base=\"coap://10.0.0.2\";ep=\"node2\"")
+        exchanges.append((req, expected))
+
+        req = self._request("POST", "/rd", "base=coap://10.0.0.3", "</temp>")
+        exchanges.append((req, self._expected("BAD_REQUEST")))
+
+        req = self._request("POST", "/rd", "ep=node3&lt", "</temp>")
+        exchanges.append((req, self._expected("BAD_REQUEST")))
+
+        self._test_rd(exchanges)
+
+if __name__ == '__main__':
+    unittest.main()